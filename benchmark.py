@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""benchmark.py measures HiPAT against the simulated Crtc and ntpd of crtc_simulator.py.
+
+Metrics:
+- serial: commands per second sustained by adjust_ms, by a freq_adj sized batch and by single sends.
+- convergence: simulated seconds get_quality_offset needs to return a confident offset.
+- cycle: ntpd queries, CPU seconds and memory for one control loop pass (check_crtc, get_quality_offset
+  and check_file_lengths). CPU is measured for the whole process, so it includes the simulator threads.
+- logging: microseconds per call of a debug record that is filtered out, with the message formatted before the
+  call and with lazy arguments, and of a record put on the queue of a QueueHandler.
+
+The results are printed as JSON. A previous result can be given with --baseline to print the change of every metric.
+
+Usage:
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json
+"""
+
+import argparse
+import json
+import logging
+import Queue
+import resource
+import sys
+import time
+import clock
+import crtc_simulator
+
+def cpu_seconds():
+    """returns: user and system CPU seconds used by the process."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def mean(values):
+    return sum(values) / float(len(values)) if values else 0.0
+
+def bench_serial(ser, adjust_steps, freq_steps):
+    """Measures the serial command rate. Every wait of the Crtc and the simulator follows the clock, so the rate
+    in simulated time is the rate the real Crtc would give.
+
+    ser: the Crtc of the simulator.
+    adjust_steps: number of ms steps sent with adjust_ms.
+    freq_steps: number of ten steps sent as one freq_adj batch, with one thousand step.
+    returns: dict of metrics.
+    """
+    start = clock.time()
+    ser.adjust_ms(adjust_steps)
+    adjust_seconds = clock.time() - start
+
+    commands = 'o' + 'x' * freq_steps
+    start = clock.time()
+    answered = ser.send_many(commands)
+    batch_seconds = clock.time() - start
+
+    start = clock.time()
+    single_answered = sum(1 for letter in commands[:5] if ser.send(letter) != 1)
+    single_seconds = clock.time() - start
+
+    return {'char_delay': ser.char_delay,
+            'adjust_ms_commands_per_second': adjust_steps / adjust_seconds,
+            'freq_adj_commands_per_second': len(commands) / batch_seconds,
+            'freq_adj_acknowledged': sum(answered.values()) / float(len(commands)),
+            'single_send_commands_per_second': 5 / single_seconds,
+            'single_send_acknowledged': single_answered / 5.0}
+
+def bench_convergence(crtc_sim, runs):
+    """Measures the time get_quality_offset needs to become confident.
+
+    returns: dict of metrics.
+    """
+    import check_offset
+    seconds, samples, stale, errors = [], [], [], []
+    since = clock.time()    # Measurements from before the serial benchmark changed the Crtc are not used
+    for run in range(runs):
+        start = clock.time()
+        offset = check_offset.get_quality_offset(since=since)
+        seconds.append(clock.time() - start)
+        samples.append(check_offset.last_convergence['samples'] if check_offset.last_convergence else 0)
+        stale.append(check_offset.last_convergence['stale'] if check_offset.last_convergence else 0)
+        errors.append(abs(offset + crtc_sim.offset_ms()))    # The offset is the Crtc error with the opposite sign
+    return {'runs': runs,
+            'simulated_seconds_mean': mean(seconds),
+            'simulated_seconds_max': max(seconds),
+            'samples_mean': mean(samples),
+            'stale_reads_mean': mean(stale),
+            'offset_error_ms_mean': mean(errors)}
+
+def bench_cycle(ser, ntpd_sim, cycles):
+    """Measures the cost of control loop passes.
+
+    ser: the Crtc of the simulator.
+    returns: dict of metrics.
+    """
+    import check_offset
+    import hipat_control
+    from config import config
+    queries = check_offset.peers.queries
+    requests = ntpd_sim.server.requests
+    cpu = cpu_seconds()
+    start = clock.time()
+    for cycle in range(cycles):
+        ser.check_crtc()
+        check_offset.get_quality_offset()
+        hipat_control.check_file_lengths(config['log_max_lines'])
+    return {'cycles': cycles,
+            'simulated_seconds_per_cycle': (clock.time() - start) / cycles,
+            'ntpd_queries_per_cycle': (check_offset.peers.queries - queries) / float(cycles),
+            'ntpd_requests_per_cycle': (ntpd_sim.server.requests - requests) / float(cycles),
+            'cpu_seconds_per_cycle': (cpu_seconds() - cpu) / cycles,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def bench_logging(calls):
+    """Measures the cost of logging calls in real time.
+    
+    calls: number of calls measured for every case.
+    returns: dict of metrics.
+    """
+    import logger
+    logfile = logger.init_logger('benchmark')
+    offsets = [0.1 * i for i in range(10)]
+    results = {}
+    
+    start = time.time()
+    for i in xrange(calls):
+        logfile.debug("New offset List: {0} New avg: {1}".format(str(offsets), i))
+    results['debug_eager_us'] = (time.time() - start) / calls * 1e6
+    
+    start = time.time()
+    for i in xrange(calls):
+        logfile.debug("New offset List: %s New avg: %s", offsets, i)
+    results['debug_filtered_us'] = (time.time() - start) / calls * 1e6
+    
+    queued = logging.getLogger('benchmark.queued')     # Kept off the terminal, the queue is never read
+    queued.propagate = False
+    queued.addHandler(logger.QueueHandler(Queue.Queue()))
+    start = time.time()
+    for i in xrange(calls):
+        queued.info("New offset List: %s New avg: %s", offsets, i)
+    results['info_queued_us'] = (time.time() - start) / calls * 1e6
+    return results
+
+def compare(results, baseline):
+    """Prints every metric next to its baseline value."""
+    for group in sorted(results['metrics']):
+        for name, value in sorted(results['metrics'][group].items()):
+            old = baseline.get('metrics', {}).get(group, {}).get(name)
+            if isinstance(old, (int, float)) and old:
+                change = '{0:+.1f}%'.format((value - old) * 100.0 / old)
+            else:
+                change = ''
+            sys.stderr.write('{0:<12} {1:<32} {2:>14.4f} {3:>14} {4:>8}\n'.format(
+                group, name, value, '' if old is None else '{0:.4f}'.format(old), change))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark HiPAT against the simulated Crtc and ntpd.')
+    parser.add_argument('--speed', type=float, default=20.0, help='simulated seconds per real second')
+    parser.add_argument('--runs', type=int, default=3, help='get_quality_offset runs for convergence')
+    parser.add_argument('--cycles', type=int, default=2, help='control loop passes')
+    parser.add_argument('--adjust-steps', type=int, default=20, help='ms steps sent with adjust_ms')
+    parser.add_argument('--freq-steps', type=int, default=20, help='ten steps sent in the freq_adj batch')
+    parser.add_argument('--backend', choices=['control', 'ntpq'], default='control', help='how ntpd is read')
+    parser.add_argument('--estimator', choices=['window', 'kalman'], help='estimator used by get_quality_offset')
+    parser.add_argument('--offset', type=float, default=25.0, help='Crtc error in ms')
+    parser.add_argument('--jitter', type=float, default=0.05, help='jitter in ms of the reference')
+    parser.add_argument('--log-calls', type=int, default=100000, help='logging calls measured for every case')
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    crtc_sim, ntpd_sim, directory = crtc_simulator.start_simulation(args.speed, args.offset, jitter=args.jitter, backend=args.backend)
+    from config import config
+    config['serial_calibrate'] = 'False'
+    if args.estimator:
+        config['estimator'] = args.estimator
+    from crtc import Crtc
+    ser = Crtc(crtc_sim.port)   # One Crtc for every benchmark, in reader mode a second one would share the lines
+    metrics = {'serial': bench_serial(ser, args.adjust_steps, args.freq_steps)}
+    metrics['convergence'] = bench_convergence(crtc_sim, args.runs)
+    metrics['cycle'] = bench_cycle(ser, ntpd_sim, args.cycles)
+    metrics['logging'] = bench_logging(args.log_calls)
+
+    results = {'metrics': metrics,
+               'settings': {'speed': args.speed, 'backend': args.backend, 'sample_mode': config['sample_mode'],
+                            'estimator': config['estimator'],
+                            'offset_window': config['offset_window'], 'time': time.time()}}
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print output
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
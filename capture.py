@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""capture.py records what HiPAT sees and does, so a run can be replayed offline with replay.py.
+
+Every record is (time, kind, data), pickled into a gzip file:
+- start: dict with the config, the state store and the refclocks of the Crtcs when the capture started.
+- peers: list of the ntpd peers read by a PeerTable, as tuples of the ntpq columns.
+- line: (refclock, line) received from a Crtc.
+- command: (refclock, text) written to a Crtc.
+- decision: (refclock, offset) acted upon by hipat_control.
+
+Recording is off until start is called. With capture_file set in config hipat_control records to it. If the file
+can't be written recording stops, HiPAT goes on without it.
+
+Usage:
+    capture.start('/mnt/tmpfs/capture.gz', ['127.127.20.0'])
+    for record in capture.read('/mnt/tmpfs/capture.gz'):
+        print record
+"""
+
+import atexit
+import gzip
+import pickle
+import threading
+import clock
+import logger
+
+#initialize the logger
+logfile = logger.init_logger('capture')
+
+FLUSH_INTERVAL = 10.0   # Seconds between flushes of the file, a flush ends a compressed block
+
+class Recorder():
+    """Recorder writes records to a file, or keeps them in a list if no file is given."""
+
+    def __init__(self, path=None):
+        """path: gzip file to write, None to keep the records in self.records."""
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = []
+        self.file = gzip.open(path, 'wb') if path else None
+        self.flushed = clock.monotonic()
+        self.failed = False     # Set when writing failed, nothing more is recorded
+
+    def record(self, kind, data, time=None):
+        """Records data of kind.
+
+        time: time of the record, default is the current time.
+        returns: None
+        """
+        entry = (clock.time() if time is None else time, kind, data)
+        with self.lock:
+            if self.failed:
+                return
+            if self.file is None:
+                self.records.append(entry)
+                return
+            try:
+                pickle.dump(entry, self.file, 2)
+                if clock.monotonic() - self.flushed > FLUSH_INTERVAL:
+                    self.file.flush()
+                    self.flushed = clock.monotonic()
+            except (IOError, OSError) as e:     # e.g. the temporary storage is full
+                logfile.error("Recording to {0} failed, the capture is stopped: {1}".format(self.path, e))
+                self.failed = True
+                try:
+                    self.file.close()
+                except (IOError, OSError):
+                    pass
+                self.file = None
+        return
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                try:
+                    self.file.close()
+                except (IOError, OSError) as e:
+                    logfile.error("Closing the capture {0} failed: {1}".format(self.path, e))
+                self.file = None
+
+recorder = None     # The Recorder in use, None when not capturing
+
+def start(path, refclocks, config=None, state=None):
+    """Starts recording, the start record holds what is needed to replay the run.
+
+    path: gzip file to write, None to keep the records in memory.
+    refclocks: addresses in ntpd of the Crtcs.
+    config: dict of the config items.
+    state: dict of the state store.
+    returns: the Recorder.
+    """
+    global recorder
+    recorder = Recorder(path)
+    atexit.register(recorder.close)
+    recorder.record('start', {'config': dict(config or {}), 'state': dict(state or {}), 'refclocks': list(refclocks)})
+    return recorder
+
+def record(kind, data, time=None):
+    """Records data of kind if a capture is running.
+
+    time: time of the record, default is the current time.
+    returns: None
+    """
+    if recorder is not None:
+        recorder.record(kind, data, time)
+
+def stop():
+    """Stops recording.
+
+    returns: the Recorder that was in use.
+    """
+    global recorder
+    stopped, recorder = recorder, None
+    if stopped is not None:
+        stopped.close()
+    return stopped
+
+def read(path):
+    """returns: iterator of the (time, kind, data) records in a capture file. A file cut short by a crash is read
+    until its last complete record."""
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except (EOFError, IOError, pickle.UnpicklingError):
+                return
@@ -7,17 +7,46 @@ returns: offset in ms to the reference server.
 
 from config import config
 import subprocess
-import time
+import clock
+import collections
 import sys
-import shelve
-import re
 import datetime
 import math
+import logging
 import logger
+import metrics
+import ntp_control
+import peer_table
+import socket
+import control_socket
+from offset_window import OffsetWindow
+from drift_estimator import DriftEstimator
+from time_series import get_series
+from state_store import get_store
+from crtc_health import device_key, REFCLOCK
 
 #initialize the logger
 logfile = logger.init_logger('check_offset')
 
+#NTP control client, one socket is kept open to ntpd when using the control backend.
+ntp_client = ntp_control.NtpControl(port=config['ntp_control_port'])
+
+#Snapshot of all peers, shared by every reader in this process.
+peers = peer_table.PeerTable(config['ntp_backend'], ntp_client, config['peer_cache_ttl'], config['ntpq_command'])
+
+#Time and number of samples the last get_quality_offset needed to be confident.
+last_convergence = None
+convergences = {}   # The last convergence of every refclock, None for the system clock
+windows = {}        # The OffsetWindow of the running or last get_quality_offset of every refclock
+
+ESTIMATE_MAX_AGE = 600  # Seconds an estimate of a running hipat_control is used by main
+
+def device_log(refclock):
+    """returns: logger for the messages about one Crtc, its messages are prefixed unless it is the first Crtc."""
+    if refclock in (None, REFCLOCK):
+        return logfile
+    return logger.DeviceLogger(logfile, 'Crtc ' + refclock)
+
 def ntpd_running():
     """Will make sure ntpd is running. If ntpd has stopped the offset to the reference server can have been to great, 
     that means we will need to do a more direct time synchronization to the server.
@@ -27,6 +56,19 @@ def ntpd_running():
     """
     ref_server = config["hipat_reference"]
     
+    #A fresh snapshot of the peers means ntpd answered a moment ago.
+    if peers.fresh():
+        return
+    
+    #If ntpd answers with its peers it is running and pgrep is not needed.
+    #The answer is kept as the new peer snapshot.
+    try:
+        peers.refresh()
+        if peers.peers:
+            return
+    except (ntp_control.NtpControlError, subprocess.CalledProcessError, OSError):
+        pass    # Fall back to checking the process list
+    
     #if Ntpd isn't running we set the date manually and restart the service.
     ntpd_status = subprocess.call(["pgrep", "ntpd"], stdout=subprocess.PIPE)
     if (ntpd_status != 0):
@@ -34,16 +76,17 @@ def ntpd_running():
         subprocess.call(["/etc/rc.d/ntpd", "stop"])
         subprocess.call(["ntpdate", ref_server])
         subprocess.call(["/etc/rc.d/ntpd", "restart"])
-        time.sleep(5)
+        clock.sleep(5)
         return True
         
     return
 
-def get_offset(ref_server = config["hipat_reference"], offset = True, **kwarg):
+def get_offset(ref_server = None, offset = True, snapshot = None, **kwarg):
     """Returns the offset between the client and the specified ref_server. It first performs a check to see if ntpd is running.
     
-    ref_server: string of ip to filter by, default is the reference
+    ref_server: string of ip to filter by, default is the reference in config
     offset: set to True if offset is part of the return statement
+    snapshot: (time, dict of Peer by ref_server) from peers.snapshot() to read from, default is the shared snapshot
     **kwarg: all other required feedback
     multiple_offsets: one specific kwarg can be multiple_offsets, this is used when running ntpd_running.
     
@@ -52,41 +95,28 @@ def get_offset(ref_server = config["hipat_reference"], offset = True, **kwarg):
     if ntpd_running() and ('multiple_offsets' in kwarg.keys()):  # test to make sure ntpd is running.
         return "restarted"  #ntpd had to be restarted
         
-    ntpq_output = subprocess.check_output(['ntpq', '-pn'])
-    regex = (   '(?P<ref_server>{0})\s+'# ref_server
-                '(?P<refid>\S+)\s+'     # refid 
-                '(?P<st>\S+)\s+'        # stratum
-                '(?P<t>\S+)\s+'         # type of server
-                '(?P<when>\S+)\s+'      # when, time since last update
-                '(?P<poll>\S+)\s+'      # poll, how often it is polled
-                '(?P<reach>\S+)\s+'     # how reliable the server is
-                '(?P<delay>\S+)\s+'     # time in ms to the server
-                '(?P<offset>\S+)\s+'    # offset to server in ms
-                '(?P<jitter>\S+)\s+'    # jitter of the server
-    ).format(ref_server)
-    output = re.search(regex, ntpq_output, re.MULTILINE)    # search for the line
+    if ref_server is None:
+        ref_server = config["hipat_reference"]
+    if snapshot is None:
+        snapshot_time, output = peers.get(ref_server)    # The peers are read from the shared snapshot
+    else:
+        snapshot_time, output = snapshot[0], snapshot[1].get(ref_server)
     
     arguments_wanted = dict({'offset': offset}.items() + kwarg.items())
     
     return_output = {}  # A dict used for return values, it's size varies with what the user wants returned.
     for argument, value in arguments_wanted.iteritems():    # loop through the arguments provided, processing the ones that are True.
         if argument.lower() == 'when' and value == True:
-            when_output = output.group('when')          # A test is made to see if the when variable is using m: minutes, h: hours, d: days
-            if when_output == '-':
-                when_output = 0
-            elif when_output[-1] == 'm':
-                when_output = float(when_output[:-1]) * 60
-            elif when_output[-1] == 'h':
-                when_output = float(when_output[:-1]) * 3600
-            elif when_output[-1] == 'd':
-                when_output = float(when_output[:-1]) * 86400
-            return_output['when'] = float(when_output)
+            when_output = peer_table.seconds(output.when)   # when can use m: minutes, h: hours, d: days
+            if output.when != '-':  # The snapshot may be a few seconds old, whole seconds are kept like ntpq shows
+                when_output = float(int(when_output + clock.time() - snapshot_time))
+            return_output['when'] = when_output
         elif value == True: # All True values will be processed here.
             try:
-                return_output[argument.lower()] = float(output.group(argument.lower()))
+                return_output[argument.lower()] = float(getattr(output, argument.lower()))
             except ValueError:  # If they contain string only characters they are exported as strings. 
-                return_output[argument.lower()] = output.group(argument.lower())
-            except IndexError:  # If an argument is not found in the regex results.
+                return_output[argument.lower()] = getattr(output, argument.lower())
+            except AttributeError:  # If an argument is not found in the peer variables.
                 continue
     if len(return_output) == 1:
         return return_output.values()[0]
@@ -110,69 +140,413 @@ def calculate_average_std(offset_list):
 
     return average, standard_deviation
     
-def get_quality_offset():
+#Health score of every reference, 1 when its latest samples were reached and agreed with the others.
+reference_health = {}
+HEALTH_WEIGHT = 0.2     # Weight of the latest poll in the health score, a reference failing every poll drops below 
+                        # HEALTH_LIMIT in 4 polls
+HEALTH_LIMIT = 0.5      # References with a lower health score don't add samples to the offset window
+DELAY_RANGE = 2.0       # Delays count at most this many times shorter or longer than the median delay, so by its 
+                        # delay one reference weighs at most 4 times as much as another
+
+def weighted_median(values):
+    """returns: weighted median of a list of (value, weight)."""
+    values = sorted(values)
+    half = sum(weight for value, weight in values) / 2.0
+    total = 0.0
+    for value, weight in values:
+        total += weight
+        if total >= half:
+            return value
+    return values[-1][0]
+
+def combine_references(readings, outlier_limit=None):
+    """Finds the references that agree with each other. The consensus is the median of the offsets weighted by the 
+    health score of each reference and the inverse of its delay, so one reference can't move it far. The delay is 
+    taken relative to the median delay and limited to DELAY_RANGE, so a reference with a very short delay can't 
+    outweigh all the others. A reference further from the consensus than outlier_limit, or three times the weighted 
+    median deviation if that is larger, is an outlier.
+    With only two references the consensus is simply the offset of the one with the higher weight, normally the 
+    lower delay, and the other one is an outlier if they are further apart than outlier_limit.
+    
+    readings: dict of peer dicts with offset and delay by reference, only the references ntpd has reached.
+    outlier_limit: ms, default is reference_outlier_limit in config.
+    returns: (consensus offset in ms, list of the references agreeing with it), (None, []) without readings.
+    """
+    if not readings:
+        return None, []
+    if outlier_limit is None:
+        outlier_limit = config['reference_outlier_limit']
+    delays = dict((ref, max(peer.get('delay') or 0.0, 0.1)) for ref, peer in readings.iteritems())
+    median_delay = sorted(delays.values())[len(delays) / 2]
+    weights = dict((ref, reference_health.get(ref, 1.0) / 
+                         min(max(delays[ref] / median_delay, 1 / DELAY_RANGE), DELAY_RANGE)) for ref in readings)
+    consensus = weighted_median([(peer['offset'], weights[ref]) for ref, peer in readings.iteritems()])
+    deviation = weighted_median([(abs(peer['offset'] - consensus), weights[ref]) for ref, peer in readings.iteritems()])
+    limit = max(outlier_limit, 3 * deviation)
+    return consensus, [ref for ref, peer in readings.iteritems() if abs(peer['offset'] - consensus) <= limit]
+
+class OffsetSampler():
+    """OffsetSampler hands out offsets to the reference servers, one new measurement per call.
+    All references are read from the same peer snapshot in every pass. In "fixed" mode a pass is made every 20 
+    seconds. In "event" mode it reads when and poll for the servers and sleeps until just after ntpd is expected to 
+    have made its next measurement of one of them. A sample is only accepted if ntpd updated the server after the 
+    previous sample of it, so no measurement is used twice. With several references the new samples of a pass are 
+    handed out one by one, and samples of references disagreeing with the others (see combine_references) or with a 
+    poor health score are dropped.
+    With a refclock the offsets are differential: the offset of the reference minus the offset of the refclock, both
+    from the same snapshot. That is the error of that Crtc, whichever refclock ntpd disciplines the system clock to.
+    Every sample is appended to the time series on temporary storage, and the latest samples are checkpointed in 
+    the state store so a restarted daemon can resume them.
+    """
+    
+    def __init__(self, ref_server=None, mode=None, since=None, keep=None, refclock=None):
+        """ref_server: server or list of servers to sample, default is hipat_references in config, or the 
+                       hipat_reference if the list is empty.
+        mode: "event" or "fixed", default is sample_mode in config.
+        since: in "event" mode measurements ntpd made before this time are not used, e.g. the time of the last
+               adjustment of the Crtc.
+        keep: number of the latest samples checkpointed, default is offset_window in config.
+        refclock: address of a Crtc in ntpd to measure the offsets of, None for the offsets of the system clock.
+        """
+        if ref_server is None:
+            ref_server = config['hipat_references'] or [config["hipat_reference"]]
+        self.ref_servers = [ref_server] if isinstance(ref_server, basestring) else list(ref_server)
+        self.ref_server = self.ref_servers[0]
+        self.mode = mode or config['sample_mode']
+        self.since = since
+        self.refclock = refclock
+        self.checkpoint_key = device_key('sample_checkpoint', refclock)
+        self.last_update = dict((ref, since) for ref in self.ref_servers)   # Time ntpd last updated each server
+                                                                            # when the previous sample was taken
+        self.pending = collections.deque()  # New samples of the latest pass not handed out yet
+        self.passes = 0             # Number of times the servers have been read
+        self.samples = 0            # Number of samples handed out
+        self.stale = 0              # Number of times a sample was read before ntpd had updated it
+        self.resumed = 0            # Number of samples resumed from the checkpoint
+        self.rejected = 0           # Number of samples dropped as outliers or from unhealthy references
+        self.consensus = None       # Combined offset of the references in the latest pass
+        self.agreeing = []          # References agreeing with the consensus in the latest pass
+        self.last = None            # Peer variables of the latest sample: offset, jitter, delay, time measured and ref_server
+        self.kept = collections.deque(maxlen=keep or config['offset_window'])  # The latest samples as (time, offset, jitter, delay, ref_server)
+    
+    def resume(self, max_age=None):
+        """Resumes the samples checkpointed by an earlier sampler. Samples are only resumed if they are younger than
+        max_age, measured after since, and the system clock hasn't been stepped (or the host rebooted) since they
+        were checkpointed.
+        
+        max_age: maximum age in seconds of a resumed sample, 0 resumes nothing. Default is checkpoint_max_age in config.
+        returns: list of the resumed samples as dicts with time, offset, jitter, delay and ref_server, the oldest first.
+        """
+        if max_age is None:
+            max_age = config['checkpoint_max_age']
+        checkpoint = get_store().get(self.checkpoint_key)
+        if (not checkpoint or not max_age or list(checkpoint['ref_server']) != self.ref_servers or 
+                checkpoint.get('refclock') != self.refclock):
+            return []
+        now, monotonic = clock.time(), clock.monotonic()
+        if monotonic < checkpoint['monotonic']:     # The host has rebooted
+            return []
+        if abs((now - checkpoint['time']) - (monotonic - checkpoint['monotonic'])) > 1:     # The clock was stepped
+            logfile.debug("Clock stepped since the samples were checkpointed, they are not resumed")
+            return []
+        resumed = [dict(zip(('time', 'offset', 'jitter', 'delay', 'ref_server'), sample)) for sample in checkpoint['samples']
+                   if now - max_age <= sample[0] <= now and (self.since is None or sample[0] > self.since + 1)]
+        for sample in resumed:
+            self.kept.append((sample['time'], sample['offset'], sample['jitter'], sample['delay'], sample['ref_server']))
+            self.last_update[sample['ref_server']] = max(self.last_update[sample['ref_server']], sample['time'])
+        if resumed:
+            self.last = resumed[-1]
+            self.resumed = len(resumed)
+            logfile.info("Resumed {0} samples from the checkpoint".format(len(resumed)))
+        return resumed
+    
+    def finish(self):
+        """Drops the checkpoint, called when the samples have been used for a decision."""
+        self.kept.clear()
+        get_store()[self.checkpoint_key] = None
+    
+    def _accept(self, peer):
+        """Keeps a new sample, appends it to the time series and checkpoints the latest samples.
+        
+        returns: the offset of the sample.
+        """
+        self.last = peer
+        self.samples += 1
+        get_series().append(peer['time'], peer['offset'], peer.get('jitter'), peer.get('delay'), peer['ref_server'])
+        self.kept.append((peer['time'], peer['offset'], peer.get('jitter'), peer.get('delay'), peer['ref_server']))
+        get_store()[self.checkpoint_key] = {'ref_server': self.ref_servers, 'refclock': self.refclock, 'time': clock.time(),
+                                            'monotonic': clock.monotonic(), 'samples': list(self.kept)}
+        return peer['offset']
+    
+    def _read(self):
+        """Reads all references from the peer snapshot, updates their health scores and queues the new samples 
+        of the references that agree.
+        
+        returns: dict of the peer variables by reference, "restarted" if ntpd had to be restarted.
+        """
+        self.passes += 1
+        readings = {}
+        if ntpd_running():
+            return "restarted"
+        snapshot = peers.snapshot()     # The refclock and every reference are read from the same snapshot
+        if self.refclock:
+            refclock = self._read_refclock(snapshot)
+            if refclock is None:
+                return {}
+        for ref in self.ref_servers:
+            if ref not in snapshot[1]:   # ntpd doesn't have the server as a peer
+                continue
+            peer = get_offset(ref_server = ref, snapshot = snapshot, when = True, poll = True, jitter = True, 
+                              delay = True, reach = True)
+            peer['ref_server'] = ref
+            if self.refclock:
+                peer['offset'] -= refclock
+            peer['time'] = clock.time() if self.mode != 'event' else clock.time() - peer['when']   # when has a resolution of 1 second
+            readings[ref] = peer
+        
+        #A reference is reached if ntpd has received it within two poll intervals
+        reached = dict((ref, peer) for ref, peer in readings.iteritems() 
+                       if peer.get('reach') and peer['when'] <= 2 * peer['poll'])
+        self.consensus, agreeing = combine_references(reached)
+        self.agreeing = agreeing
+        
+        for ref, peer in readings.iteritems():
+            #when is in whole seconds and aged from the snapshot, so one update can appear up to 2 seconds apart
+            if self.mode == 'event' and self.last_update[ref] is not None and peer['time'] <= self.last_update[ref] + 2:
+                continue    # Not updated since the previous sample
+            self.last_update[ref] = peer['time']
+            #The health score is only updated by a new poll, not by every pass reading the same measurement
+            health = reference_health.get(ref, 1.0)
+            reference_health[ref] = health + HEALTH_WEIGHT * ((ref in agreeing) - health)
+            if ref in agreeing and reference_health[ref] >= HEALTH_LIMIT:
+                self.pending.append(peer)
+            else:
+                self.rejected += 1
+                metrics.count('reference_samples_rejected_total')
+        self.pending = collections.deque(sorted(self.pending, key=lambda peer: peer['time']))
+        if len(self.ref_servers) > 1 and logfile.isEnabledFor(logging.DEBUG):
+            logfile.debug("Consensus offset: %s agreeing: %s health: %s", self.consensus, agreeing, 
+                          dict((ref, round(reference_health.get(ref, 1.0), 2)) for ref in self.ref_servers))
+        return readings
+    
+    def _read_refclock(self, snapshot):
+        """snapshot: (time, dict of Peer by ref_server) the references are read from.
+        returns: offset in ms of the refclock, None if ntpd doesn't receive it."""
+        if self.refclock not in snapshot[1]:
+            logfile.debug("Refclock %s not a peer of ntpd", self.refclock)
+            return None
+        refclock = get_offset(ref_server = self.refclock, snapshot = snapshot, reach = True)
+        if not refclock.get('reach'):
+            logfile.debug("Refclock %s not reached", self.refclock)
+            return None
+        return refclock['offset']
+    
+    def _wait(self, readings):
+        """Sleeps until 1 second after ntpd is expected to poll one of the servers again. If all updates are 
+        overdue the servers are checked every quarter of the shortest poll interval.
+        
+        returns: None
+        """
+        waits = [peer['poll'] - peer['when'] + 1 if peer['poll'] > peer['when'] else max(peer['poll'] / 4.0, 1)
+                 for ref, peer in readings.iteritems() if ref in self.agreeing and reference_health.get(ref, 1.0) >= HEALTH_LIMIT]
+        waits = waits or [max(peer['poll'] / 4.0, 1) for peer in readings.itervalues()] or [16]
+        clock.sleep(min(waits))
+        return
+    
+    def next(self):
+        """Waits for and returns the next offset.
+        
+        returns: offset in ms as float, "restarted" if ntpd had to be restarted.
+        """
+        while not self.pending:
+            if self.mode != 'event':
+                if self.passes:
+                    clock.sleep(20)  #Sleep for 20 seconds. NTP update time is 16 seconds
+                if self._read() == "restarted":
+                    return "restarted"
+                continue
+            readings = self._read()
+            if readings == "restarted":
+                return readings
+            if not self.pending:
+                self.stale += 1
+                self._wait(readings)
+        return self._accept(self.pending.popleft())
+
+def get_quality_offset(abort=None, since=None, refclock=None):
     """Will get the offset multiple times until it is sure of a range in the offset. 
     Before returning an offset it will make sure the crtc has synchronized first.
+    With estimator "window" the standard deviation of a window of offsets has to improve below a limit, with
+    "kalman" a drift model is fitted and the offset is returned as soon as its confidence interval is tight enough.
     
+    abort: function called before every sample, if it returns True the samples are no longer valid (e.g. the Crtc 
+           has been adjusted) and None is returned.
+    since: measurements ntpd made before this time are not used.
+    refclock: address of the Crtc in ntpd to measure the differential offset of, None for the offset of the system 
+              clock. Either way ntpd is to be in sync with the first Crtc.
     returns: offset in float
     """
+    global last_convergence
+    start = clock.time()
+    
     #Make sure the Crtc has synchronized before continuing.
-    offset_low = float(config['sync_check_limit_offset']) * -1.0
-    offset_high = float(config['sync_check_limit_offset'])
-    jitter_low = float(config['sync_check_limit_jitter']) * -1.0
-    jitter_high = float(config['sync_check_limit_jitter'])
+    offset_low = config['sync_check_limit_offset'] * -1.0
+    offset_high = config['sync_check_limit_offset']
+    jitter_low = config['sync_check_limit_jitter'] * -1.0
+    jitter_high = config['sync_check_limit_jitter']
     sync_check = get_offset(ref_server = '127.127.20.0', jitter = True)
     if not ((offset_low < sync_check['offset'] < offset_high) and (jitter_low < sync_check['jitter'] < jitter_high)):  # if the offset is larger than limit we return a 0
-        logfile.debug("NTP not in sync, offset: {0} jitter: {1}".format(sync_check['offset'], sync_check['jitter']))
+        logfile.debug("NTP not in sync, offset: %s jitter: %s", sync_check['offset'], sync_check['jitter'])
         return 0
     
+    if config['estimator'] == 'kalman':
+        windows.pop(refclock, None)     # Only the window estimator has a window
+        return estimate_offset(abort, since, start, refclock)
+    
     #Local variables used in this function
-    offset_list = []            # List of the offsets, this list will always be 10 entries long.
+    window_size = config['offset_window']
+    offset_window = OffsetWindow(window_size)  # Window of the offsets, when full the oldest is replaced.
+    windows[refclock] = offset_window   # Reported by the status of hipat_control while it fills
     confident_result = False    # When the average is trusted this is used to exit while loop.
-    std_limit = float(config['std_start_limit'])             # Standard deviation limit, this will increase for every loop.
+    std_limit = config['std_start_limit']             # Standard deviation limit, this will increase for every loop.
+    sampler = OffsetSampler(since=since, refclock=refclock)   # Waits for every new offset
+    for sample in sampler.resume():    # Samples checkpointed before a restart that are still valid
+        offset_window.push(sample['offset'])
     
-    #Perform 10 get offsets to get an initial data set
-    logfile.debug("Will perform 10 get offsets")
-    for x in range(10):
-        offset = get_offset(multiple_offsets = True)
+    #Fill the window to get an initial data set
+    logfile.debug("Will perform %s get offsets", window_size)
+    while not offset_window.full():
+        if abort and abort():
+            logfile.debug("Samples no longer valid, aborting get_quality_offset")
+            return None
+        offset = sampler.next()
         if offset == "restarted":
             logfile.debug("NTPD restarted, aborting get_quality_offset")
             return 0
-        offset_list.append(offset)
-        logfile.debug(str(offset_list))
-        time.sleep(20)  #Sleep for 20 seconds. NTP update time is 16 seconds
+        offset_window.push(offset)
+        logfile.debug("%s", offset_window)
     
     #Additional offsets are attained every loop and the standard deviation is evaluated.
-    logfile.debug("Performed 10 get offsets: {0}".format(offset_list))
+    logfile.debug("Performed %s get offsets: %s", window_size, offset_window)
     while(confident_result == False):
         
-        #Calculate average and std of old dataset
-        old_average, old_std = calculate_average_std(offset_list)
+        #Average and std of old dataset
+        old_average, old_std = offset_window.average(), offset_window.std()
         
-        #Get another offset, update offset_list and calculate average and std
-        offset_list.append(get_offset())
-        offset_list = offset_list[1:]   #Remove first entry in list
-        new_average, new_std = calculate_average_std(offset_list)   #Calculate new average and standard deviation
-        logfile.debug("New offset List: {2} New avg: {0} New std: {1} Std limit: {3}".format(old_average, old_std, offset_list, std_limit))
+        #Get another offset, it replaces the oldest in the window
+        if abort and abort():
+            logfile.debug("Samples no longer valid, aborting get_quality_offset")
+            return None
+        offset = sampler.next()
+        if offset == "restarted":
+            logfile.debug("NTPD restarted, aborting get_quality_offset")
+            return 0
+        offset_window.push(offset)
+        new_average, new_std = offset_window.average(), offset_window.std()   #New average and standard deviation
+        logfile.debug("New offset List: %s New avg: %s New std: %s Std limit: %s", offset_window, old_average, old_std, std_limit)
         
         if new_std <= old_std and new_std <= std_limit:   #If the standard deviation is improving and is under the limit.
-            logfile.debug("std. dev. is improving and under the limit, new_avg: {0}, new_std: {1}".format(new_average, new_std))
+            logfile.debug("std. dev. is improving and under the limit, new_avg: %s, new_std: %s", new_average, new_std)
             confident_result = True
         elif new_std <= std_limit/3.0: #if the standard deviation is smaller than 1/3rd of the limit it is approved.
-            logfile.debug("std. dev. is smaller than 1/3 of limit, new_std: {0}".format(new_std))
+            logfile.debug("std. dev. is smaller than 1/3 of limit, new_std: %s", new_std)
             confident_result = True
-        else:   #if the new_std is larger than old_std (i.e. not improving) and is below the std_limit
-            time.sleep(20)
         std_limit += 0.05    #Increase the limit for every loop
-        
+    
+    #Report how long it took to be confident, to compare sampling modes.
+    sampler.finish()
+    last_convergence = {'seconds': clock.time() - start, 'samples': sampler.samples, 'stale': sampler.stale, 'mode': sampler.mode,
+                        'resumed': sampler.resumed, 'average': new_average, 'std': new_std}
+    convergences[refclock] = last_convergence
+    device_log(refclock).info("Confident offset after {seconds:.0f} s, {samples} samples, {stale} stale reads, {resumed} resumed ({mode} sampling)".format(**last_convergence))
+    metrics.histogram('samples_per_decision', sampler.samples, metrics.SAMPLE_BUCKETS)
+    metrics.observe('convergence_seconds', last_convergence['seconds'])
+    metrics.count('stale_reads_total', sampler.stale)
+    metrics.gauge('offset_ms', new_average)
+    metrics.gauge('offset_std_ms', new_std)
     return new_average
 
+def estimate_offset(abort=None, since=None, start=None, refclock=None):
+    """Samples the offset into a DriftEstimator until at least estimator_min_samples are taken and the confidence
+    interval of the estimate is within estimator_interval. Like the standard deviation limit, the interval limit 
+    increases for every extra sample, so a noisy period can't stall the decision forever.
+    
+    abort: function called before every sample, if it returns True None is returned.
+    since: measurements ntpd made before this time are not used.
+    start: time get_quality_offset started, used to report the convergence time.
+    refclock: address of the Crtc in ntpd to measure the differential offset of, None for the system clock.
+    returns: estimated offset in ms at the current time, 0 if ntpd restarted.
+    """
+    global last_convergence
+    if start is None:
+        start = clock.time()
+    estimator = DriftEstimator()
+    sampler = OffsetSampler(since=since, refclock=refclock)
+    for sample in sampler.resume():    # Samples checkpointed before a restart that are still valid
+        estimator.update(sample['time'], sample['offset'], sample['jitter'], sample['delay'])
+    min_samples = config['estimator_min_samples']
+    interval_limit = config['estimator_interval']
+    
+    while True:
+        if abort and abort():
+            logfile.debug("Samples no longer valid, aborting get_quality_offset")
+            return None
+        offset = sampler.next()
+        if offset == "restarted":
+            logfile.debug("NTPD restarted, aborting get_quality_offset")
+            return 0
+        peer = sampler.last
+        estimator.update(peer['time'], offset, peer.get('jitter'), peer.get('delay'))
+        now = clock.time()
+        interval = estimator.interval(now)
+        logfile.debug("Offset: %s Estimate: %.4f +- %.4f Drift: %.6f ms/s Limit: %s",
+                      offset, estimator.estimate(now), interval, estimator.drift, interval_limit)
+        if estimator.samples >= min_samples:   # Resumed samples count, but at least one new sample is taken
+            if interval <= interval_limit:
+                break
+            interval_limit += 0.05   #Increase the limit for every extra sample
+    
+    estimate = estimator.estimate(now)
+    sampler.finish()
+    last_convergence = {'seconds': now - start, 'samples': sampler.samples, 'stale': sampler.stale, 'mode': sampler.mode,
+                        'resumed': sampler.resumed, 'average': estimate, 'interval': interval, 'drift': estimator.drift}
+    convergences[refclock] = last_convergence
+    device_log(refclock).info("Confident offset after {seconds:.0f} s, {samples} samples, {stale} stale reads, {resumed} resumed ({mode} sampling)".format(**last_convergence))
+    metrics.histogram('samples_per_decision', sampler.samples, metrics.SAMPLE_BUCKETS)
+    metrics.observe('convergence_seconds', last_convergence['seconds'])
+    metrics.count('stale_reads_total', sampler.stale)
+    metrics.gauge('offset_ms', estimate)
+    metrics.gauge('offset_interval_ms', interval)
+    return estimate
+
+def cached_offset(max_age=ESTIMATE_MAX_AGE):
+    """Asks a running hipat_control for its latest estimate of the first Crtc, instead of sampling ntpd again.
+    
+    max_age: maximum age in seconds of the estimate.
+    returns: offset in ms as float, None if hipat_control isn't running, or has no estimate younger than max_age 
+             made since the Crtc was last adjusted.
+    """
+    path = control_socket.socket_path()
+    if path is None:
+        return None
+    try:
+        status = control_socket.query(path, 'status')
+    except (socket.error, ValueError, control_socket.ControlError) as e:
+        logfile.debug("No estimate from hipat_control: %s", e)
+        return None
+    estimate = status['devices'][0]['estimate']
+    if estimate is None or not estimate['current'] or estimate['age'] > max_age:
+        return None
+    return estimate['offset_us'] / 1000.0
+
 def main():
-    """Will return the offset to the reference server in ms. 
+    """Will return the offset to the reference server in ms. If hipat_control is running its latest estimate is
+    returned at once, otherwise the offset is sampled.
     
     return: offset in ms as float    
     """
-    print get_quality_offset()
+    offset = cached_offset()
+    print get_quality_offset() if offset is None else offset
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""clock.py is the source of time for HiPAT. Every module reads the time and sleeps through these functions,
+so the clock can be replaced, e.g. by AcceleratedClock when running against the simulator, or by VirtualClock when
+replaying a capture.
+
+Usage:
+    clock.install(clock.AcceleratedClock(60))   # one real second is one simulated minute
+"""
+
+import datetime
+import threading
+import time as _time
+from timeout import monotonic as _monotonic
+
+class SystemClock():
+    """SystemClock is the real time."""
+
+    def time(self):
+        return _time.time()
+
+    def monotonic(self):
+        return _monotonic()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+    def wait(self, event, seconds):
+        """Waits for a threading.Event at most seconds.
+
+        returns: True if the event is set.
+        """
+        return event.wait(seconds)
+
+class AcceleratedClock(SystemClock):
+    """AcceleratedClock runs factor times faster than the real time, starting at the current time."""
+
+    def __init__(self, factor):
+        self.factor = float(factor)
+        self.start = _time.time()
+        self.start_monotonic = _monotonic()
+
+    def time(self):
+        return self.start + (_time.time() - self.start) * self.factor
+
+    def monotonic(self):
+        return self.start_monotonic + (_monotonic() - self.start_monotonic) * self.factor
+
+    def sleep(self, seconds):
+        _time.sleep(max(seconds, 0) / self.factor)
+
+    def wait(self, event, seconds):
+        return event.wait(max(seconds, 0) / self.factor)
+
+class VirtualClock(SystemClock):
+    """VirtualClock only moves when it is slept on: sleep advances the time at once instead of waiting. It is meant
+    for a single thread driving a replay, every listener is called with the new time when the clock moves, e.g. to
+    deliver replayed serial lines that have become due.
+    """
+
+    def __init__(self, start):
+        """start: seconds since the epoch the clock starts at."""
+        self.now = float(start)
+        self.start = self.now
+        self.lock = threading.Lock()
+        self.listeners = []     # Functions called with the time whenever the clock moves
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now - self.start
+
+    def advance(self, seconds):
+        """Moves the clock seconds forward."""
+        with self.lock:
+            self.now += max(seconds, 0)
+            now = self.now
+        for listener in self.listeners:
+            listener(now)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, seconds):
+        if not event.is_set():
+            self.advance(seconds)
+        return event.is_set()
+
+current = SystemClock()     # The clock in use
+
+def install(new_clock):
+    """Replaces the clock used by every module.
+
+    returns: the clock that was in use.
+    """
+    global current
+    old_clock = current
+    current = new_clock
+    return old_clock
+
+def time():
+    """returns: seconds since the epoch as float."""
+    return current.time()
+
+def monotonic():
+    """returns: seconds from an arbitrary point, never stepped."""
+    return current.monotonic()
+
+def sleep(seconds):
+    current.sleep(seconds)
+
+def wait(event, seconds):
+    """Waits for a threading.Event at most seconds.
+
+    returns: True if the event is set.
+    """
+    return current.wait(event, seconds)
+
+def now():
+    """returns: local time as a datetime."""
+    return datetime.datetime.fromtimestamp(current.time())
+
+def utcnow():
+    """returns: UTC time as a datetime."""
+    return datetime.datetime.utcfromtimestamp(current.time())
@@ -2,21 +2,27 @@
 
 import os
 import re
+import threading
 
-"""Config will scan config.txt and use config values in a dict."""
+"""Config will scan config.txt and use config values in a dict. Every value is converted to its type and validated 
+against SCHEMA, so callers get e.g. a float or a bool instead of the string in config.txt. 
+Config.reload reads config.txt again when it has been changed, the control loop calls it regularly.
+"""
 
-def scan_config(defaults):
+def scan_config(defaults, config_file=None):
     """Will scan config.txt and extract the config items.
     The items will be added to a dictionary.
     
     defaults: dictionary containig the default configuration.   
+    config_file: file to scan, default is config.txt next to this file.
     return: dictionary containing the config items.
     """
-    directory = os.path.dirname(os.path.realpath(__file__))     #Will return the directory regardless of where the script is run from
-    config_file = os.path.join(directory, 'config.txt')         #Appends config.txt to the directory
+    if config_file is None:
+        directory = os.path.dirname(os.path.realpath(__file__))     #Will return the directory regardless of where the script is run from
+        config_file = os.path.join(directory, 'config.txt')         #Appends config.txt to the directory
     file = open(config_file, 'r')
     for line in file:
-        match = re.search('(\w+):\s"(.+)"', line)
+        match = re.search('^(\w+):\s*"?([^"]*?)"?\s*$', line)     #Values can be quoted, e.g. freq_adj: False
         if match:
             config_item = match.group(1)
             config_value = match.group(2)
@@ -26,20 +32,72 @@ def scan_config(defaults):
                 print('Error in config.txt please review: {0}'.format(config_item))
     file.close()
     return defaults
-    
+
+def boolean(value):
+    """returns: value as a bool, "True" and "False" are accepted."""
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('true', 'yes', '1'):
+        return True
+    if str(value).lower() in ('false', 'no', '0'):
+        return False
+    raise ValueError('{0} is not True or False'.format(value))
+
+def positive(kind):
+    """returns: function converting a value to kind, only accepting values larger than 0."""
+    def convert(value):
+        value = kind(value)
+        if value <= 0:
+            raise ValueError('{0} is not larger than 0'.format(value))
+        return value
+    return convert
+
+def not_negative(kind):
+    """returns: function converting a value to kind, only accepting values of 0 or more."""
+    def convert(value):
+        value = kind(value)
+        if value < 0:
+            raise ValueError('{0} is negative'.format(value))
+        return value
+    return convert
+
+def choice(*options):
+    """returns: function only accepting one of options."""
+    def convert(value):
+        if value not in options:
+            raise ValueError('{0} is not one of {1}'.format(value, ', '.join(options)))
+        return value
+    return convert
+
+def address_list(value):
+    """returns: list of the addresses in a comma separated value, an empty list if it is empty."""
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [address.strip() for address in value.split(',') if address.strip()]
+
 def create_dictionary():
     defaults = {
         # Address for the serial port
         'serial_address': "/dev/ttyU0",
         
+        # Serial ports of several Crtcs controlled together, comma separated. The Nth port is the Crtc ntpd reads as
+        # refclock 127.127.20.N. Empty to only use serial_address
+        'crtc_devices': "",
+        
         # Program path for the program
         'program_path': os.path.dirname(os.path.realpath(__file__)),
         
         # Reference NTP server
         'hipat_reference': "158.112.160.8",
         
+        # Reference NTP servers sampled together and combined, comma separated. Empty to only use hipat_reference
+        'hipat_references': "",
+        
+        # Offset in ms from the consensus of the references beyond which a reference is an outlier
+        'reference_outlier_limit': "1.0",
+        
         # Frequency adjust
-        'freq_adj': False,
+        'freq_adj': "False",
         
         # Temporary storage
         'temporary_storage': "/mnt/tmpfs",
@@ -51,11 +109,208 @@ def create_dictionary():
         'sync_check_limit_jitter': "0.4",
         
         # Standard deviation limit used for quality offset
-        'std_start_limit': "1.0"
+        'std_start_limit': "1.0",
+        
+        # How peer variables are read from ntpd, "control" uses the NTP control protocol, "ntpq" runs ntpq -pn
+        'ntp_backend': "control",
+        
+        # UDP port ntpd answers control requests on
+        'ntp_control_port': "123",
+        
+        # Command used by the ntpq backend
+        'ntpq_command': "ntpq",
+        
+        # Keep the serial port open and read it from a background thread
+        'serial_reader': "True",
+        
+        # Number of received serial lines kept in memory
+        'serial_ring_size': "256",
+        
+        # Seconds to wait before writing each character to the Crtc
+        'serial_char_delay': "0.3",
+        
+        # Number of batched commands allowed to wait for an answer at the same time
+        'command_window': "4",
+        
+        # Measure the character delay and round trip time of a Crtc at startup, if they aren't stored from an earlier run
+        'serial_calibrate': "True",
+        
+        # How get_quality_offset waits for samples, "event" waits for ntpd to update the reference, "fixed" sleeps 20 seconds
+        'sample_mode': "event",
+        
+        # Number of offsets get_quality_offset evaluates at the same time
+        'offset_window': "10",
+        
+        # Maximum number of seconds a snapshot of the ntpd peers is reused
+        'peer_cache_ttl': "8",
+        
+        # Seconds changes to the state are collected before they are written to temporary storage
+        'state_flush_delay': "5",
+        
+        # Maximum size in bytes of errors.log and running_output.txt
+        'log_max_bytes': "1048576",
+        
+        # Maximum number of lines kept in errors.log and running_output.txt
+        'log_max_lines': "200",
+        
+        # Number of rotated errors.log files kept
+        'log_backup_count': "1",
+        
+        # Seconds between the Crtc health checks of the control loop
+        'health_interval': "5",
+        
+        # Format of the metrics written to temporary storage every cycle, "prometheus", "json" or "none"
+        'metrics_format': "prometheus",
+        
+        # How get_quality_offset decides on an offset, "window" waits for the standard deviation of the offset window
+        # to improve, "kalman" fits the offset and drift and stops when the confidence interval is tight enough
+        'estimator': "window",
+        
+        # Largest half width in ms of the 95% confidence interval accepted by the kalman estimator
+        'estimator_interval': "0.2",
+        
+        # Minimum number of samples the kalman estimator takes
+        'estimator_min_samples': "3",
+        
+        # How freq_adj calculates its steps, "fit" fits the drift to the history of adjustments, "curve" uses the
+        # time since the last frequency adjustment
+        'freq_controller': "fit",
+        
+        # Expected frequency change in ppm of one frequency step, used until the history is long enough to fit it
+        'freq_step_ppm': "0.001",
+        
+        # Number of adjustments kept in the history used by the "fit" frequency controller
+        'freq_history_size': "50",
+        
+        # Number of samples and adjustments kept in history.ring on temporary storage, 48 bytes each
+        'history_size': "16384",
+        
+        # Maximum age in seconds of checkpointed samples resumed after a restart, 0 to always start over
+        'checkpoint_max_age': "300",
+        
+        # File hipat_control records the ntpd peers, the Crtc lines and commands and its decisions to, for replay.py.
+        # Empty to not record
+        'capture_file': "",
+        
+        # Unix domain socket hipat_control answers status requests on, relative to temporary_storage. Empty to not
+        # serve it
+        'control_socket': "hipat_control.sock"
     }
     return defaults
     
+#Type of every config item, and whether a change is used without restarting HiPAT.
+#Items read when HiPAT starts (files, ports, the serial reader) need a restart.
+SCHEMA = {
+    'serial_address': (str, False),
+    'crtc_devices': (address_list, False),
+    'program_path': (str, False),
+    'hipat_reference': (str, True),
+    'hipat_references': (address_list, True),
+    'reference_outlier_limit': (positive(float), True),
+    'freq_adj': (boolean, True),
+    'temporary_storage': (str, False),
+    'sync_check_limit_offset': (positive(float), True),
+    'sync_check_limit_jitter': (positive(float), True),
+    'std_start_limit': (positive(float), True),
+    'ntp_backend': (choice('control', 'ntpq'), False),
+    'ntp_control_port': (positive(int), False),
+    'ntpq_command': (str, False),
+    'serial_reader': (boolean, False),
+    'serial_ring_size': (positive(int), False),
+    'serial_char_delay': (not_negative(float), False),
+    'command_window': (positive(int), True),
+    'serial_calibrate': (boolean, True),
+    'sample_mode': (choice('event', 'fixed'), True),
+    'offset_window': (positive(int), True),
+    'peer_cache_ttl': (not_negative(float), True),
+    'state_flush_delay': (not_negative(float), False),
+    'log_max_bytes': (positive(int), False),
+    'log_max_lines': (positive(int), True),
+    'log_backup_count': (not_negative(int), False),
+    'health_interval': (positive(float), False),
+    'metrics_format': (choice('prometheus', 'json', 'none'), True),
+    'estimator': (choice('window', 'kalman'), True),
+    'estimator_interval': (positive(float), True),
+    'estimator_min_samples': (positive(int), True),
+    'freq_controller': (choice('fit', 'curve'), True),
+    'freq_step_ppm': (positive(float), True),
+    'freq_history_size': (positive(int), True),
+    'history_size': (positive(int), False),
+    'checkpoint_max_age': (not_negative(float), True),
+    'capture_file': (str, False),
+    'control_socket': (str, False),
+}
+
+class Config(dict):
+    """Config is the dictionary of typed config items. Values set are converted like the values in config.txt."""
+    
+    def __init__(self, config_file=None):
+        """config_file: file to read, default is config.txt next to this file."""
+        dict.__init__(self)
+        if config_file is None:
+            config_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.txt')
+        self.config_file = config_file
+        self.mtime = None       # Modification time of config_file when it was read
+        self.lock = threading.Lock()    # The config task and the control socket can both reload
+        for item, value in self.load().items():
+            dict.__setitem__(self, item, value)
+    
+    def convert(self, item, value):
+        """returns: value converted to the type of item, raises ValueError if it isn't valid."""
+        if item not in SCHEMA:
+            raise ValueError('unknown config item {0}'.format(item))
+        return SCHEMA[item][0](value)
+    
+    def __setitem__(self, item, value):
+        dict.__setitem__(self, item, self.convert(item, value))
+    
+    def update(self, *args, **kwargs):
+        for item, value in dict(*args, **kwargs).items():
+            self[item] = value
+    
+    def load(self):
+        """Reads config_file on top of the defaults. An invalid value is reported and the default is used instead.
+        
+        returns: dict of the converted values.
+        """
+        defaults = create_dictionary()
+        try:
+            self.mtime = os.path.getmtime(self.config_file)
+            raw = scan_config(dict(defaults), self.config_file)
+        except (IOError, OSError) as e:
+            print('Could not read {0}, using defaults: {1}'.format(self.config_file, e))
+            raw = defaults
+        values = {}
+        for item, value in raw.items():
+            try:
+                values[item] = self.convert(item, value)
+            except ValueError as e:
+                print('Error in config.txt please review: {0}: {1}'.format(item, e))
+                values[item] = self.convert(item, defaults[item])
+        return values
+    
+    def reload(self):
+        """Reads config_file again if it has been modified since it was read. Items that can change while HiPAT 
+        runs are updated, the others keep their value until HiPAT is restarted.
+        
+        returns: (dict of the items updated with their new value, list of the changed items that need a restart)
+        """
+        with self.lock:
+            try:
+                if os.path.getmtime(self.config_file) == self.mtime:
+                    return {}, []
+            except OSError:
+                return {}, []
+            updated, restart = {}, []
+            for item, value in self.load().items():
+                if value == self.get(item):
+                    continue
+                if SCHEMA[item][1]:
+                    dict.__setitem__(self, item, value)
+                    updated[item] = value
+                else:
+                    restart.append(item)
+            return updated, restart
+
 #This code is placed outside a function to run when importing.
-defaults = create_dictionary()
-config = scan_config(defaults)
-    
\ No newline at end of file
+config = Config()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""control_socket.py serves the status of hipat_control on a Unix domain socket, so monitoring can ask for the
+latest offset as often as it likes without sampling ntpd itself.
+Every request is one line with a command and its arguments separated by spaces, every answer one line of JSON:
+{"ok": true, "result": ...} or {"ok": false, "error": "..."}. A connection can send any number of requests.
+
+The commands are given by hipat_control:
+- status: the latest estimate, health, adjustments and frequency adjustment of every Crtc.
+- resample [refclock]: drops the samples of the running estimate, so a new one is started.
+- reload: reads config.txt again if it has been changed.
+
+Usage:
+    echo status | nc -U /mnt/tmpfs/hipat_control.sock
+    print control_socket.query(control_socket.socket_path(), 'status')
+"""
+
+import json
+import os
+import socket
+import SocketServer
+import threading
+from config import config
+import logger
+
+#initialize the logger
+logfile = logger.init_logger('control_socket')
+
+IDLE_TIMEOUT = 60.0     # Seconds a connection may be idle before it is closed
+
+class ControlError(Exception):
+    """Raised by query when hipat_control answers a request with an error."""
+    pass
+
+def socket_path():
+    """returns: path of the control socket, None if it is not served."""
+    if not config['control_socket']:
+        return None
+    return os.path.join(config['temporary_storage'], config['control_socket'])
+
+class Handler(SocketServer.StreamRequestHandler):
+    """Handler answers the requests of one connection."""
+    timeout = IDLE_TIMEOUT
+
+    def handle(self):
+        try:
+            for line in iter(self.rfile.readline, ''):
+                words = line.split()
+                if not words:
+                    continue
+                answer = self.server.dispatch(words[0], words[1:])
+                self.wfile.write(json.dumps(answer, default=str, sort_keys=True) + '\n')
+        except socket.error:    # The client went away or was idle too long
+            pass
+        return
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ControlServer answers requests on the socket from a background thread, every connection in its own thread."""
+    daemon_threads = True
+
+    def __init__(self, path, commands):
+        """path: file of the socket, a socket left by an earlier run is replaced.
+        commands: dict of functions by command, called with the arguments of the request as strings. They return
+                  the result, which has to be serializable as JSON.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, Handler, bind_and_activate=False)
+        try:
+            self.server_bind()
+            #Only the user and group of HiPAT can connect. Nobody can connect before listen, so the permissions
+            #are set in between.
+            os.chmod(path, 0o660)
+            self.server_activate()
+        except:
+            self.server_close()
+            raise
+        self.path = path
+        self.commands = commands
+        self.requests = 0
+        self.thread = None
+
+    def dispatch(self, command, arguments):
+        """Runs one request.
+
+        returns: dict with the answer.
+        """
+        self.requests += 1
+        function = self.commands.get(command)
+        if function is None:
+            return {'ok': False, 'error': 'unknown command {0}, use one of: {1}'.format(
+                command, ', '.join(sorted(self.commands)))}
+        try:
+            return {'ok': True, 'result': function(*arguments)}
+        except (TypeError, ValueError) as e:    # Wrong arguments
+            return {'ok': False, 'error': '{0}: {1}'.format(command, e)}
+        except Exception as e:
+            logfile.exception("Control command {0} failed".format(command))
+            return {'ok': False, 'error': '{0} failed: {1}'.format(command, e)}
+
+    def start(self):
+        """Starts serving from a background thread.
+
+        returns: None
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name='control socket')
+        self.thread.daemon = True
+        self.thread.start()
+        return
+
+    def stop(self):
+        """Stops serving and removes the socket."""
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def query(path, command, timeout=2.0):
+    """Sends one request to a running hipat_control.
+
+    path: file of the socket, see socket_path.
+    command: command and its arguments, e.g. "status".
+    timeout: seconds to wait for the answer.
+    returns: the result, raises socket.error if hipat_control isn't serving, ControlError if the request failed.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall(command.strip() + '\n')
+        answer = client.makefile('r').readline()
+    finally:
+        client.close()
+    if not answer:
+        raise socket.error('{0} closed the connection'.format(path))
+    answer = json.loads(answer)
+    if not answer['ok']:
+        raise ControlError(answer['error'])
+    return answer['result']
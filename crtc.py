@@ -5,41 +5,99 @@ It will send and receive information.
 """
 
 from serial import Serial
-from timeout import timeout #import the timeout decorator
+from timeout import TimeoutError
 from config import config   #configuration dictionary
+from serial_reader import SerialReader
+from state_store import get_store
+from freq_control import FrequencyController
+import crtc_health
+from crtc_health import CrtcHealth, HEALTHY, NO_DATA
 import logger
+import metrics
+import capture
 import re
 import datetime
-import time
-import shelve
+import clock
 import math
 import sys
-import os
 import check_offset
 import subprocess
+import itertools
+import collections
+import threading
 
 #initialize the logger
 logfile = logger.init_logger('crtc')
 
-ser_buffer = ''     #Global receive buffer
-
 class Crtc():
     """Crtc is the class handling all the communication over the serial interface.
     """
     
-    def __init__(self, address=config['serial_address']):
-        """Initiating the serial port
+    def __init__(self, address=None, reader=None, refclock=crtc_health.REFCLOCK, ser=None):
+        """Initiating the serial port. In reader mode the port is kept open and a background thread 
+        collects every line the Crtc sends, otherwise the port is only opened while it is used.
+        
+        address: address of the serial port, default is serial_address in config.
+        reader: True to keep the port open and read it from a background thread, default is serial_reader in config.
+                Instead of True an object with the methods of SerialReader can supply the lines, e.g. a replay.
+        refclock: address of the Crtc in ntpd, 127.127.20.N for the Nth Crtc.
+        ser: object used as the serial port instead of opening address, e.g. a replay.
         """
-        self.ser = Serial(address, 4800, timeout=3)
-        self.ser.close()
+        if address is None:
+            address = config['serial_address']
+        if reader is None:
+            reader = config['serial_reader']
+        self.refclock = refclock
+        #The first Crtc keeps the log messages and state store keys of a single Crtc
+        self.log = logfile if refclock == crtc_health.REFCLOCK else logger.DeviceLogger(logfile, 'Crtc ' + refclock)
+        self.ser = ser or Serial(address, 4800, timeout=3)
+        self.char_delay = config['serial_char_delay']    # Seconds to wait before writing each character
+        self.round_trip = 0.0   # Seconds from the last character is written until the answer is received
+        self.load_calibration()
+        self.reader = None
+        self.cursor = 0     # Sequence number of the last line consumed from the reader
+        self.ser_buffer = ''    # Receive buffer, holds the incomplete line after a receive
+        self.lock = threading.RLock()   # Only one thread writes a command and waits for its answer at a time
+        self.health = None  # Watches the lines from the Crtc in reader mode
+        if reader:
+            self.reader = SerialReader(self.ser, config['serial_ring_size']) if reader is True else reader
+            self.health = CrtcHealth(refclock, check_offset.peers)
+            self.reader.listeners.append(self.health.observe)
+            self.reader.start()
+        else:
+            self.ser.close()
         
     def __str__(self):
-        """print serial buffer."""
+        """print serial buffer. In reader mode the next unread line is returned without blocking, if all lines are 
+        read the latest line is returned as long as it was received within the serial timeout."""
+        if self.reader:
+            entry = self.reader.get_line(self.cursor)
+            if entry:
+                self.cursor = entry[0]
+                return entry[2]
+            entry = self.reader.latest()
+            if entry and clock.time() - entry[1] < self.ser.timeout:
+                return entry[2]
+            return ''
         self.ser.open()
         output =  self.ser.readline()
         self.ser.close()
         return output
     
+    def key(self, name):
+        """returns: key in the state store of the state name of this Crtc."""
+        return crtc_health.device_key(name, self.refclock)
+    
+    def open(self):
+        """Opens the serial port, in reader mode it is always open."""
+        if not self.reader:
+            self.ser.open()
+    
+    def close(self):
+        """Closes the serial port, in reader mode it is kept open."""
+        if not self.reader:
+            self.ser.close()
+    
     def check_crtc(self):
         """Links together the methods for fixing the crtc. If no updates are received it attempts to fix the problem
         a maximum number of 5 times.
@@ -47,20 +105,28 @@ class Crtc():
         returns: returns when the problem is fixed, or it will exit the program.
         """
         number_of_fix_attempts = 0
-        logfile.debug("Checking crtc functionality")
+        self.log.debug("Checking crtc functionality")
         while not self.is_crtc_updating():   # While is_crtc_updating returns false
-            logfile.info("Crtc not answering, attempting to fix.")
+            self.log.info("Crtc not answering, attempting to fix.")
             if number_of_fix_attempts > 5:
-                logfile.warn("Attempted to fix Crtc 5 times, to no use, now exiting.")
+                self.log.warn("Attempted to fix Crtc 5 times, to no use, now exiting.")
                 sys.exit()
-            self.fix_crtc()
+            with self.lock:     # No other commands are sent to the Crtc while it is being fixed
+                metrics.count('fix_crtc_total')
+                with metrics.timer('fix_crtc_seconds'):
+                    self.fix_crtc()
             number_of_fix_attempts += 1
+            if self.health:     # Give the Crtc and ntpd time to recover, at most two ntpd polls
+                self.health.wait(34)
         if number_of_fix_attempts > 0:
-            logfile.info("Crtc is now fixed")
+            self.log.info("Crtc is now fixed")
         return
     
     def is_crtc_updating(self):
-        """To make sure the crtc is updating the ntpd process we check the output from ntpd.
+        """In reader mode the health monitor tells at once if the Crtc is sending valid status lines and ntpd receives
+        them, without waiting.
+        
+        Otherwise, to make sure the crtc is updating the ntpd process we check the output from ntpd.
         When working correctly ntpd updates the time from the Crtc every 16 seconds. 
         We therefore collect two updates from the Crtc, 20 seconds appart. If working correctly 
         the total of our two time stamps shouldn't exceed 17+17 (1 second added). If no updates
@@ -68,24 +134,32 @@ class Crtc():
     
         returns: Returns a boolean regarding the status of the Crtc.
         """
+        if self.health:
+            state = self.health.state()
+            if state == NO_DATA:    # The reader has just started, wait for the first status line
+                state = self.health.wait(self.ser.timeout)
+            if state != HEALTHY:
+                self.log.warn("Crtc not healthy: {0}".format(state))
+            return state == HEALTHY
+        
         when = []   # Will hold our two answers showing when ntpd was updated
     
         # We loop twice, to capture two when-timestamps.
         for x in range(2):
             # Get output from the crtc using the check_offset method
-            when_temporary = check_offset.get_offset(ref_server = "127.127.20.0", offset = False, when = True)
+            when_temporary = check_offset.get_offset(ref_server = self.refclock, offset = False, when = True)
             when.append(when_temporary) # When was the last update from the crtc received. If never received it is "-"
             if x == 0:
-                time.sleep(20)  # We sleep for 20 seconds to make sure we go past 16 seconds.
+                clock.sleep(20)  # We sleep for 20 seconds to make sure we go past 16 seconds.
     
         # To make sure the crtc is updating we perform a check for the total.
         if sum(when) >= 34:     # The maximum number a single valid when-reading can have is 17.
             # Not valid
-            logfile.warn("Time updates from Crtc not received in a long time.")
+            self.log.warn("Time updates from Crtc not received in a long time.")
             return False
         elif sum(when) == 0:    # No updates are ever received from the Crtc.
             # Not valid
-            logfile.warn("Time updates from Crtc never received.")
+            self.log.warn("Time updates from Crtc never received.")
             return False
         else:
             # Valid
@@ -100,27 +174,30 @@ class Crtc():
         3. If we receive valid updates and we are still not seeing a valid time update in ntp, the date and time may
            be invalid (e.g. date = 1111111111), an ntpdate to the ref server and a date_time are both done.
         The program returns after fixing number 2, or after performing number 3. 
+        In reader mode the stage is chosen from the health monitor.
        
         return: None
         """
+        if self.health:
+            return self._fix_from_health()
     
         # Start by checking if the Crtc is actually sending updates over serial.
         if not str(self):    # not sending
-            logfile.warn("Not receiving updates from CRTC. Attempting to send 1's to fix.")
+            self.log.warn("Not receiving updates from CRTC. Attempting to send 1's to fix.")
             # Attempt to send "1" date: 8 digits, time: 9 digits, so we send 10 times
             for attempt in range(10):
                 self.send("1", None)
-                time.sleep(0.05)
+                clock.sleep(0.05)
                 if str(self):    # Problem is fixed and we exit the for loop.
                     break
                 elif str(self) == '' and attempt == 9:   # if still not fixed, we report error and exit program
-                    logfile.warn("Still not receiving from CRTC. Will now exit the program.")
+                    self.log.warn("Still not receiving from CRTC. Will now exit the program.")
                     sys.exit()
     
         # If the problem is not with the Crtc sending updates we check if they are valid
         # This is indicated by the A|V character in the string. If it is sending "A" everything is OK. 
     
-        logfile.info("Receiving updates from crtc, will check if they are valid (A) updates.")
+        self.log.info("Receiving updates from crtc, will check if they are valid (A) updates.")
         regex = "054,(A|V),0000"
         answer = "V"
         while(answer == "V"):
@@ -135,25 +212,63 @@ class Crtc():
                     answer = "V"
                     continue
             if answer == "V":
-                logfile.info("Crtc output invalid, sending date and time.")
+                self.log.info("Crtc output invalid, sending date and time.")
                 self.date_time(0)
-                logfile.info("Date and time set on Crtc, ")
-                time.sleep(60)  
+                self.log.info("Date and time set on Crtc, ")
+                clock.sleep(60)  
                 return
     
         # If the Crtc is sending valid updates the final problem could be that the date and time of the
         # updates is very wrong. A last resort is then to update the time with ntpdate and run a
         # date_time(0) to update the time.
     
-        logfile.warn("Receiving valid updates from Crtc, but still not working, sending new time update to Crtc")
+        self.log.warn("Receiving valid updates from Crtc, but still not working, sending new time update to Crtc")
         ref_server = config["hipat_reference"]
         subprocess.call(["/etc/rc.d/ntpd", "stop"])
         subprocess.call(["ntpdate", ref_server])
         subprocess.call(["/etc/rc.d/ntpd", "restart"])
-        time.sleep(20)
+        clock.sleep(20)
         self.date_time(0)
         return
         
+    def _fix_from_health(self):
+        """The stages of fix_crtc, chosen from the health state instead of reading lines from the Crtc.
+        
+        return: None
+        """
+        state = self.health.state()
+        if state in (crtc_health.STALLED, NO_DATA):
+            self.log.warn("Not receiving updates from CRTC. Attempting to send 1's to fix.")
+            self.send_many('1' * 10, None)  # date: 8 digits, time: 9 digits, so we send 10 times
+            if self.health.wait(3 * self.health.interval, until=(HEALTHY, crtc_health.INVALID, crtc_health.NO_REFCLOCK), 
+                                step=0.1) in (crtc_health.STALLED, NO_DATA):
+                self.log.warn("Still not receiving from CRTC. Will now exit the program.")
+                sys.exit()
+            return
+        if state == crtc_health.INVALID:
+            self.log.info("Crtc output invalid, sending date and time.")
+            self.date_time(0)
+            self.log.info("Date and time set on Crtc, ")
+            self.health.wait(60, until=(HEALTHY, crtc_health.NO_REFCLOCK))
+            return
+        if state == crtc_health.NO_REFCLOCK:
+            self.log.warn("Receiving valid updates from Crtc, but ntpd doesn't receive them, sending new time update to Crtc")
+            ref_server = config["hipat_reference"]
+            subprocess.call(["/etc/rc.d/ntpd", "stop"])
+            subprocess.call(["ntpdate", ref_server])
+            subprocess.call(["/etc/rc.d/ntpd", "restart"])
+            clock.sleep(20)
+            self.date_time(0)
+        return
+    
+    def write(self, text):
+        """Writes text to the serial port, it is recorded if a capture is running.
+        
+        returns: None
+        """
+        capture.record('command', (self.refclock, text))
+        self.ser.write(text)
+    
     def send(self, text, response='PSRFTXT,(ACK)'):
         """Function used to write text to the serial port. A response from the CRTC is always expected, and if none is specified it will return 1.
         
@@ -161,48 +276,265 @@ class Crtc():
         response: expected response.
         returns: answer string if OK, 1 if no response was received.
         """
+        with self.lock:
+            return self._send(text, response)
+    
+    def _send(self, text, response):
         #first the text is written, one letter at the time
-        self.ser.open()
+        self.open()
+        if self.reader:     #Lines received before the text was sent can't be the response
+            self.cursor = self.reader.sequence
         for letter in text:
-            time.sleep(0.3)     #0.3 seconds sleep turns out to be the best
-            self.ser.write(letter)
+            clock.sleep(self.char_delay)     #0.3 seconds sleep turns out to be the best
+            self.write(letter)
+        metrics.count('serial_commands_total')
           
         #If response is specified to be None, we skip the receive check
         if response == None:
-            self.ser.close()
+            self.close()
             return 1
         #then we wait for the response
         try:
+            sent = clock.time()
             answer = self.receive(response)    
+            metrics.observe('serial_round_trip_seconds', clock.time() - sent)
             return answer
         except:
-            self.ser.write('1111111111')    #the CRTC can hang while expecting more input
-            logfile.warn('Send to Crtc, no response. Retrying.')
-            self.ser.close()
+            metrics.count('serial_ack_timeouts_total')
+            self.write('1111111111')    #the CRTC can hang while expecting more input
+            self.log.warn('Send to Crtc, no response. Retrying.')
+            self.close()
             return 1
             
-    @timeout(3) #this function will timeout after 3 seconds
-    def receive(self, regex):
+    def send_many(self, commands, response='PSRFTXT,(ACK)', window=None, retries=3):
+        """Sends a batch of single character commands without waiting for each answer. Up to window commands 
+        are unanswered at the same time, answers are matched to commands in the order they arrive. 
+        A command whose answer is not received within 3 seconds is sent again once a later status line shows the 
+        answer isn't coming, a late answer is still counted. If more than retries answers in a row are lost, or the 
+        Crtc stops sending lines, it is assumed to hang and the rest of the batch is dropped.
+        
+        commands: string of single character commands, e.g. 'ooozz'.
+        response: expected response to every command, None if the Crtc doesn't answer.
+        window: number of unanswered commands allowed, default is command_window in config.
+        retries: number of lost answers in a row before giving up.
+        returns: dict with the number of answered commands for every character.
+        """
+        with self.lock:
+            return self._send_many(commands, response, window, retries)
+    
+    def _send_many(self, commands, response, window, retries):
+        answered = dict((letter, 0) for letter in commands)
+        if window is None:
+            window = config['command_window']
+        
+        self.open()
+        #If response is None the commands are only written
+        if response == None:
+            for letter in commands:
+                clock.sleep(self.char_delay)
+                self.write(letter)
+                answered[letter] += 1
+            metrics.count('serial_commands_total', len(commands))
+            self.close()
+            return answered
+        
+        #Answers are collected by the reader thread, one is started for the batch if the Crtc isn't in reader mode.
+        reader = self.reader or SerialReader(self.ser, config['serial_ring_size'])
+        if not self.reader:
+            reader.start()
+        cursor = reader.sequence
+        try:
+            #Identical commands can't be told apart, so a lost answer is always resent as the same character.
+            groups = [(letter, len(list(group))) for letter, group in itertools.groupby(commands)]
+            for index, (letter, queued) in enumerate(groups):
+                sent = collections.deque()  # Send times of the commands still waiting for an answer
+                lost = 0                    # Answers lost in a row
+                status = 0                  # Time of the latest line that isn't an answer
+                while queued or sent:
+                    if queued and len(sent) < window:
+                        clock.sleep(self.char_delay)
+                        self.write(letter)
+                        sent.append(clock.time())
+                        metrics.count('serial_commands_total')
+                        queued -= 1
+                        wait = 0
+                    elif clock.time() < sent[0] + 3:
+                        wait = sent[0] + 3 - clock.time()
+                    else:   # Overdue, the next status line tells if the answer is still coming
+                        wait = max(sent[0] + 6 - clock.time(), 0)
+                    entry = reader.get_line(cursor, wait)
+                    while entry:    # Every answer received so far is matched to the oldest command
+                        cursor = entry[0]
+                        if not re.search(response, entry[2]):
+                            status = entry[1]
+                        elif sent and entry[1] >= sent[0]:   # Earlier lines answer earlier commands
+                            metrics.observe('serial_round_trip_seconds', entry[1] - sent.popleft())
+                            answered[letter] += 1
+                            lost = 0
+                        entry = reader.get_line(cursor)
+                    if not sent or clock.time() < sent[0] + 3:
+                        continue
+                    #A late answer is still counted, the command is only sent again when the Crtc has sent status
+                    #lines after the deadline without answering, otherwise the Crtc could perform it twice.
+                    if status > sent[0] + 3:
+                        sent.popleft()
+                        lost += 1
+                        metrics.count('serial_ack_timeouts_total')
+                        if lost <= retries:
+                            queued += 1
+                            metrics.count('serial_retries_total')
+                            self.log.debug("No answer to '%s', sending it again", letter)
+                            continue
+                        reason = "{0} answers lost in a row".format(lost)
+                    elif clock.time() >= sent[0] + 6:
+                        metrics.count('serial_ack_timeouts_total')
+                        reason = "no lines received for 3 seconds"
+                    else:
+                        continue
+                    #The Crtc is assumed to hang, nothing more of the batch is sent
+                    metrics.count('serial_batches_dropped_total')
+                    self.write('1111111111')    #the CRTC can hang while expecting more input
+                    unsent = [(letter, queued + len(sent))] + groups[index + 1:]
+                    self.log.warn("Send to Crtc, {0}. Dropping the rest of the batch, unanswered or not sent: {1}".format(
+                        reason, ', '.join("{0} '{1}'".format(count, dropped) for dropped, count in unsent if count)))
+                    return answered
+        finally:
+            if not self.reader:
+                reader.stop()
+            else:
+                self.cursor = cursor
+            self.close()
+        return answered
+    
+    def receive(self, regex, timeout=3.0):
         """Function used to extract a received answer from the serial port. User must provide a regex if a certain type of message is to be received.
+        The serial port is read with blocking reads until the deadline, so no CPU is used while waiting. 
         If it times out a TimeoutError is raised.
         
         regex: regular expression indicating what message it expects to receive back.
+        timeout: seconds to wait for the answer, fractions of a second are allowed.
         returns: string of match
         """
-        global ser_buffer
+        deadline = clock.monotonic() + timeout
+        if self.reader:     #the reader thread collects the lines, each new line is checked.
+            while True:
+                entry = self.reader.get_line(self.cursor, timeout=max(deadline - clock.monotonic(), 0))
+                if not entry:
+                    raise TimeoutError('No answer matching {0} within {1} seconds'.format(regex, timeout))
+                self.cursor = entry[0]
+                match = re.search(regex, entry[2])
+                if match:
+                    return match.group(1)
+        
         #self.ser.open()    #it is opened by the send process.
-        while True:
-            ser_buffer = ser_buffer + self.ser.read(self.ser.inWaiting()) #fills the buffer
-            if '\n' in ser_buffer:  #if a complete line is received
-                lines = ser_buffer.split('\n')
-                if lines[-2]:   #Access the complete line
-                    match = re.search(regex, lines[-2])
-                    if match:   #if regex matches
-                        ser_buffer = lines[-1]
-                        self.ser.close()
-                        return match.group(1)   #return match and exit
-                ser_buffer = lines[-1]  #if lines[-2] doesn't exist we keep lines[-1]
+        port_timeout = self.ser.timeout
+        try:
+            while True:
+                remaining = deadline - clock.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('No answer matching {0} within {1} seconds'.format(regex, timeout))
+                #read blocks until a byte arrives or the deadline is reached. Setting the timeout reconfigures the
+                #port, so it is only shortened when the read could otherwise pass the deadline by more than 0.1 s.
+                if self.ser.timeout is None or self.ser.timeout > remaining + 0.1:
+                    self.ser.timeout = remaining
+                self.ser_buffer = self.ser_buffer + self.ser.read(self.ser.inWaiting() or 1) #fills the buffer
+                if '\n' in self.ser_buffer:    #if complete lines are received
+                    lines = self.ser_buffer.split('\n')
+                    for line in lines[:-1]:     #Check every complete line
+                        match = re.search(regex, line)
+                        if match:   #if regex matches
+                            self.ser_buffer = lines[-1]
+                            self.ser.close()
+                            return match.group(1)   #return match and exit
+                    self.ser_buffer = lines[-1]     #the incomplete line is kept
+        finally:
+            if self.ser.timeout != port_timeout:
+                self.ser.timeout = port_timeout
+        
+    def load_calibration(self):
+        """Loads the character delay and round trip time measured by calibrate, if a calibration is stored.
+        
+        returns: None
+        """
+        calibration = get_store().get(self.key('serial_calibration'))
+        if calibration:
+            self.char_delay = calibration['char_delay']
+            self.round_trip = calibration['round_trip']
+        return
+    
+    def calibrate(self, delays=(0.3, 0.2, 0.15, 0.1, 0.07, 0.05, 0.03, 0.02), attempts=3, length=10):
+        """Measures how fast the Crtc accepts characters and how long it takes to answer a command. 
+        The p command is used since it changes nothing on the Crtc and can't leave it waiting for more input. For every 
+        delay, starting with the slowest, as many p commands as a time command has characters are written that delay 
+        apart, a number of times. The shortest delay where every command is answered is used with a 50% margin. 
+        The results are stored in the state store and used by send and date_time.
         
+        delays: character delays to try, in seconds.
+        attempts: number of times the commands are written for every delay.
+        length: number of commands written at a time.
+        returns: dict with the char_delay and round_trip measured, None if the Crtc didn't answer.
+        """
+        old_delay = self.char_delay
+        accepted = None     # Shortest delay where all commands were answered
+        round_trips = []
+        for delay in sorted(delays, reverse=True):
+            self.char_delay = delay
+            answers = [self.probe(length) for attempt in range(attempts)]
+            if None in answers:
+                break
+            accepted = delay
+            round_trips.extend(answer[0] for answer in answers)     # Later answers can wait for the earlier ones
+        
+        if accepted is None:
+            self.char_delay = old_delay
+            self.log.warn("Crtc calibration failed, no answer at {0} seconds character delay".format(max(delays)))
+            return None
+        
+        round_trips.sort()
+        self.char_delay = min(accepted * 1.5, max(delays))
+        self.round_trip = max(round_trips[len(round_trips) / 2], 0.0)  # median
+        calibration = {'char_delay': self.char_delay, 'round_trip': self.round_trip, 'time': clock.now()}
+        get_store()[self.key('serial_calibration')] = calibration
+        self.log.info("Crtc calibrated, character delay: {0:.3f} s, round trip: {1:.3f} s".format(self.char_delay, self.round_trip))
+        return calibration
+    
+    def probe(self, count):
+        """Writes count p commands char_delay apart and waits for every answer. Unlike send nothing is written when 
+        an answer is missing, the Crtc can't be waiting for the rest of a command.
+        
+        count: number of commands.
+        returns: list of seconds from writing each command to its answer, None if an answer was missing.
+        """
+        with self.lock:
+            self.open()
+            reader = self.reader or SerialReader(self.ser, config['serial_ring_size'])
+            if not self.reader:
+                reader.start()
+            cursor = reader.sequence
+            try:
+                sent = []
+                for attempt in range(count):
+                    clock.sleep(self.char_delay)
+                    self.write('p')
+                    sent.append(clock.time())
+                metrics.count('serial_commands_total', count)
+                round_trips = []
+                while len(round_trips) < count:
+                    entry = reader.get_line(cursor, max(sent[len(round_trips)] + 3 - clock.time(), 0))
+                    if not entry:
+                        metrics.count('serial_ack_timeouts_total')
+                        return None
+                    cursor = entry[0]
+                    if entry[1] >= sent[len(round_trips)] and re.search('PSRFTXT,(Y|N)', entry[2]):
+                        round_trips.append(entry[1] - sent[len(round_trips)])
+                return round_trips
+            finally:
+                if not self.reader:
+                    reader.stop()
+                else:
+                    self.cursor = cursor
+                self.close()
+    
     def date_time(self, delta):
         """This function sets the date and time. It receives the time as a delta. It sets the time using the send function. Date is set with the following format: ddmmyyyy, time is set with: HHMMSSfff which includes milliseconds.
         
@@ -212,17 +544,18 @@ class Crtc():
         while True:
             #First the delta is converted to a python timedelta object, a timedelta object accepts either seconds or microseconds. delta * 1000 is in microseconds.
             python_delta = datetime.timedelta(microseconds = delta * 1000)
-            #the transmission takes time, so this is accounted for.
-            transmission_error = datetime.timedelta(seconds = 3)
+            #the transmission takes time, so this is accounted for. The Crtc sets the time when the last of the 10 
+            #characters arrives, each character is delayed and the last one takes half a round trip to arrive.
+            transmission_error = datetime.timedelta(seconds = 10 * self.char_delay + self.round_trip / 2.0)
             
             #Then the time is written
-            total_time = datetime.datetime.utcnow() + python_delta + transmission_error  #Time to write
+            total_time = clock.utcnow() + python_delta + transmission_error  #Time to write
             status_time = self.send('t' + total_time.strftime("%H%M%S%f")[:-3]) #Writing time
-            time.sleep(0.5)     #Let the Crtc process time update
+            clock.sleep(0.5)     #Let the Crtc process time update
         
             #Then the date is written
-            status_date = self.send('d' + datetime.datetime.utcnow().strftime("%d%m%Y"))
-            time.sleep(0.5)     #Sleep to let Crtc process before sending next command
+            status_date = self.send('d' + clock.utcnow().strftime("%d%m%Y"))
+            clock.sleep(0.5)     #Sleep to let Crtc process before sending next command
             
             if status_date == 1 or status_time == 1:
                 continue
@@ -235,39 +568,49 @@ class Crtc():
         delta: int with the number of milliseconds to adjust
         returns None        
         """
-        #Create a list containing all the millisecond steps needed
+        #All the millisecond steps needed are sent as one batch
         if delta > 0:
-            delta_list = range(0,int(round(delta,0)))   #make sure delta is a whole number
             sign = '+'
         elif delta < 0:
-            delta_list = range(int(round(delta,0)),0)   #make sure delta is a whole number
             sign = '-'
-        for number in delta_list:
-            status = self.send(sign, None)  #No response needed
-            time.sleep(0.01)
+        else:
+            return
+        self.send_many(sign * abs(int(round(delta,0))), None)  #No response needed
         return
     
     def freq_adj(self, crtc_restart=False, offset=0):
         """frequency adjust will monitor the long term stability of the oscillator, and will attempt to adjust the frequency to improve stability.
         
+        With freq_controller "fit" the steps are predicted from the whole history of adjustments by a
+        FrequencyController, with "curve" they are calculated from the time since the last frequency adjustment.
+        
         crtc_restart: Indicates if the crtc has lost power thus having reset all previous frequency adjustments.
         offset: if the offset has been larger than +-1ms we perform a new frequency adjustment. The offset is therefore needed.
-        returns: None
+        returns: total number of steps in effect
         """
         
-        #The time of the last frequency adjustment and adjustment steps are kept in a shelve.
-        db = shelve.open(os.path.join(config['temporary_storage'],'shelvefile'), 'c')
+        #The time of the last frequency adjustment and adjustment steps are kept in the state store.
+        db = get_store()
+        controller = None
         
         #Now the number of necessary steps are calculated.
         if crtc_restart:    #if the crtc has restarted we reuse the saved number of steps
-            steps = db['freq_adj'][1]
+            steps = db[self.key('freq_adj')][1]
             if steps < 0:
                 sign = '-'
             else:
                 sign = '+'
+        elif not (-1 < offset < 1) and config['freq_controller'] == 'fit':
+            #The offset and what adjust_ms leaves of it are added to the history, which predicts the steps
+            controller = FrequencyController(db.get(self.key('freq_history')), config['freq_step_ppm'],
+                                             size=config['freq_history_size'])
+            residual = 0.0 if abs(offset) > 1000 else offset - int(round(offset, 0))
+            controller.add(clock.time(), offset, residual, db[self.key('freq_adj')][1])
+            steps = controller.steps_needed()
+            sign = '-' if steps < 0 else '+'
         elif not (-1 < offset < 1): #we calculate the steps if the offset is larger than +- 1ms
-            time_1 = db['freq_adj'][0]  #time of last frequency adjustment
-            time_dif = datetime.datetime.now() - time_1 #time it has taken to drift offset
+            time_1 = db[self.key('freq_adj')][0]  #time of last frequency adjustment
+            time_dif = clock.now() - time_1 #time it has taken to drift offset
             time_dif = time_dif.total_seconds() #convert time delta to seconds
             error_size = time_dif / float(offset)   #error_size indicates how quickly it has drifted
             steps = 20000*math.e**(-abs(error_size)/170000.0)    #large error_size, more steps
@@ -286,21 +629,24 @@ class Crtc():
             frequency_adjustment = [[thousands, 'o'],[tens, 'x']]
         elif sign == '-':    #adjust frequency down
             frequency_adjustment = [[thousands, 'i'],[tens, 'z']]
-            steps = steps * -1  #negative adjustment was performed
         
-        for amount in frequency_adjustment: #first treat thousands, then do tens.
-            for step in range(int(amount[0])):  #use send multiple times.
-                self.send(amount[1])    #amount[1] is the letter to be sent to the crtc.
+        #first treat thousands, then do tens. Only the answered steps are counted as performed.
+        answered = self.send_many(''.join(letter * int(amount) for amount, letter in frequency_adjustment))
+        steps = 1000 * answered.get(frequency_adjustment[0][1], 0) + 10 * answered.get(frequency_adjustment[1][1], 0)
+        metrics.histogram('freq_adj_steps', steps, metrics.STEP_BUCKETS)
+        if sign == '-':
+            steps = steps * -1
         
-        #updating shelve file with the new information
+        #updating the state store with the new information
+        if controller:
+            controller.set_steps(db[self.key('freq_adj')][1] + steps)
+            db[self.key('freq_history')] = controller.history
         if crtc_restart:
-            db['freq_adj'] = [datetime.datetime.now(), steps]
-            db.close()
+            db[self.key('freq_adj')] = [clock.now(), steps]
             return steps
         else:
-            total_steps = db['freq_adj'][1] + steps
-            db['freq_adj'] = [datetime.datetime.now(), total_steps]
-            db.close()
+            total_steps = db[self.key('freq_adj')][1] + steps
+            db[self.key('freq_adj')] = [clock.now(), total_steps]
             return total_steps
 
 
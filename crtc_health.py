@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""crtc_health.py watches the lines the Crtc sends and tells at once whether it is working.
+The Crtc sends a status line every second, e.g. "$PSRFTXT,054,A,0000" where A means the time is valid and V invalid.
+CrtcHealth is called with every line by the SerialReader, and keeps the time of the latest status line, the typical
+interval between them and the latest validity flag. The stream is stalled when no status line has arrived for
+STALL_LINES intervals. The reach of the refclock in ntpd is read from the shared peer snapshot, so ntpd is rarely
+queried for it.
+"""
+
+import re
+import threading
+import clock
+import metrics
+
+STATUS = re.compile('054,(A|V),0000')
+STALL_LINES = 2.0       # Intervals without a status line before the stream is stalled, one line missed
+EXPECTED_INTERVAL = 1.0 # Seconds between status lines until the interval is measured
+REFCLOCK = '127.127.20.0'
+
+#Health states
+HEALTHY = 'healthy'
+NO_DATA = 'no data'
+STALLED = 'stalled'
+INVALID = 'invalid'
+NO_REFCLOCK = 'refclock not reached'
+
+def refclock_address(unit):
+    """returns: address in ntpd of the unit'th Crtc, e.g. 127.127.20.1 for the second."""
+    return '{0}.{1}'.format(REFCLOCK.rsplit('.', 1)[0], unit)
+
+def device_key(name, refclock):
+    """returns: name of the state of one Crtc in the state store. The first Crtc uses the name itself, so the state
+    of a host with one Crtc is kept when more are added."""
+    if refclock in (None, REFCLOCK):
+        return name
+    return '{0}.{1}'.format(name, refclock)
+
+class CrtcHealth():
+    """CrtcHealth is the health state of one Crtc."""
+
+    def __init__(self, refclock=REFCLOCK, peers=None):
+        """refclock: address of the Crtc in ntpd.
+        peers: PeerTable the refclock is read from, None to only watch the serial stream.
+        """
+        self.refclock = refclock
+        self.peers = peers
+        self.lock = threading.Lock()
+        self.last_line = None       # Time of the latest line of any kind
+        self.last_status = None     # Time of the latest status line
+        self.interval = EXPECTED_INTERVAL   # Average seconds between status lines
+        self.valid = None           # True if the latest status line was A
+        self.stalls = 0             # Number of times the stream has been found stalled
+        self.stalled = False
+
+    def observe(self, time, line):
+        """Called with every line received from the Crtc.
+
+        returns: None
+        """
+        match = STATUS.search(line)
+        with self.lock:
+            self.last_line = time
+            if not match:
+                return
+            if self.last_status is not None and 0 < time - self.last_status <= STALL_LINES * self.interval:   # Not a stall
+                self.interval += (time - self.last_status - self.interval) / 8.0    # Moving average of the interval
+            self.last_status = time
+            self.valid = match.group(1) == 'A'
+            self.stalled = False
+        return
+
+    def sending(self):
+        """returns: True if a status line has arrived within STALL_LINES intervals."""
+        with self.lock:
+            if self.last_status is None or clock.time() - self.last_status > STALL_LINES * self.interval:
+                if self.last_status is not None and not self.stalled:
+                    self.stalled = True
+                    self.stalls += 1
+                    metrics.count('crtc_stalls_total')
+                return False
+            return True
+
+    def refclock_reached(self, cached=False):
+        """cached: True to use the snapshot already read instead of querying ntpd if it has expired.
+        returns: True if ntpd received the Crtc at one of its last two polls, True if there are no peers to check."""
+        if self.peers is None:
+            return True
+        snapshot_time, peer = self.peers.latest(self.refclock) if cached else self.peers.get(self.refclock)
+        if peer is None or peer.reach == '-' or int(peer.reach, 8) & 0x3 == 0:
+            return False
+        return True
+
+    def state(self, cached=False):
+        """cached: True to use the peer snapshot already read, e.g. for status requests.
+        returns: the health state, HEALTHY if the Crtc is working."""
+        if self.last_status is None:
+            return NO_DATA
+        if not self.sending():
+            return STALLED
+        if not self.valid:
+            return INVALID
+        if not self.refclock_reached(cached):
+            return NO_REFCLOCK
+        return HEALTHY
+
+    def wait(self, timeout, until=(HEALTHY,), step=1.0):
+        """Waits until the Crtc is healthy, or in one of the states in until.
+
+        timeout: maximum seconds to wait.
+        step: seconds between the checks.
+        returns: the health state.
+        """
+        deadline = clock.monotonic() + timeout
+        state = self.state()
+        while state not in until and clock.monotonic() < deadline:
+            clock.sleep(step)
+            state = self.state()
+        return state
+
+    def summary(self, cached=False):
+        """cached: True to use the peer snapshot already read instead of querying ntpd.
+        returns: dict with the health of the Crtc, e.g. for status reports."""
+        state = self.state(cached)
+        with self.lock:
+            age = None if self.last_status is None else clock.time() - self.last_status
+            return {'state': state, 'status_age': age, 'interval': self.interval, 'valid': self.valid,
+                    'stalls': self.stalls}
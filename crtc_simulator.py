@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+"""crtc_simulator.py simulates a Crtc on a pseudo-terminal and an ntpd that is disciplined by it,
+so hipat_control and check_offset can run without the hardware.
+
+CrtcSimulator speaks the Crtc protocol on a pty:
+- a "$PSRFTXT,054,A,0000" status line is sent every second, V until the time is set.
+- t + HHMMSSfff sets the time, d + ddmmyyyy sets the date.
+- + and - adjust the time 1 ms, o/i and x/z adjust the frequency 1000/10 steps up/down.
+- p answers Y if the Crtc has restarted since it was last asked, otherwise N.
+- every command is answered with "$PSRFTXT,ACK".
+The Crtc drifts drift ppm, answers after latency seconds and hangs with a probability of hang_rate per command.
+A hung Crtc sends nothing until it receives 10 characters, like a Crtc waiting for the rest of a command.
+
+SimulatedNtpd updates a FakeNtpd every poll interval with the offsets ntpd would see: the refclock follows the
+Crtc while it sends valid updates, and the reference shows the Crtc's error. With several Crtcs the system clock
+follows the first, and refclock 127.127.20.N shows the error of the Nth Crtc relative to the first. It also writes a state file for
+fake_ntpq.py.
+
+Usage:
+    python crtc_simulator.py --speed 20 --offset 25 --duration 3600
+"""
+
+import os
+import pty
+import tty
+import json
+import random
+import threading
+import datetime
+import time
+import _strptime     # strptime imports it on first use, which fails if several Crtc threads use it at once
+import clock
+from fake_ntpd import FakeNtpd
+
+ACK = '$PSRFTXT,ACK\r\n'
+COMMAND_LENGTHS = {'t': 9, 'd': 8}  # Number of digits following the command letter
+REFCLOCK = '127.127.20.0'
+
+class CrtcSimulator(threading.Thread):
+    """CrtcSimulator is the thread answering commands on the pty."""
+
+    def __init__(self, offset=0.0, drift=0.0, ppm_per_step=0.001, latency=0.05, hang_rate=0.0,
+                 valid=True, restarted=False, line_interval=1.0):
+        """offset: initial error of the Crtc in ms, positive if it is ahead.
+        drift: frequency error in ppm, positive makes the Crtc run fast.
+        ppm_per_step: change of the frequency for every o/i/x/z step.
+        latency: seconds before an answer is sent.
+        hang_rate: probability that a command makes the Crtc hang.
+        valid: False makes the Crtc send V until the time is set.
+        restarted: the answer to the first p command.
+        line_interval: seconds between status lines.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)     # Serial address to give to Crtc
+        self.lock = threading.RLock()
+        self.offset = float(offset)   # Error of the time of day
+        self.date_offset = 0.0  # Error of the date, in whole days
+        self.drift = float(drift)
+        self.ppm_per_step = ppm_per_step
+        self.latency = latency
+        self.hang_rate = hang_rate
+        self.valid = valid
+        self.restarted = restarted
+        self.line_interval = line_interval
+        self.hung = 0           # Characters needed to end a hang
+        self.pending = ''       # Command being received
+        self.updated = clock.time()     # Time the offset was last brought up to date
+        self.commands = {}      # Number of every command received
+        self.running = False
+
+    def offset_ms(self):
+        """returns: the current error of the Crtc in ms."""
+        with self.lock:
+            now = clock.time()
+            self.offset += self.drift * 1e-3 * (now - self.updated)    # 1 ppm is 1 microsecond per second
+            self.updated = now
+            return self.offset + self.date_offset
+
+    def sending(self):
+        """returns: True if the Crtc sends valid updates."""
+        return self.valid and not self.hung
+
+    def hang(self):
+        """Makes the Crtc hang until 10 characters are received."""
+        with self.lock:
+            self.hung = 10
+
+    def _write(self, text):
+        try:
+            os.write(self.master, text)
+        except OSError:
+            pass
+
+    def run(self):
+        self.running = True
+        status = threading.Thread(target=self._status_lines)
+        status.daemon = True
+        status.start()
+        while self.running:
+            try:
+                character = os.read(self.master, 1)
+            except OSError:
+                break
+            if character:
+                self._receive(character)
+
+    def _status_lines(self):
+        while self.running:
+            clock.sleep(self.line_interval)
+            if not self.hung:
+                self._write('$PSRFTXT,054,{0},0000\r\n'.format('A' if self.valid else 'V'))
+
+    def _receive(self, character):
+        """Handles one received character."""
+        with self.lock:
+            if self.hung:
+                self.hung -= 1
+                return
+            if self.pending:
+                self.pending += character
+                if len(self.pending) <= COMMAND_LENGTHS[self.pending[0]]:
+                    return
+                command, self.pending = self.pending, ''
+            elif character in COMMAND_LENGTHS:
+                self.pending = character
+                return
+            else:
+                command = character
+            self.commands[command[0]] = self.commands.get(command[0], 0) + 1
+            answer = self._execute(command)
+            if self.hang_rate and random.random() < self.hang_rate:
+                self.hung = 10
+                return
+        if answer:
+            clock.sleep(self.latency)
+            self._write(answer)
+
+    def _execute(self, command):
+        """Performs a complete command.
+
+        returns: the answer to send, None if the Crtc doesn't answer.
+        """
+        self.offset_ms()    # Bring the offset up to date before it is changed
+        letter = command[0]
+        if letter == 't':
+            try:
+                hours, minutes, seconds, milliseconds = int(command[1:3]), int(command[3:5]), int(command[5:7]), int(command[7:10])
+            except ValueError:
+                return ACK
+            now = clock.utcnow()
+            set_time = now.replace(hour=hours % 24, minute=minutes % 60, second=seconds % 60, microsecond=milliseconds * 1000)
+            difference = (set_time - now).total_seconds() * 1000.0
+            self.offset = (difference + 43200000) % 86400000 - 43200000  # Nearest time of day, within 12 hours
+            self.valid = True
+        elif letter == 'd':
+            try:
+                date = datetime.datetime.strptime(command[1:], '%d%m%Y')
+            except ValueError:
+                return ACK
+            self.date_offset = (date.date() - clock.utcnow().date()).days * 86400000.0
+        elif letter == '+':
+            self.offset += 1
+        elif letter == '-':
+            self.offset -= 1
+        elif letter in 'oixz':
+            steps = {'o': 1000, 'i': -1000, 'x': 10, 'z': -10}[letter]
+            self.drift += steps * self.ppm_per_step
+        elif letter == 'p':
+            answer = 'Y' if self.restarted else 'N'
+            self.restarted = False
+            return '$PSRFTXT,{0}\r\n'.format(answer)
+        elif letter == '1':
+            return None     # Used to unblock the Crtc, ignored otherwise
+        return ACK
+
+    def stop(self):
+        self.running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+class SimulatedNtpd(threading.Thread):
+    """SimulatedNtpd updates the peers of a FakeNtpd from a CrtcSimulator every poll interval."""
+
+    def __init__(self, crtc, reference, poll=16, jitter=0.05, delay=1.2, state_file=None, biases=None):
+        """crtc: the CrtcSimulator ntpd follows, or a list of several, the first disciplines the system clock.
+        reference: address of the reference server, or list of addresses of several.
+        poll: seconds between updates.
+        jitter: standard deviation in ms of the reference offsets.
+        delay: delay in ms to the reference.
+        state_file: file the peers are written to for fake_ntpq.py, None to not write it.
+        biases: dict of ms added to the offsets of a reference, e.g. for a reference with an asymmetric path.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.crtcs = list(crtc) if isinstance(crtc, (list, tuple)) else [crtc]
+        self.crtc = self.crtcs[0]
+        self.refclocks = ['{0}.{1}'.format(REFCLOCK.rsplit('.', 1)[0], unit) for unit in range(len(self.crtcs))]
+        self.references = [reference] if isinstance(reference, basestring) else list(reference)
+        self.reference = self.references[0]
+        self.biases = dict(biases or {})
+        self.down = set()       # References that don't answer
+        self.poll = poll
+        self.jitter = jitter
+        self.delay = delay
+        self.state_file = state_file
+        self.polls = 0
+        self.reach = dict((peer, 0) for peer in self.references + self.refclocks)
+        self.received = {}      # Time every peer was last updated
+        poll_exponent = len(bin(int(poll))) - 3
+        self.server = FakeNtpd(dict((peer, {'hpoll': poll_exponent, 'ppoll': poll_exponent, 'when': None}) for peer in self.reach))
+        self.port = self.server.port
+        self.running = False
+
+    def run(self):
+        self.running = True
+        self.server.start()
+        while self.running:
+            self.update()
+            clock.sleep(self.poll)
+
+    def update(self):
+        """Polls every peer once, like ntpd does every poll interval."""
+        self.polls += 1
+        crtc_offset = self.crtc.offset_ms()
+        # The system clock follows the refclock, so the reference sees the Crtc's error with the opposite sign.
+        peers = dict((reference, {'offset': -crtc_offset + self.biases.get(reference, 0.0) + random.gauss(0, self.jitter),
+                                  'jitter': abs(random.gauss(self.jitter, self.jitter / 4)),
+                                  'delay': self.delay + abs(random.gauss(0, self.jitter))})
+                     for reference in self.references if reference not in self.down)
+        for crtc, refclock in zip(self.crtcs, self.refclocks):
+            if crtc.sending():
+                peers[refclock] = {'offset': crtc.offset_ms() - crtc_offset + random.gauss(0, 0.01), 
+                                   'jitter': abs(random.gauss(0.005, 0.002)), 'delay': 0.0}
+        for peer in self.reach:
+            self.reach[peer] = ((self.reach[peer] << 1) | (peer in peers)) & 0xff
+            variables = {'reach': '0x{0:x}'.format(self.reach[peer])}
+            if peer in peers:
+                self.received[peer] = clock.time()
+                variables['when'] = 0
+                variables.update(('{0}'.format(name), '{0:.3f}'.format(value)) for name, value in peers[peer].items())
+            self.server.set_peer(peer, **variables)
+        if self.state_file:
+            self.write_state()
+
+    def write_state(self):
+        """Writes the peers for fake_ntpq.py. The simulated and real time are both written, so fake_ntpq can
+        calculate the simulated time when it runs.
+        """
+        with self.server.lock:
+            peers = [dict(peer) for peer in self.server.peers.values()]
+        state = {'time': clock.time(), 'real_time': time.time(), 'speed': getattr(clock.current, 'factor', 1.0),
+                 'poll': self.poll, 'received': self.received, 'peers': peers}
+        temporary = self.state_file + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+        os.rename(temporary, self.state_file)
+
+    def stop(self):
+        self.running = False
+        self.server.stop()
+
+def start_simulation(speed=10.0, offset=25.0, drift=0.0, latency=0.05, hang_rate=0.0, jitter=0.05, backend='control',
+                     devices=1):
+    """Starts a simulated Crtc and ntpd and points the configuration at them. The configuration has to be changed
+    before the HiPAT modules are imported, since they read it at import.
+    
+    speed: simulated seconds per real second, 1 keeps the real time.
+    backend: how HiPAT reads ntpd, "control" or "ntpq".
+    devices: number of Crtcs simulated, with more than one they are set as crtc_devices. All get the same arguments,
+             ntpd.crtcs holds them.
+    The other arguments are passed to CrtcSimulator and SimulatedNtpd.
+    returns: (the first CrtcSimulator, SimulatedNtpd, temporary storage directory)
+    """
+    import sys
+    import tempfile
+    from config import config
+    
+    directory = tempfile.mkdtemp(prefix='hipat_sim_')
+    if speed != 1:
+        clock.install(clock.AcceleratedClock(speed))
+    crtcs = [CrtcSimulator(offset=offset, drift=drift, latency=latency, hang_rate=hang_rate) for unit in range(devices)]
+    for crtc in crtcs:
+        crtc.start()
+    crtc = crtcs[0]
+    ntpd = SimulatedNtpd(crtcs, config['hipat_references'] or config['hipat_reference'], jitter=jitter,
+                         state_file=os.path.join(directory, 'ntpq_state.json'))
+    ntpd.start()
+    config.update({'temporary_storage': directory,
+                   'serial_address': crtc.port,
+                   'crtc_devices': ','.join(crtc.port for crtc in crtcs) if devices > 1 else '',
+                   'ntp_backend': backend,
+                   'ntp_control_port': str(ntpd.port),
+                   'ntpq_command': '{0} {1} {2}'.format(sys.executable, os.path.join(config['program_path'], 'fake_ntpq.py'),
+                                                        ntpd.state_file)})
+    clock.sleep(ntpd.poll * 2)  # Let the refclock reach ntpd
+    return crtc, ntpd, directory
+
+def main():
+    """Runs hipat_control, or a single get_quality_offset, against a simulated Crtc and ntpd."""
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Run HiPAT against a simulated Crtc and ntpd.')
+    parser.add_argument('--mode', choices=['control', 'quality'], default='control',
+                        help='run hipat_control, or a single get_quality_offset')
+    parser.add_argument('--speed', type=float, default=10.0, help='simulated seconds per real second')
+    parser.add_argument('--duration', type=float, default=3600.0, help='simulated seconds to run hipat_control')
+    parser.add_argument('--offset', type=float, default=25.0, help='initial Crtc error in ms')
+    parser.add_argument('--drift', type=float, default=0.0, help='Crtc frequency error in ppm')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds before the Crtc answers')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='probability a command hangs the Crtc')
+    parser.add_argument('--jitter', type=float, default=0.05, help='jitter in ms of the reference')
+    parser.add_argument('--backend', choices=['control', 'ntpq'], default='control', help='how ntpd is read')
+    parser.add_argument('--devices', type=int, default=1, help='number of Crtcs controlled by hipat_control')
+    args = parser.parse_args()
+
+    crtc, ntpd, directory = start_simulation(args.speed, args.offset, args.drift, args.latency, args.hang_rate,
+                                             args.jitter, args.backend, args.devices)
+
+    if args.mode == 'quality':
+        import check_offset
+        start = clock.time()
+        offset = check_offset.get_quality_offset()
+        print 'Offset: {0} ms, Crtc error: {1:.3f} ms, simulated seconds: {2:.0f}'.format(offset, crtc.offset_ms(), clock.time() - start)
+        return
+
+    import hipat_control
+    control = threading.Thread(target=hipat_control.main)
+    control.daemon = True
+    control.start()
+    end = clock.time() + args.duration
+    while clock.time() < end and control.is_alive():
+        clock.sleep(60)
+        for crtc in ntpd.crtcs:
+            print 'Simulated time: {0:.0f} s, Crtc error: {1:.3f} ms, drift: {2:.3f} ppm, commands: {3}'.format(
+                args.duration - (end - clock.time()), crtc.offset_ms(), crtc.drift, crtc.commands)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
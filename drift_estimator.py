@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""drift_estimator.py estimates the offset to the reference with a Kalman filter of the offset and its drift.
+Every measurement is weighted by the noise ntpd reports for it: the jitter, and half the delay in excess of the
+lowest delay seen, since a measurement delayed by queueing can be off by up to half the extra delay.
+The estimate comes with a confidence interval, so a decision can be made as soon as the interval is tight enough
+instead of waiting for the standard deviation of a full window to improve.
+"""
+
+import math
+
+DRIFT_NOISE = 1e-9          # Change of the drift, ms^2/s^3. The oscillator drift changes slowly
+INITIAL_DRIFT = 0.01        # Standard deviation of the unknown drift before the first samples, ms/s (10 ppm)
+MINIMUM_NOISE = 0.001       # Lowest standard deviation of a measurement, ms. A jitter of 0 is not trusted blindly
+
+class DriftEstimator():
+    """DriftEstimator keeps the state [offset in ms, drift in ms/s] and its covariance."""
+
+    def __init__(self):
+        self.time = None        # Time of the latest measurement
+        self.offset = 0.0       # Estimated offset at self.time, ms
+        self.drift = 0.0        # Estimated drift, ms per second
+        self.covariance = [[0.0, 0.0], [0.0, 0.0]]
+        self.min_delay = None   # Lowest delay seen, ms
+        self.samples = 0
+
+    def noise(self, jitter, delay):
+        """returns: standard deviation in ms of a measurement with the given jitter and delay."""
+        excess = 0.0
+        if delay is not None:
+            if self.min_delay is None or delay < self.min_delay:
+                self.min_delay = delay
+            excess = (delay - self.min_delay) / 2.0
+        return max(math.sqrt((jitter or 0.0) ** 2 + excess ** 2), MINIMUM_NOISE)
+
+    def update(self, time, offset, jitter, delay=None):
+        """Adds a measurement.
+
+        time: time the measurement was made by ntpd, seconds since the epoch.
+        offset: measured offset in ms.
+        jitter: jitter reported by ntpd in ms.
+        delay: delay reported by ntpd in ms.
+        returns: None
+        """
+        variance = self.noise(jitter, delay) ** 2
+        if self.time is None:
+            self.time = time
+            self.offset = offset
+            self.drift = 0.0
+            self.covariance = [[variance, 0.0], [0.0, INITIAL_DRIFT ** 2]]
+            self.samples = 1
+            return
+
+        #Predict the state at the time of the measurement
+        dt = max(time - self.time, 0.0)
+        (p00, p01), (p10, p11) = self.covariance
+        offset_predicted = self.offset + self.drift * dt
+        p00, p01, p10, p11 = (p00 + dt * (p10 + p01) + dt * dt * p11 + DRIFT_NOISE * dt ** 3 / 3.0,
+                              p01 + dt * p11 + DRIFT_NOISE * dt ** 2 / 2.0,
+                              p10 + dt * p11 + DRIFT_NOISE * dt ** 2 / 2.0,
+                              p11 + DRIFT_NOISE * dt)
+
+        #Correct it with the measurement
+        residual = offset - offset_predicted
+        s = p00 + variance
+        k0, k1 = p00 / s, p10 / s
+        self.offset = offset_predicted + k0 * residual
+        self.drift = self.drift + k1 * residual
+        self.covariance = [[(1 - k0) * p00, (1 - k0) * p01],
+                           [p10 - k1 * p00, p11 - k1 * p01]]
+        self.time = max(time, self.time)
+        self.samples += 1
+        return
+
+    def estimate(self, time=None):
+        """returns: offset in ms predicted at time, default the time of the latest measurement."""
+        if time is None or self.time is None:
+            return self.offset
+        return self.offset + self.drift * (time - self.time)
+
+    def interval(self, time=None, z=1.96):
+        """returns: half width in ms of the confidence interval of estimate(time), 95% by default."""
+        (p00, p01), (p10, p11) = self.covariance
+        dt = 0.0 if time is None or self.time is None else time - self.time
+        return z * math.sqrt(max(p00 + dt * (p10 + p01) + dt * dt * p11, 0.0))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""fake_ntpd.py is a local stand-in for ntpd that answers NTP control (mode 6) requests.
+It is used to exercise ntp_control.py and check_offset.py without a running ntpd.
+
+Usage:
+    server = FakeNtpd({'158.112.160.8': {'offset': '0.250', 'jitter': '0.100'}})
+    server.start()
+    client = NtpControl(port=server.port)
+"""
+
+import socket
+import struct
+import threading
+import clock
+from ntp_control import HEADER, MODE_CONTROL, OP_READSTAT, OP_READVAR, NTP_EPOCH
+
+FRAGMENT_SIZE = 468     # ntpd sends at most 468 data bytes per response packet
+
+def ntp_timestamp(unix_time):
+    """returns: unix_time formatted as an ntpd hex timestamp."""
+    seconds = int(unix_time) + NTP_EPOCH
+    fraction = int((unix_time % 1) * 4294967296)
+    return '0x{0:08x}.{1:08x}'.format(seconds, fraction)
+
+class FakeNtpd(threading.Thread):
+    """FakeNtpd serves a table of peers over UDP on localhost."""
+
+    def __init__(self, peers=None, address='127.0.0.1', port=0):
+        """Binds the socket, port 0 picks a free port which is found in self.port.
+
+        peers: dict with the peer address as key and a dict of variables as value. Missing variables get defaults.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.sock.settimeout(0.2)
+        self.port = self.sock.getsockname()[1]
+        self.requests = 0
+        self.running = False
+        for ref_server, variables in (peers or {}).items():
+            self.set_peer(ref_server, **variables)
+
+    def set_peer(self, ref_server, **variables):
+        """Adds or updates a peer. Updating "rec" marks a new measurement.
+
+        ref_server: address of the peer.
+        variables: ntpd peer variables, e.g. offset='0.250', when=3 (seconds since last update).
+        """
+        with self.lock:
+            if ref_server not in self.peers:
+                self.peers[ref_server] = {'association': len(self.peers) + 1,
+                                          'srcadr': ref_server,
+                                          'refid': '.GPS.' if ref_server.startswith('127.127.') else '192.168.1.1',
+                                          'stratum': '0' if ref_server.startswith('127.127.') else '1',
+                                          'hpoll': '4', 'ppoll': '4', 'reach': '0xff',
+                                          'delay': '0.000', 'offset': '0.000', 'jitter': '0.000',
+                                          'rec': ntp_timestamp(clock.time())}
+            peer = self.peers[ref_server]
+            if 'when' in variables:
+                when = variables.pop('when')
+                peer['rec'] = '0x00000000.00000000' if when is None else ntp_timestamp(clock.time() - when)
+            for name, value in variables.items():
+                peer[name] = str(value)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                packet, client = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            if len(packet) < HEADER.size:
+                continue
+            li_vn_mode, r_e_m_op, sequence, status, association, offset, count = HEADER.unpack_from(packet)
+            if (li_vn_mode & 0x7) != MODE_CONTROL:
+                continue
+            self.requests += 1
+            opcode = r_e_m_op & 0x1f
+            with self.lock:
+                data = self._answer(opcode, association)
+            if data is None:
+                self.sock.sendto(HEADER.pack(li_vn_mode, 0x80 | 0x40 | opcode, sequence, 3 << 8, association, 0, 0), client)
+                continue
+            for start in range(0, max(len(data), 1), FRAGMENT_SIZE):
+                fragment = data[start:start + FRAGMENT_SIZE]
+                more = 0x20 if start + FRAGMENT_SIZE < len(data) else 0
+                padding = '\0' * (-len(fragment) % 4)
+                header = HEADER.pack(li_vn_mode, 0x80 | more | opcode, sequence, 0, association, start, len(fragment))
+                self.sock.sendto(header + fragment + padding, client)
+
+    def _answer(self, opcode, association):
+        """returns: response data for the request, None if the request is not known."""
+        if opcode == OP_READSTAT:
+            return ''.join(struct.pack('!HH', peer['association'], 0x9614) for peer in self.peers.values())
+        if opcode == OP_READVAR:
+            for peer in self.peers.values():
+                if peer['association'] == association:
+                    items = ['{0}={1}'.format(name, value) for name, value in sorted(peer.items())
+                             if name != 'association']
+                    return ', '.join(items) + '\r\n'
+        return None
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.sock.close()
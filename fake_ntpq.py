@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""fake_ntpq.py prints the peers of crtc_simulator.py in the format of ntpq -pn.
+It is used as ntpq_command when the simulator runs with the ntpq backend.
+
+Usage:
+    python fake_ntpq.py state_file -pn
+"""
+
+import sys
+import json
+import time
+import ntp_control
+
+def main():
+    """Reads the state file written by SimulatedNtpd and prints the table."""
+    with open(sys.argv[1]) as f:
+        state = json.load(f)
+    now = state['time'] + (time.time() - state['real_time']) * state['speed']     # The simulated time
+    print '     remote           refid      st t when poll reach   delay   offset  jitter'
+    print '=============================================================================='
+    for variables in sorted(state['peers'], key=lambda peer: peer['association']):
+        peer = ntp_control.peer_record(variables, now)
+        tally = '*' if peer['t'] == 'l' and peer['reach'] != '0' else ' '
+        print '{0}{ref_server:<16} {refid:<16} {st:>2} {t} {when:>4} {poll:>4} {reach:>5} {delay:>7} {offset:>8} {jitter:>7}'.format(tally, **peer)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""freq_control.py decides how many frequency steps freq_adj should send, from the history of adjustments.
+
+Between two adjustments the Crtc drifts away from the reference. The offset measured at an adjustment, minus what
+was left uncorrected by the previous one, divided by the time between them is the drift rate during that interval,
+and the total number of frequency steps in effect is known for every interval. A weighted least squares fit of
+rate = natural drift - gain * steps over the whole history gives the number of steps where the drift is zero.
+Long intervals measure the rate best and are weighted by the square of their length.
+If the history only holds one step setting the gain can't be fitted, and freq_step_ppm from config is used.
+The step is shrunk by the uncertainty of the prediction, so a single noisy offset can't cause a large mis-step.
+"""
+
+import math
+
+class FrequencyController():
+    """FrequencyController holds the history of adjustments.
+    Every record is a dict with time (seconds since the epoch), offset (ms measured), residual (ms left uncorrected)
+    and steps (total frequency steps in effect after the adjustment).
+    """
+
+    def __init__(self, history=None, step_ppm=0.001, max_steps=20000, size=50):
+        """history: records from an earlier run, e.g. loaded from the state store.
+        step_ppm: expected frequency change in ppm of one step, used until the history is enough to fit it.
+        max_steps: largest number of steps sent in one adjustment.
+        size: number of records kept.
+        """
+        self.history = list(history or [])[-size:]
+        self.gain = step_ppm * 1e-3     # ms/s per step
+        self.max_steps = max_steps
+        self.size = size
+
+    def add(self, time, offset, residual, steps):
+        """Adds an adjustment to the history. An offset too large for the drift (a date and time adjustment)
+        starts the history over, since the time between adjustments no longer tells the drift.
+
+        returns: None
+        """
+        if abs(offset) > 1000:
+            self.history = []
+        self.history.append({'time': time, 'offset': offset, 'residual': residual, 'steps': steps})
+        self.history = self.history[-self.size:]
+        return
+
+    def set_steps(self, steps):
+        """Sets the total steps in effect after the latest adjustment, once they are sent to the Crtc."""
+        self.history[-1]['steps'] = steps
+
+    def rates(self):
+        """returns: list of (drift rate in ms/s, steps in effect, weight) for every interval in the history."""
+        rates = []
+        for previous, record in zip(self.history, self.history[1:]):
+            interval = record['time'] - previous['time']
+            if interval <= 0:
+                continue
+            rate = (record['offset'] - previous['residual']) / interval
+            rates.append((rate, previous['steps'], interval ** 2))
+        return rates
+
+    def fit(self):
+        """Fits rate = drift - gain * steps.
+
+        returns: (drift in ms/s, gain in ms/s per step, standard error in ms/s of the rate at the latest steps),
+                 None if the history holds no interval.
+        """
+        rates = self.rates()
+        if not rates:
+            return None
+        total = sum(weight for rate, steps, weight in rates)
+        steps_mean = sum(steps * weight for rate, steps, weight in rates) / total
+        rate_mean = sum(rate * weight for rate, steps, weight in rates) / total
+        steps_var = sum(weight * (steps - steps_mean) ** 2 for rate, steps, weight in rates)
+        gain = self.gain
+        parameters = 1
+        if steps_var > 0:
+            fitted = -sum(weight * (steps - steps_mean) * (rate - rate_mean) for rate, steps, weight in rates) / steps_var
+            if fitted > 0:      # A frequency step in the wrong direction means the history is too noisy to tell
+                gain = fitted
+                parameters = 2
+        drift = rate_mean + gain * steps_mean
+
+        #Standard error of the rate predicted at the latest steps
+        latest = self.history[-1]['steps']
+        if len(rates) <= parameters:    # No spread to measure, the rate is assumed to be known to within itself
+            return drift, gain, abs(drift - gain * latest)
+        variance = sum(weight * (rate - drift + gain * steps) ** 2 for rate, steps, weight in rates) / (len(rates) - parameters)
+        leverage = 1.0 / total
+        if parameters == 2:
+            leverage += (latest - steps_mean) ** 2 / steps_var
+        return drift, gain, math.sqrt(variance * leverage)
+
+    def steps_needed(self):
+        """returns: number of steps to add to the latest steps to make the drift zero, rounded to tens."""
+        result = self.fit()
+        if result is None:
+            return 0
+        drift, gain, error = result
+        latest = self.history[-1]['steps']
+        steps = drift / gain - latest
+        uncertainty = error / gain
+        if steps:   # Move only as far as the prediction is trusted
+            steps *= steps ** 2 / (steps ** 2 + uncertainty ** 2)
+        steps = max(-self.max_steps, min(self.max_steps, steps))
+        return int(round(steps, -1))
@@ -10,15 +10,23 @@ Version 2.0
 
 from crtc import Crtc
 from config import config
+from crtc_health import refclock_address, STATUS
+from scheduler import Scheduler
 import logger
-import datetime
-import time
+import metrics
+import capture
+import control_socket
+import collections
+import clock
 import re
 import check_offset
 import os
 import sys
-import shelve
 import subprocess
+import socket
+import threading
+from state_store import get_store
+from time_series import get_series
 
 #initialize the logger
 logfile = logger.init_logger('hipat_control')
@@ -29,7 +37,7 @@ def check_running():
     returns: address to pidfile
     """
     pid = str(os.getpid())
-    pidfile = "/mnt/tmpfs/check_offset.pid"
+    pidfile = os.path.join(config['temporary_storage'], 'check_offset.pid')
     
     if os.path.isfile(pidfile): #if a pidfile exists
         new_pid = file(pidfile, 'r').read()
@@ -44,17 +52,16 @@ def check_running():
         file(pidfile, 'w').write(pid)   #store pid in file
     return 
     
-def shelvefile():
-    """Opens the shelve file. If no shelvefile exists a new one is created and populated with a default average value.
+def shelvefile(devices):
+    """Loads the state store. If it is empty it is populated with a default average value and freq_adj history
+    for every Crtc.
     
     returns: None  
     """
-    db = shelve.open(os.path.join(config['temporary_storage'],'shelvefile'), 'c')
-    if 'average' not in db:
-        db['average'] = 0
-    if 'freq_adj' not in db:
-        db['freq_adj'] = [datetime.datetime.now(), 0]
-    db.close()
+    db = get_store()
+    for device in devices:
+        db.setdefault(device.crtc.key('average'), 0)
+        db.setdefault(device.crtc.key('freq_adj'), [clock.now(), 0])
     return
     
 def crtc_restart(ser):
@@ -65,40 +72,28 @@ def crtc_restart(ser):
     crtc_restart = ser.send('p', 'PSRFTXT,(Y|N)')
     if crtc_restart == 'Y':
         #reset the previous freq_adj by calling it with a True variable
-        logfile.info('Crtc restart, freq_adj is called, (commented out for now)')
+        ser.log.info('Crtc restart, freq_adj is called, (commented out for now)')
         #ser.freq_adj(True) 
     return
 
 
 def check_file_lengths(length):
     """To make sure the storage capacity of the HiPAT system doesn't fill up a regular check of the log files is done. 
+    Only the end of each file is read, and only if it has changed since the last check. errors.log is not trimmed,
+    its handler rotates it at log_max_lines.
     
     length: number of lines the file should not exceed.
     
     returns: None
     """
-    filepaths = [os.path.join(config['temporary_storage'], 'errors.log'),
-                 os.path.join(config['temporary_storage'], 'running_output.txt')]
+    filepaths = [os.path.join(config['temporary_storage'], 'running_output.txt')]
     for file in filepaths:
-        try:
-            os.path.isfile(file)
-        except IOError:
-            logfile.debug("No {0} present".format(os.path.basename(file)))
-            
-        # Check for file size first
-        file_size = int(os.path.getsize(file))
-        if file_size > 1048576:  # 1 MB
-            os.remove(file)   
+        if not os.path.isfile(file):
+            logfile.debug("No %s present", os.path.basename(file))
+            continue
         
-        # Check number of lines    
-        with open(file, 'r') as f:
-            lines = f.readlines()
-            if len(lines) > length:
-                lines = lines[-length:]
-        #if more than 200 lines are present only the last 200 are rewritten
-        with open(file, 'w') as c:
-            for line in lines:
-                c.write(line)   
+        # Keep the last lines, and never more than log_max_bytes
+        logger.trim_tail(file, length, config['log_max_bytes'])
     return
     
 def make_adjust(ser, offset):
@@ -107,55 +102,345 @@ def make_adjust(ser, offset):
     
     returns: None, when it is finished.    
     """
-    db = shelve.open(os.path.join(config['temporary_storage'],'shelvefile'), 'c')
+    db = get_store()
+    metrics.histogram('adjustment_ms', abs(offset), metrics.ADJUSTMENT_BUCKETS)
     #Adjust time and date
     if -1000 > offset or offset > 1000:
         ser.date_time(offset)
-        db['average'] = 0.0
-        db.close()
-        logfile.info("Adjusted Date and Time")
+        get_series().append(clock.time(), offset, source=ser.refclock, adjustment=offset)
+        db[ser.key('average')] = 0.0
+        ser.log.info("Adjusted Date and Time")
         #time.sleep(60)     # Don't need to sleep. Check_offset will take time and wait for it to be stable.
         return
     
     #Adjust ms
     while round(offset,1) >= 1 or round(offset,1) <= -1:
         ser.adjust_ms(offset)
-        db['average'] = 0.0
-        db.close()
-        logfile.info("Adjusted {0} Millisecond(s)".format(int(round(offset,0))))
+        get_series().append(clock.time(), offset, source=ser.refclock, adjustment=round(offset, 0))
+        db[ser.key('average')] = 0.0
+        ser.log.info("Adjusted {0} Millisecond(s)".format(int(round(offset,0))))
         #time.sleep(60)     # Don't need to sleep. 
         return
     return    
     
+ADJUSTMENTS_KEPT = 10   # Number of adjustments of every Crtc reported by the status command
+
+class ControlState():
+    """ControlState is shared by the tasks of the control loop. The sampling task publishes offsets, the adjust task
+    consumes them. Every adjustment starts a new generation, offsets sampled before it are no longer valid.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0     # Number of adjustments made
+        self.offset = None      # Latest offset not yet acted upon
+        self.offset_generation = None   # Generation the offset was sampled in
+        self.offset_time = None # Time the offset was published
+        self.estimate = None    # Latest offset published as (offset, time, generation), kept when it is acted upon
+        self.adjusted_time = None   # Time the Crtc was last adjusted, ntpd measurements before it are not used
+        self.adjustments = collections.deque(maxlen=ADJUSTMENTS_KEPT)   # (time, offset) of the latest adjustments
+    
+    def publish(self, offset, generation):
+        """Publishes an offset sampled in generation."""
+        with self.lock:
+            self.offset = offset
+            self.offset_generation = generation
+            self.offset_time = clock.time()
+            self.estimate = (offset, self.offset_time, generation)
+    
+    def take(self):
+        """returns: the latest valid offset, None if there is none. The offset is only returned once."""
+        with self.lock:
+            offset = self.offset
+            self.offset = None
+            if offset is None or self.offset_generation != self.generation:
+                return None
+            return offset
+    
+    def adjusted(self, offset=None):
+        """Starts a new generation, called before and after the Crtc is adjusted. Also used to resample, the 
+        running estimate is aborted and only measurements made after this are used.
+        
+        offset: offset in ms the Crtc is adjusted by, None if it isn't adjusted.
+        """
+        with self.lock:
+            self.generation += 1
+            self.adjusted_time = clock.time()
+            if offset is not None:
+                self.adjustments.append((self.adjusted_time, offset))
+
+class Device():
+    """Device is one Crtc controlled by hipat_control, with its own control state. Every device has its own
+    sampling, health and adjust tasks, so a slow fix or frequency adjustment of one doesn't hold up the others.
+    """
+    
+    def __init__(self, crtc):
+        self.crtc = crtc
+        self.state = ControlState()
+        self.failed = False     # True while the Crtc can't be fixed, it is neither sampled nor adjusted
+    
+def create_devices():
+    """Opens every Crtc in crtc_devices, the Nth is refclock 127.127.20.N in ntpd. Without crtc_devices the Crtc
+    on serial_address is used.
+    
+    returns: list of Device
+    """
+    addresses = config['crtc_devices'] or [config['serial_address']]
+    return [Device(Crtc(address, refclock=refclock_address(unit))) for unit, address in enumerate(addresses)]
+
+def check_crtc(device, devices):
+    """Health task: checks the Crtc and fixes it if needed. If it can't be fixed the program exits, unless other 
+    Crtcs are still working. Then the Crtc is left out until a later check finds it working again.
+    
+    returns: None
+    """
+    try:
+        device.crtc.check_crtc()
+    except SystemExit:
+        device.failed = True
+        if all(other.failed for other in devices):
+            raise
+        device.crtc.log.warn("Crtc could not be fixed, continuing with the other Crtcs")
+        return
+    if device.failed:
+        device.crtc.log.info("Crtc working again")
+    device.failed = False
+    return
+
+def start_capture(devices):
+    """Starts recording to capture_file, with the config and state needed to replay the control loop. The lines of
+    every Crtc are recorded as they arrive. If the file can't be created HiPAT runs without recording.
+    
+    returns: None
+    """
+    try:
+        capture.start(config['capture_file'], [device.crtc.refclock for device in devices], config, get_store().copy())
+    except (IOError, OSError) as e:
+        logfile.warn("Could not record to {0}: {1}".format(config['capture_file'], e))
+        return
+    snapshot_time, peers = check_offset.peers.snapshot()    # The samplers start from the snapshot already read
+    capture.record('peers', [tuple(peer) for peer in peers.values()], snapshot_time)
+    for device in devices:
+        if device.crtc.reader:
+            #The lines from the latest status line on are recorded too, so the health monitor starts from it
+            latest = entry = device.crtc.reader.latest()
+            while entry and not STATUS.search(entry[2]):
+                previous = device.crtc.reader.get_line(entry[0] - 2)
+                if previous[0] >= entry[0]:     # The older lines are out of the ring
+                    break
+                entry = previous
+            while entry and entry[0] <= latest[0]:
+                capture.record('line', (device.crtc.refclock, entry[2]), entry[1])
+                entry = device.crtc.reader.get_line(entry[0])
+            device.crtc.reader.listeners.append(
+                lambda time, line, refclock=device.crtc.refclock: capture.record('line', (refclock, line), time))
+    logfile.info("Recording to {0}".format(config['capture_file']))
+    return
+
+def microseconds(ms):
+    """returns: ms in microseconds rounded to 0.1, None if ms is None."""
+    return None if ms is None else round(ms * 1000.0, 1)
+
+def status(devices):
+    """Status command of the control socket. Only what the tasks already know is reported, neither ntpd nor the
+    Crtcs are queried, so it can be polled often. Offsets are in microseconds.
+    
+    returns: dict with the time, the health of the references and a dict for every Crtc with its latest estimate,
+             the convergence of the estimate, the offset window being sampled, its health, latest adjustments and 
+             frequency adjustment.
+    """
+    now = clock.time()
+    db = get_store()
+    report = []
+    for device in devices:
+        ser, state = device.crtc, device.state
+        with state.lock:
+            estimate, generation = state.estimate, state.generation
+            adjustments = list(state.adjustments)
+        if estimate is not None:
+            estimate = {'offset_us': microseconds(estimate[0]), 'time': estimate[1], 'age': now - estimate[1],
+                        'current': estimate[2] == generation}   # False if the Crtc was adjusted after it
+        convergence = check_offset.convergences.get(ser.refclock)
+        if convergence is not None:
+            convergence = dict(convergence)
+            for name in ('average', 'std', 'interval'):
+                if name in convergence:
+                    convergence[name + '_us'] = microseconds(convergence.pop(name))
+        window = check_offset.windows.get(ser.refclock)
+        if window is not None:     # Read while the sampling thread pushes to it, the values can be one sample apart
+            window = {'count': len(window), 'capacity': window.capacity, 'average_us': microseconds(window.average()),
+                      'std_us': microseconds(window.std())}
+        freq_time, freq_steps = db.get(ser.key('freq_adj'), [None, 0])
+        report.append({'refclock': ser.refclock,
+                       'failed': device.failed,
+                       'estimate': estimate,
+                       'convergence': convergence,
+                       'window': window,
+                       'health': ser.health.summary(cached=True) if ser.health else None,
+                       'adjustments': [{'time': adjusted_time, 'offset_us': microseconds(offset)}
+                                       for adjusted_time, offset in adjustments],
+                       'freq_adj': {'steps': freq_steps, 'time': freq_time,
+                                    'us_per_day': round(freq_steps * config['freq_step_ppm'] * 86400, 1)}})
+    return {'time': now,
+            'references': dict(check_offset.reference_health),
+            'peers_age': None if check_offset.peers.time is None else now - check_offset.peers.time,
+            'devices': report}
+
+def resample(devices, refclock=None):
+    """Resample command of the control socket: the running estimate is dropped and a new one is started, e.g. after
+    a reference has been changed.
+    
+    refclock: Crtc to resample, default is every Crtc.
+    returns: list of the refclocks resampled.
+    """
+    selected = [device for device in devices if refclock in (None, device.crtc.refclock)]
+    if not selected:
+        raise ValueError('no Crtc {0}'.format(refclock))
+    for device in selected:
+        device.state.adjusted()
+        device.crtc.log.info("Resampling, requested on the control socket")
+    return [device.crtc.refclock for device in selected]
+
+def start_control_socket(devices):
+    """Serves status requests on the control socket.
+    
+    returns: the ControlServer, None if it could not be started.
+    """
+    path = control_socket.socket_path()
+    commands = {'status': lambda: status(devices),
+                'resample': lambda refclock=None: resample(devices, refclock),
+                'reload': reload_config}
+    try:
+        server = control_socket.ControlServer(path, commands)
+    except (OSError, IOError, socket.error) as e:
+        logfile.warn("Could not serve the control socket {0}: {1}".format(path, e))
+        return None
+    server.start()
+    return server
+
+def start_device(device, devices):
+    """Checks whether the Crtc has restarted, calibrates it and makes sure it is functional.
+    
+    returns: None
+    """
+    crtc_restart(device.crtc)           # Check to see if the Crtc has restarted, this affects frequency adjust
+    #Measure how fast the Crtc accepts commands, once. The calibration is kept in the state store.
+    if config['serial_calibrate'] and get_store().get(device.crtc.key('serial_calibration')) is None:
+        device.crtc.calibrate()
+    check_crtc(device, devices)
+    return
+    
+def sample_offset(state, ser=None):
+    """Sampling task: collects a quality offset and publishes it. If ntpd is not in sync it waits one ntpd update.
+    The metrics are exported after every attempt.
+    
+    ser: the Crtc sampled, the offset is the differential offset of its refclock. None for the system clock.
+    returns: None
+    """
+    generation, since = state.generation, state.adjusted_time
+    try:
+        offset = check_offset.get_quality_offset(abort=lambda: state.generation != generation, since=since,
+                                                 refclock=ser and ser.refclock)
+        if offset is None:      # Aborted, the Crtc was adjusted while sampling
+            return
+        if offset == 0:         # Not in sync or ntpd restarted
+            metrics.count('not_in_sync_total')
+            clock.sleep(16)
+            return
+        state.publish(offset, generation)
+    finally:
+        metrics.export()    # The metrics are updated every cycle
+    return
+
+def adjust(ser, state):
+    """Adjust task: acts on a new offset as soon as the sampling task publishes it.
+    
+    returns: None
+    """
+    offset = state.take()
+    if offset is None or (-1 < offset < 1):
+        return
+    ser.log.info("Offset: {0}".format(offset))
+    capture.record('decision', (ser.refclock, offset))
+    state.adjusted(offset)  # Samples taken before this adjustment are no longer valid
+    with metrics.timer('adjust_seconds'):
+        make_adjust(ser, offset)
+    if config['freq_adj']:
+        #Make a frequency adjust at the same time
+        total_steps = ser.freq_adj(False, offset)
+        ser.log.info("Total freq_adj steps: {0}".format(total_steps))
+    state.adjusted()    # Samples taken while adjusting are not valid either
+    ser.log.info("Normal operation is resumed")
+    return
+
+def reload_config():
+    """Config task: reads config.txt again if it has been changed. Limits are used from the next time they are read,
+    items that are only read at startup are reported. Also the reload command of the control socket.
+    
+    returns: list of the items updated.
+    """
+    updated, restart = config.reload()
+    for item, value in sorted(updated.items()):
+        logfile.info("Config {0} changed to {1}".format(item, value))
+    if 'peer_cache_ttl' in updated:
+        check_offset.peers.max_ttl = updated['peer_cache_ttl']
+    if 'log_max_lines' in updated and logger.file_handler:
+        logger.file_handler.max_lines = updated['log_max_lines']
+    if restart:
+        logfile.warn("Config changed, restart HiPAT to use: {0}".format(', '.join(sorted(restart))))
+    return sorted(updated)
+
+def sample_device(device):
+    """Sampling task of one Crtc, waits for the health task while the Crtc is failed.
+    
+    returns: None
+    """
+    if device.failed:
+        clock.sleep(config['health_interval'])
+        return
+    sample_offset(device.state, device.crtc)
+    return
+
 def main():
-    """hipat_control first calls the restart and valid functions, 
+    """hipat_control first calls the restart and valid functions for every Crtc, 
     then it will attempt to set the offset for the first time. 
-    When all these checks are done it resumes normal operation which is looped.    
+    When all these checks are done it resumes normal operation, where the Crtc health check, offset sampling,
+    log maintenance and adjustments run as separate tasks. With several Crtcs each has its own health, sampling
+    and adjust task.
     """
     # Some initialization
     check_running() # Check if hipat_control is already running.
-    shelvefile()    # Creates and populates a shelvefile if none exists.
+    devices = create_devices()
+    shelvefile(devices)     # Loads the state store and populates it if it is empty.
     
-    # Making sure the Crtc is functional.
-    ser = Crtc()
-    crtc_restart(ser)           # Check to see if the Crtc has restarted, this affects frequency adjust
-    ser.check_crtc()     
+    # Making sure the Crtcs are functional, they are started at the same time.
+    if len(devices) == 1:
+        start_device(devices[0], devices)
+    else:
+        starting = [threading.Thread(target=start_device, args=(device, devices)) for device in devices]
+        for thread in starting:
+            thread.start()
+        for thread in starting:
+            thread.join()
+        if all(device.failed for device in devices):
+            sys.exit()
+    if config['capture_file']:
+        start_capture(devices)  # After the start, so the state recorded holds the calibration of the Crtcs
+    if config['control_socket']:
+        start_control_socket(devices)
         
     #Normal operation is resumed
     logfile.info("Normal operation is resumed")
-    while(True):
-        ser.check_crtc()
-        offset = check_offset.get_quality_offset()
-        check_file_lengths(200) 
-        if not (-1 < offset <1):
-            logfile.info("Offset: {0}".format(offset))
-            make_adjust(ser, offset)
-            if config['freq_adj'] == True:
-                #Make a frequency adjust at the same time
-                total_steps = ser.freq_adj(False, offset)
-                logfile.info("Total freq_adj steps: {0}".format(total_steps))
-            logfile.info("Normal operation is resumed")
-        time.sleep(60)
+    tasks = Scheduler()
+    tasks.add('maintenance', lambda: check_file_lengths(config['log_max_lines']), 60)
+    tasks.add('config', reload_config, 10)
+    for device in devices:
+        name = '' if len(devices) == 1 else ' ' + device.crtc.refclock
+        tasks.add('sampling' + name, lambda device=device: sample_device(device), 0)
+        tasks.add('health' + name, lambda device=device: check_crtc(device, devices), config['health_interval'])
+        #A single Crtc is adjusted from the main thread, several from their own threads
+        tasks.add('adjust' + name, lambda device=device: adjust(device.crtc, device.state), 1, thread=len(devices) > 1)
+    tasks.run()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,38 +1,219 @@
 #!/usr/bin/env python
 
 """logging.py handles logging of system messages from the HiPAT system. Logging.py is called and a logger is returned.
+The loggers only put their records on a queue, one listener thread writes them to errors.log and the terminal, so
+logging never holds up the sampling or the serial timing.
 """
 
 
+import atexit
 import logging
+import logging.handlers
 import os
 import sys
 import datetime
+import threading
+import Queue
 from config import config
 
-def init_logger(name):
-    """init_logger creates a logger that is returned. It will set up a file logger and a terminal output.
-    name: what name to tag the log output with. This is used to reflect what function requests the log.
+file_handler = None     # errors.log handler shared by every logger, so only one handler rotates the file
+queue_handler = None    # Handler of every logger, puts the records on the queue of the listener
+listener = None         # QueueListener writing the records to errors.log and the terminal
+init_lock = threading.Lock()
+STOP = object()         # Put on the queue to stop the listener
+trimmed_sizes = {}      # Size of every file the last time trim_tail found it within its limits
+
+class BoundedFileHandler(logging.handlers.RotatingFileHandler):
+    """A RotatingFileHandler that also rotates when the file reaches max_lines lines."""
     
-    returns: logger, the object that is used to log.
+    def __init__(self, filename, max_bytes, max_lines, backup_count=1):
+        """filename: file to log to.
+        max_bytes: size in bytes the file is rotated at.
+        max_lines: number of lines the file is rotated at.
+        backup_count: number of rotated files kept, e.g. errors.log.1
+        """
+        logging.handlers.RotatingFileHandler.__init__(self, filename, maxBytes=max_bytes, backupCount=backup_count)
+        self.max_lines = max_lines
+        with open(filename, 'rb') as f:     # The file is at most max_bytes, so counting its lines once is cheap
+            self.lines = f.read().count('\n')
+    
+    def shouldRollover(self, record):
+        if self.lines >= self.max_lines:
+            return 1
+        return logging.handlers.RotatingFileHandler.shouldRollover(self, record)
+    
+    def doRollover(self):
+        logging.handlers.RotatingFileHandler.doRollover(self)
+        self.lines = 0
+    
+    def emit(self, record):
+        logging.handlers.RotatingFileHandler.emit(self, record)
+        self.lines += self.format(record).count('\n') + 1     # A traceback adds several lines
+
+def trim_tail(path, max_lines, max_bytes, block_size=4096):
+    """Keeps only the last max_lines lines of a file, and never more than max_bytes. The file is read backwards 
+    from the end in blocks, so at most max_bytes are read no matter how large the file is. If the file hasn't changed 
+    since it was last found within the limits, nothing is read. The file is rewritten in place so programs appending 
+    to it keep writing to the same file.
+    
+    path: file to trim.
+    max_lines: number of lines to keep.
+    max_bytes: maximum size to keep.
+    returns: True if the file was trimmed.
     """
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    # create file handler which logs even debug messages
-    fh = logging.FileHandler(os.path.join(config['temporary_storage'],'errors.log'))
-    fh.setLevel(logging.WARNING)    #Default level for file logging set to WARNING
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    if trimmed_sizes.get(path) == size:
+        return False
+    
+    with open(path, 'r+b') as f:
+        #Read blocks from the end until max_lines + 1 line breaks or max_bytes are found
+        tail = ''
+        position = size
+        while position > 0 and tail.count('\n') <= max_lines and len(tail) < max_bytes:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+        
+        #A line break at the very end ends the last line, it doesn't start a new one
+        breaks = [index for index, character in enumerate(tail) if character == '\n']
+        if breaks and breaks[-1] == len(tail) - 1:
+            breaks = breaks[:-1]
+        start = 0
+        if len(breaks) >= max_lines:
+            start = breaks[len(breaks) - max_lines] + 1
+        if len(tail) - start > max_bytes:   # Keep whole lines within max_bytes
+            cut = tail.find('\n', len(tail) - max_bytes)
+            start = cut + 1 if cut >= 0 else len(tail) - max_bytes
+        
+        if position == 0 and start == 0:    # The whole file is within the limits
+            trimmed_sizes[path] = size
+            return False
+        f.seek(0)
+        f.write(tail[start:])
+        f.truncate()
+        trimmed_sizes[path] = f.tell()
+    return True
+
+class QueueHandler(logging.Handler):
+    """Backport of the QueueHandler of Python 3. Records are put on a queue and written by a QueueListener, so the 
+    thread logging never waits for a file or the terminal.
+    """
+    
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+    
+    def prepare(self, record):
+        """Merges the message with its arguments, since they may change before the record is written. The rest of the
+        formatting, e.g. the time stamp, is done by the listener.
+        
+        returns: the record to put on the queue.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:     # The traceback is formatted while it is still available
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+class QueueListener():
+    """Backport of the QueueListener of Python 3. One thread takes the records from the queue and passes them to
+    the handlers whose level they reach.
+    """
+    
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor, name='logger')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is STOP:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+    
+    def stop(self):
+        """Writes the records still on the queue and stops the thread."""
+        if self.thread is not None:
+            self.queue.put_nowait(STOP)
+            self.thread.join()
+            self.thread = None
+
+class DeviceLogger(logging.LoggerAdapter):
+    """DeviceLogger prefixes every message with the name of a device, e.g. one of several Crtcs."""
+    
+    def __init__(self, logger, device):
+        logging.LoggerAdapter.__init__(self, logger, {'device': device})
+    
+    def process(self, msg, kwargs):
+        return '{0}: {1}'.format(self.extra['device'], msg), kwargs
+    
+    def debug(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG):     # The prefix is only added to records that are written
+            logging.LoggerAdapter.debug(self, msg, *args, **kwargs)
+    
+    warn = logging.LoggerAdapter.warning
+
+def start_listener():
+    """Creates the handlers writing errors.log and the terminal output, and the thread writing to them.
+    
+    returns: None
+    """
+    global file_handler, queue_handler, listener
+    # create file handler which logs warnings, it is bounded in size and lines and shared by all loggers
+    file_handler = BoundedFileHandler(os.path.join(config['temporary_storage'],'errors.log'),
+                                      config['log_max_bytes'], config['log_max_lines'],
+                                      config['log_backup_count'])
+    file_handler.setLevel(logging.WARNING)    #Default level for file logging set to WARNING
     # create console handler with a higher log level
     ch = logging.StreamHandler(sys.stdout)
     ch.setLevel(logging.INFO)       #Default level for console logging set to INFO
     # create formatter and add it to the handlers
     formatter = logging.Formatter('%(asctime)s-%(levelname)s-%(message)s','%Y-%m-%d %H:%M:%S') #%(name)s is commented out
     ch.setFormatter(formatter)
-    fh.setFormatter(formatter)
-    # add the handlers to logger
-    logger.addHandler(ch)
-    logger.addHandler(fh)
+    file_handler.setFormatter(formatter)
+    listener = QueueListener(Queue.Queue(), ch, file_handler)
+    listener.start()
+    atexit.register(listener.stop)  # The queued records are written before the program exits
+    queue_handler = QueueHandler(listener.queue)
+    return
+
+def init_logger(name):
+    """init_logger creates a logger that is returned. Its records are written to a file logger and a terminal 
+    output by the listener thread. The logger is set to the lowest level of the handlers, so a record no handler 
+    writes is dropped before its message is formatted. Calling init_logger again with the same name returns the 
+    same logger without adding another handler.
+    name: what name to tag the log output with. This is used to reflect what function requests the log.
+    
+    returns: logger, the object that is used to log.
+    """
+    with init_lock:
+        if listener is None:
+            start_listener()
+        logger = logging.getLogger(name)
+        if queue_handler not in logger.handlers:
+            logger.addHandler(queue_handler)
+        logger.setLevel(min(handler.level for handler in listener.handlers))
     
     #Create a running_output.txt file
     open(os.path.join(config['temporary_storage'],'running_output.txt'), 'a').close()
     
-    return logger
\ No newline at end of file
+    return logger
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""metrics.py collects counters, timings and histograms from the hot paths of HiPAT and exports them to
+temporary storage, either as a Prometheus textfile (for the node_exporter textfile collector) or as JSON.
+Recording a value is a dict update under a lock, so it can be done on every serial command and ntpd query.
+
+Usage:
+    metrics.count('serial_commands_total')
+    with metrics.timer('ntpd_query_seconds'):
+        ...
+    metrics.export()
+"""
+
+import json
+import os
+import threading
+import clock
+from config import config
+
+ADJUSTMENT_BUCKETS = (1, 2, 5, 10, 50, 100, 1000, 10000)   # Milliseconds adjusted
+STEP_BUCKETS = (10, 100, 1000, 5000, 10000, 20000)          # Frequency adjustment steps
+SAMPLE_BUCKETS = (3, 5, 8, 11, 15, 20, 30, 50, 100)         # Samples before get_quality_offset is confident
+
+export_lock = threading.Lock()  # The device threads export at the same time, and would share the temporary file
+
+class Timer():
+    """Timer measures the seconds spent in a with block and records them in metrics."""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock.time()   # The monotonic clock of python 2 only counts in clock ticks
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, clock.time() - self.start)
+        return False
+
+class Metrics():
+    """Metrics holds every value recorded in the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # Name: total
+        self.gauges = {}        # Name: latest value
+        self.timings = {}       # Name: [count, sum of seconds, max seconds]
+        self.histograms = {}    # Name: [buckets, count per bucket, count, sum], the last count is above the buckets
+
+    def count(self, name, amount=1):
+        """Adds amount to a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        """Sets a gauge to its latest value."""
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        """Records a duration in seconds."""
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+
+    def timer(self, name):
+        """returns: context manager recording the seconds spent in it."""
+        return Timer(self, name)
+
+    def histogram(self, name, value, buckets):
+        """Records value in the first bucket it is less than or equal to.
+
+        buckets: sorted upper bounds of the buckets, only used the first time name is recorded.
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [tuple(buckets), [0] * (len(buckets) + 1), 0, 0.0]
+            index = 0
+            while index < len(histogram[0]) and value > histogram[0][index]:
+                index += 1
+            histogram[1][index] += 1
+            histogram[2] += 1
+            histogram[3] += value
+
+    def snapshot(self):
+        """returns: dict with a copy of every value."""
+        with self.lock:
+            return {'time': clock.time(),
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'timings': dict((name, {'count': count, 'sum': total, 'max': maximum})
+                                    for name, (count, total, maximum) in self.timings.items()),
+                    'histograms': dict((name, {'buckets': list(buckets), 'counts': list(counts), 'count': count, 'sum': total})
+                                       for name, (buckets, counts, count, total) in self.histograms.items())}
+
+    def prometheus(self, prefix='hipat_'):
+        """returns: the values in the Prometheus text format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines += ['# TYPE {0}{1} counter'.format(prefix, name), '{0}{1} {2}'.format(prefix, name, value)]
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines += ['# TYPE {0}{1} gauge'.format(prefix, name), '{0}{1} {2}'.format(prefix, name, value)]
+        for name, timing in sorted(snapshot['timings'].items()):
+            lines += ['# TYPE {0}{1} summary'.format(prefix, name),
+                      '{0}{1}_count {2}'.format(prefix, name, timing['count']),
+                      '{0}{1}_sum {2:.6f}'.format(prefix, name, timing['sum']),
+                      '# TYPE {0}{1}_max gauge'.format(prefix, name),
+                      '{0}{1}_max {2:.6f}'.format(prefix, name, timing['max'])]
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            lines.append('# TYPE {0}{1} histogram'.format(prefix, name))
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                cumulative += count
+                lines.append('{0}{1}_bucket{{le="{2}"}} {3}'.format(prefix, name, bound, cumulative))
+            lines += ['{0}{1}_count {2}'.format(prefix, name, histogram['count']),
+                      '{0}{1}_sum {2}'.format(prefix, name, histogram['sum'])]
+        lines.append('# TYPE {0}metrics_timestamp_seconds gauge'.format(prefix))
+        lines.append('{0}metrics_timestamp_seconds {1:.3f}'.format(prefix, snapshot['time']))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, directory, format='prometheus'):
+        """Writes the values to hipat_metrics.prom or hipat_metrics.json in directory. The file is replaced
+        atomically, so a collector never reads a half written file. Exports are made one at a time.
+
+        format: "prometheus" or "json".
+        returns: path of the file written.
+        """
+        if format == 'json':
+            path = os.path.join(directory, 'hipat_metrics.json')
+            data = json.dumps(self.snapshot(), sort_keys=True)
+        else:
+            path = os.path.join(directory, 'hipat_metrics.prom')
+            data = self.prometheus()
+        temporary = path + '.tmp'
+        with export_lock:
+            with open(temporary, 'w') as f:
+                f.write(data)
+            os.rename(temporary, path)
+        return path
+
+registry = Metrics()    # Metrics of this process
+
+def count(name, amount=1):
+    registry.count(name, amount)
+
+def gauge(name, value):
+    registry.gauge(name, value)
+
+def observe(name, seconds):
+    registry.observe(name, seconds)
+
+def timer(name):
+    return registry.timer(name)
+
+def histogram(name, value, buckets):
+    registry.histogram(name, value, buckets)
+
+def export():
+    """Exports the metrics of this process to temporary storage in the format set by metrics_format in config,
+    nothing is written if it is "none".
+
+    returns: path of the file written, None if disabled.
+    """
+    if config['metrics_format'] == 'none':
+        return None
+    return registry.export(config['temporary_storage'], config['metrics_format'])
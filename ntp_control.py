@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""ntp_control.py is a small NTP control protocol (mode 6) client used to talk to the local ntpd.
+It keeps one UDP socket open and reads the peer variables directly, replacing the need to run ntpq
+and parse its output for every sample.
+
+The client implements the two requests HiPAT needs:
+- READSTAT (opcode 1): returns the association ids of all peers.
+- READVAR (opcode 2): returns the variables of a single association.
+"""
+
+import socket
+import struct
+import random
+import clock
+
+NTP_VERSION = 2             # ntpq also sends version 2 for control messages
+MODE_CONTROL = 6
+OP_READSTAT = 1
+OP_READVAR = 2
+HEADER = struct.Struct('!BBHHHHH')  # li_vn_mode, r_e_m_op, sequence, status, association, offset, count
+NTP_EPOCH = 2208988800      # seconds between 1900-01-01 and 1970-01-01
+
+class NtpControlError(Exception):
+    pass
+
+def _build_packet(opcode, sequence, association=0, data=''):
+    """Builds a control message, the data is padded to a multiple of 4 bytes.
+
+    returns: packet as a string.
+    """
+    header = HEADER.pack((NTP_VERSION << 3) | MODE_CONTROL, opcode, sequence, 0, association, 0, len(data))
+    padding = '\0' * (-len(data) % 4)
+    return header + data + padding
+
+def parse_variables(data):
+    """Parses the text returned by READVAR into a dictionary. Values are kept as strings, quotes are removed.
+
+    data: string on the form 'name=value, name="value",\r\n...'
+    returns: dict with variable names as keys.
+    """
+    variables = {}
+    for item in data.replace('\r\n', '').split(','):
+        if '=' not in item:
+            continue
+        name, value = item.split('=', 1)
+        variables[name.strip()] = value.strip().strip('"')
+    return variables
+
+def _ntp_timestamp(value):
+    """Converts an ntpd hex timestamp (0xSSSSSSSS.FFFFFFFF) to unix time.
+
+    returns: float with unix time, None if the timestamp is zero.
+    """
+    seconds, _, fraction = value.partition('.')
+    seconds = int(seconds, 16)
+    if seconds == 0:
+        return None
+    fraction = int(fraction, 16) / 4294967296.0 if fraction else 0.0
+    return seconds - NTP_EPOCH + fraction
+
+def peer_record(variables, now=None):
+    """Converts the raw READVAR variables into the same fields the ntpq -pn table shows.
+    Values are formatted the way ntpq prints them so get_offset can treat both backends alike.
+
+    variables: dict returned by parse_variables.
+    now: unix time used when calculating "when", default is the current time.
+    returns: dict with ref_server, refid, st, t, when, poll, reach, delay, offset and jitter.
+    """
+    if now is None:
+        now = clock.time()
+
+    # when is the time since the last packet was received, ntpq shows '-' if nothing is received.
+    when = '-'
+    for name in ('rec', 'reftime'):
+        if name in variables:
+            timestamp = _ntp_timestamp(variables[name])
+            if timestamp is not None:
+                when = str(max(0, int(now - timestamp)))
+                break
+
+    # ntpq shows the lowest of the host and peer poll exponents
+    polls = [int(variables[name]) for name in ('hpoll', 'ppoll') if name in variables]
+    poll = str(2 ** min(polls)) if polls else '-'
+
+    # ntpd reports reach in hex, ntpq shows it in octal
+    reach = variables.get('reach', '0')
+    reach = '{0:o}'.format(int(reach, 16) if reach.startswith('0x') else int(reach))
+
+    return {'ref_server': variables.get('srcadr', ''),
+            'refid': variables.get('refid', ''),
+            'st': variables.get('stratum', ''),
+            't': 'l' if variables.get('srcadr', '').startswith('127.127.') else 'u',
+            'when': when,
+            'poll': poll,
+            'reach': reach,
+            'delay': variables.get('delay', '0'),
+            'offset': variables.get('offset', '0'),
+            'jitter': variables.get('jitter', variables.get('dispersion', '0'))}
+
+class NtpControl():
+    """NtpControl holds a UDP socket to ntpd and performs control requests over it."""
+
+    def __init__(self, address='127.0.0.1', port=123, timeout=1.0, retries=2):
+        """Creates the socket. The socket is connected so only answers from ntpd are received.
+
+        address: address of ntpd, default is localhost.
+        port: port of ntpd.
+        timeout: seconds to wait for every response.
+        retries: number of times a request is resent before giving up.
+        """
+        self.address = (address, port)
+        self.timeout = timeout
+        self.retries = retries
+        self.sequence = random.randint(1, 0xffff)
+        self.sock = None
+        self.requests = 0   # Number of requests sent, useful when comparing to ntpq
+
+    def _socket(self):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.address)
+        return self.sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def request(self, opcode, association=0):
+        """Sends a request and collects all fragments of the response.
+
+        opcode: control opcode, OP_READSTAT or OP_READVAR.
+        association: association id the request is for, 0 for the system.
+        returns: the response data as a string.
+        """
+        for attempt in range(self.retries + 1):
+            self.sequence = (self.sequence % 0xffff) + 1
+            sock = self._socket()
+            self.requests += 1
+            try:
+                sock.send(_build_packet(opcode, self.sequence, association))
+                return self._collect(opcode)
+            except socket.timeout:
+                continue
+            except socket.error as e:   # e.g. connection refused when ntpd is not running
+                self.close()
+                raise NtpControlError('ntpd not answering: {0}'.format(e))
+        raise NtpControlError('ntpd not answering, no response after {0} attempts'.format(self.retries + 1))
+
+    def _collect(self, opcode):
+        """Receives response fragments until the last one ("more" bit cleared) is received.
+
+        returns: the reassembled data.
+        """
+        fragments = {}
+        last_end = None
+        while True:
+            packet = self.sock.recv(4096)
+            if len(packet) < HEADER.size:
+                continue
+            li_vn_mode, r_e_m_op, sequence, status, association, offset, count = HEADER.unpack_from(packet)
+            if sequence != self.sequence or (li_vn_mode & 0x7) != MODE_CONTROL or (r_e_m_op & 0x1f) != opcode:
+                continue    # old or unrelated answer
+            if not r_e_m_op & 0x80:
+                continue    # not a response
+            if r_e_m_op & 0x40:
+                raise NtpControlError('ntpd returned error {0}'.format(status >> 8))
+            fragments[offset] = packet[HEADER.size:HEADER.size + count]
+            if not r_e_m_op & 0x20:     # no more fragments
+                last_end = offset + count
+            if last_end is not None and sum(len(f) for f in fragments.values()) >= last_end:
+                return ''.join(fragments[key] for key in sorted(fragments))
+
+    def associations(self):
+        """returns: list of association ids known by ntpd."""
+        data = self.request(OP_READSTAT)
+        return [struct.unpack_from('!H', data, index)[0] for index in range(0, len(data) - 3, 4)]
+
+    def read_variables(self, association):
+        """returns: dict of the raw variables for association."""
+        return parse_variables(self.request(OP_READVAR, association))
+
+    def peers(self):
+        """Reads all the peers.
+
+        returns: list of dicts formatted as peer_record.
+        """
+        now = clock.time()
+        return [peer_record(self.read_variables(association), now) for association in self.associations()]
+
+    def peer(self, ref_server):
+        """Reads a single peer.
+
+        ref_server: the address of the peer.
+        returns: dict formatted as peer_record, None if ntpd has no such peer.
+        """
+        for association in self.associations():
+            variables = self.read_variables(association)
+            if variables.get('srcadr') == ref_server:
+                return peer_record(variables)
+        return None
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""offset_window.py holds a fixed size sliding window of offsets and keeps its statistics up to date
+as offsets are added and the oldest are pushed out. Mean and standard deviation are updated with
+Welford's method, minimum and maximum with monotonic queues and the median from a sorted copy of the window,
+so the cost of a new sample doesn't grow with the number of samples taken.
+"""
+
+import array
+import bisect
+import collections
+import math
+
+class OffsetWindow():
+    """OffsetWindow is a ring of the last capacity offsets."""
+
+    def __init__(self, capacity=10):
+        """capacity: maximum number of offsets in the window."""
+        self.capacity = capacity
+        self.ring = array.array('d', [0.0] * capacity)
+        self.head = 0           # Index the next offset is written to
+        self.count = 0          # Number of offsets in the window
+        self.added = 0          # Number of offsets ever added, used to expire the min/max queues
+        self.mean = 0.0
+        self.m2 = 0.0           # Sum of squared differences from the mean
+        self.sorted = []        # The window in sorted order, used for the median
+        self.minimum = collections.deque()     # (number, offset) increasing, the first is the minimum
+        self.maximum = collections.deque()     # (number, offset) decreasing, the first is the maximum
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        """returns: True if the window holds capacity offsets."""
+        return self.count == self.capacity
+
+    def push(self, offset):
+        """Adds an offset, if the window is full the oldest offset is removed.
+
+        offset: offset in ms.
+        returns: the removed offset, None if the window wasn't full.
+        """
+        removed = None
+        if self.count == self.capacity:
+            removed = self.ring[self.head]
+            self._remove(removed)
+        self.ring[self.head] = offset
+        self.head = (self.head + 1) % self.capacity
+        self._add(offset)
+        return removed
+
+    def _add(self, offset):
+        self.count += 1
+        delta = offset - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (offset - self.mean)
+        bisect.insort(self.sorted, offset)
+
+        # Values that can never be the minimum or maximum again are dropped from the back of the queues
+        number = self.added
+        self.added += 1
+        while self.minimum and self.minimum[-1][1] >= offset:
+            self.minimum.pop()
+        self.minimum.append((number, offset))
+        while self.maximum and self.maximum[-1][1] <= offset:
+            self.maximum.pop()
+        self.maximum.append((number, offset))
+
+    def _remove(self, offset):
+        self.count -= 1
+        if self.count == 0:
+            self.mean = 0.0
+            self.m2 = 0.0
+        else:
+            delta = offset - self.mean
+            self.mean -= delta / self.count
+            self.m2 = max(self.m2 - delta * (offset - self.mean), 0.0)
+        del self.sorted[bisect.bisect_left(self.sorted, offset)]
+
+        # The removed offset is the oldest in the window, so only the front of the queues can hold it
+        oldest = self.added - self.count - 1
+        if self.minimum and self.minimum[0][0] == oldest:
+            self.minimum.popleft()
+        if self.maximum and self.maximum[0][0] == oldest:
+            self.maximum.popleft()
+
+    def average(self):
+        """returns: the mean of the window."""
+        return self.mean
+
+    def std(self):
+        """returns: the standard deviation of the window, calculated the same way as check_offset.calculate_average_std."""
+        if self.count == 0:
+            return 0.0
+        return math.sqrt(self.m2 / self.count)
+
+    def min(self):
+        """returns: the smallest offset in the window, None if it is empty."""
+        return self.minimum[0][1] if self.count else None
+
+    def max(self):
+        """returns: the largest offset in the window, None if it is empty."""
+        return self.maximum[0][1] if self.count else None
+
+    def median(self):
+        """returns: the median of the window, None if it is empty."""
+        if self.count == 0:
+            return None
+        middle = self.count // 2
+        if self.count % 2:
+            return self.sorted[middle]
+        return (self.sorted[middle - 1] + self.sorted[middle]) / 2.0
+
+    def __str__(self):
+        return str(self.values())
+    
+    def values(self):
+        """returns: list of the offsets in the window, oldest first."""
+        start = (self.head - self.count) % self.capacity
+        return [self.ring[(start + index) % self.capacity] for index in range(self.count)]
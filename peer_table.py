@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""peer_table.py reads all of ntpd's peers at once and keeps the result as a snapshot.
+The snapshot is reused until the first peer is expected to be updated by ntpd again, or at most max_ttl seconds,
+so every reader in one control loop iteration sees the same consistent readings of the refclock and the reference.
+"""
+
+import collections
+import re
+import subprocess
+import threading
+import clock
+import capture
+import metrics
+import ntp_control
+
+#One peer, the fields are the columns of ntpq -pn and are kept as the strings ntpq shows.
+Peer = collections.namedtuple('Peer', 'ref_server refid st t when poll reach delay offset jitter')
+
+#One line of ntpq -pn, the first character is the tally code.
+NTPQ_LINE = re.compile('^[ *#o+x.\-]?(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s*$', re.MULTILINE)
+
+def seconds(value):
+    """Converts a when or poll column to seconds, ntpq uses m: minutes, h: hours, d: days for large values.
+
+    returns: float with seconds, 0 if the value is '-'.
+    """
+    if value == '-':
+        return 0.0
+    elif value[-1] == 'm':
+        return float(value[:-1]) * 60
+    elif value[-1] == 'h':
+        return float(value[:-1]) * 3600
+    elif value[-1] == 'd':
+        return float(value[:-1]) * 86400
+    return float(value)
+
+def parse_ntpq(output):
+    """Parses the whole ntpq -pn table in one pass.
+
+    returns: list of Peer.
+    """
+    return [Peer(*match) for match in NTPQ_LINE.findall(output) if match[0] != 'remote']
+
+class PeerTable():
+    """PeerTable holds the latest snapshot of the peers."""
+
+    def __init__(self, backend='control', client=None, max_ttl=8.0, ntpq_command='ntpq'):
+        """backend: "control" reads the peers with the NTP control client, "ntpq" runs ntpq -pn.
+        client: NtpControl used by the control backend.
+        max_ttl: maximum age in seconds of a snapshot before it is read again.
+        ntpq_command: command run by the ntpq backend, -pn is added.
+        """
+        self.backend = backend
+        self.ntpq_command = ntpq_command.split()
+        self.client = client
+        self.max_ttl = max_ttl
+        self.peers = {}         # Peer records by ref_server
+        self.time = None        # Time the snapshot was taken
+        self.expires = 0        # Time the snapshot must be read again
+        self.queries = 0        # Number of times ntpd has been queried
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.RLock()  # Only one thread queries ntpd at a time, they share the client
+
+    def _read(self):
+        """Reads all peers from ntpd.
+
+        returns: list of Peer.
+        """
+        self.queries += 1
+        metrics.count('ntpd_queries_total')
+        if self.backend == 'control':
+            try:
+                with metrics.timer('ntpd_query_seconds'):
+                    return [Peer(**record) for record in self.client.peers()]
+            except ntp_control.NtpControlError:
+                metrics.count('ntpd_control_failures_total')    # Fall back to ntpq
+        with metrics.timer('ntpd_query_seconds'):
+            return parse_ntpq(subprocess.check_output(self.ntpq_command + ['-pn']))
+
+    def refresh(self):
+        """Reads a new snapshot. It expires when the first peer is due to be polled by ntpd, but lives at most max_ttl.
+
+        returns: None
+        """
+        with self.refresh_lock:
+            peers = self._read()
+        capture.record('peers', [tuple(peer) for peer in peers])
+        now = clock.time()
+        ttl = self.max_ttl
+        for peer in peers:
+            if peer.when != '-' and peer.poll != '-':
+                remaining = seconds(peer.poll) - seconds(peer.when)
+                if remaining > 0:   # Peers overdue for an update are not expected at a known time
+                    ttl = min(ttl, remaining)
+        with self.lock:
+            self.peers = dict((peer.ref_server, peer) for peer in peers)
+            self.time = now
+            self.expires = now + max(ttl, 0)
+        return
+
+    def fresh(self):
+        """returns: True if the snapshot has not expired."""
+        return clock.time() < self.expires
+
+    def snapshot(self):
+        """returns: (time, dict of Peer by ref_server), read again if the snapshot has expired."""
+        if not self.fresh():
+            with self.refresh_lock:
+                if not self.fresh():    # Another thread may have read it while this one waited
+                    self.refresh()
+        with self.lock:
+            return self.time, self.peers
+
+    def latest(self, ref_server):
+        """returns: (time the snapshot was taken, Peer of ref_server) from the snapshot already read, even if it has
+        expired. The time is None if no snapshot has been read."""
+        with self.lock:
+            return self.time, self.peers.get(ref_server)
+
+    def get(self, ref_server):
+        """returns: (time the snapshot was taken, Peer of ref_server), the Peer is None if ntpd has no such server."""
+        snapshot_time, peers = self.snapshot()
+        return snapshot_time, peers.get(ref_server)
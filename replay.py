@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""replay.py replays a capture recorded by hipat_control (capture_file in config) offline.
+
+The control loop of one Crtc is run in a single thread on a VirtualClock, so every sleep is skipped and a day of
+captured operation replays in seconds. ntpd is answered from the captured peer snapshots, at the times they were
+captured, and the Crtc from the captured lines. The commands sent are answered like the Crtc answers them.
+The replay is open loop: ntpd and the Crtc don't react to what the replay does. With the captured config the
+decisions are the captured ones, with other settings the replay shows the decisions they would have made from the
+same measurements.
+
+Usage:
+    python replay.py /mnt/tmpfs/capture.gz
+    python replay.py /mnt/tmpfs/capture.gz --set std_start_limit=0.5 --set estimator=kalman
+"""
+
+import argparse
+import bisect
+import collections
+import heapq
+import re
+import sys
+import tempfile
+import time
+import clock
+import capture
+from config import config
+
+ANSWER = re.compile('PSRFTXT,(ACK|Y|N)\s*$')   # Lines answering a command, they are made up by ReplayPort
+COMMAND_LENGTHS = {'t': 9, 'd': 8}  # Number of digits following the command letter
+
+class ReplayFinished(Exception):
+    """Raised when the replay reaches the end of the capture."""
+    pass
+
+class Capture():
+    """Capture is a capture file loaded for replay."""
+
+    def __init__(self, path):
+        self.header = None
+        self.times = []         # Time of every peer snapshot
+        self.snapshots = []     # Peer snapshots as lists of tuples
+        self.lines = collections.defaultdict(list)  # (time, line) by refclock
+        self.decisions = []     # (time, refclock, offset)
+        self.commands = []      # (time, refclock, text)
+        for record_time, kind, data in capture.read(path):
+            if kind == 'start':
+                self.header = data
+                self.started = record_time
+            elif kind == 'peers':
+                self.times.append(record_time)
+                self.snapshots.append(data)
+            elif kind == 'line':
+                self.lines[data[0]].append((record_time, data[1]))
+            elif kind == 'decision':
+                self.decisions.append((record_time,) + tuple(data))
+            elif kind == 'command':
+                self.commands.append((record_time,) + tuple(data))
+        if self.header is None or not self.times:
+            raise ValueError('{0} holds no capture to replay'.format(path))
+        #Snapshots are recorded by several threads, and the one read before the capture started is recorded first
+        ordered = sorted(zip(self.times, self.snapshots), key=lambda entry: entry[0])
+        self.times = [entry[0] for entry in ordered]
+        self.snapshots = [entry[1] for entry in ordered]
+
+class ReplayNtpd():
+    """ReplayNtpd answers like NtpControl.peers with the captured snapshots. A request is answered with the first
+    snapshot captured at or after the current time, and the clock is moved forward to when it was captured. So the
+    peers are read at the times of the capture, and the samples are the captured ones.
+    """
+
+    def __init__(self, capture, clock):
+        """clock: the VirtualClock of the replay."""
+        self.capture = capture
+        self.clock = clock
+        self.requests = 0
+
+    def peers(self):
+        """returns: list of dicts formatted as ntp_control.peer_record."""
+        import peer_table
+        index = bisect.bisect_left(self.capture.times, self.clock.time())
+        if index == len(self.capture.times):
+            raise ReplayFinished()
+        self.requests += 1
+        self.clock.advance(self.capture.times[index] - self.clock.time())
+        return [dict(zip(peer_table.Peer._fields, values)) for values in self.capture.snapshots[index]]
+
+class ReplayReader():
+    """ReplayReader supplies the captured lines of one Crtc like a SerialReader, as the virtual clock reaches them.
+    Captured answers to commands are left out, the answers are made up for the commands of the replay instead.
+    """
+
+    def __init__(self, lines, size=256):
+        """lines: list of (time, line) captured from the Crtc."""
+        self.recorded = [(line_time, line) for line_time, line in lines if not ANSWER.search(line)]
+        self.index = 0          # Next recorded line
+        self.answers = []       # Heap of (time, line) answers due
+        self.lines = collections.deque(maxlen=size)    # Entries of (sequence, timestamp, line)
+        self.sequence = 0
+        self.listeners = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def answer(self, line, delay):
+        """Sends line after delay seconds."""
+        heapq.heappush(self.answers, (clock.time() + delay, line))
+
+    def next_due(self):
+        """returns: time of the next line, None if there are no more."""
+        times = [self.answers[0][0]] if self.answers else []
+        if self.index < len(self.recorded):
+            times.append(self.recorded[self.index][0])
+        return min(times) if times else None
+
+    def deliver(self, now):
+        """Receives every line due at now, called when the virtual clock moves."""
+        while True:
+            due = self.next_due()
+            if due is None or due > now:
+                return
+            if self.answers and self.answers[0][0] == due:
+                line_time, line = heapq.heappop(self.answers)
+            else:
+                line_time, line = self.recorded[self.index]
+                self.index += 1
+            self.sequence += 1
+            self.lines.append((self.sequence, line_time, line))
+            for listener in self.listeners:
+                listener(line_time, line)
+
+    def get_line(self, cursor, timeout=0):
+        """Returns the first line after cursor, the clock is moved forward to it if it is due within timeout.
+
+        returns: (sequence, timestamp, line), None if no line is due within timeout.
+        """
+        deadline = clock.time() + timeout
+        while True:
+            self.deliver(clock.time())
+            for entry in self.lines:
+                if entry[0] > cursor:
+                    return entry
+            due = self.next_due()
+            if due is None or due > deadline:
+                clock.sleep(deadline - clock.time())
+                return None
+            clock.sleep(due - clock.time())
+
+    def latest(self):
+        """returns: the latest line as (sequence, timestamp, line), None if none has been received."""
+        return self.lines[-1] if self.lines else None
+
+class ReplayPort():
+    """ReplayPort stands in for the serial port of a replayed Crtc. Every complete command is answered like the
+    Crtc answers it, after latency seconds.
+    """
+
+    def __init__(self, reader, latency=0.1):
+        self.reader = reader
+        self.latency = latency
+        self.timeout = 3
+        self.pending = ''       # Command being written
+
+    def write(self, text):
+        for character in text:
+            if self.pending:
+                self.pending += character
+                if len(self.pending) <= COMMAND_LENGTHS[self.pending[0]]:
+                    continue
+                self.pending = ''
+                self.reader.answer('$PSRFTXT,ACK', self.latency)
+            elif character in COMMAND_LENGTHS:
+                self.pending = character
+            elif character == 'p':
+                self.reader.answer('$PSRFTXT,N', self.latency)
+            elif character != '1':  # 1 only unblocks the Crtc, it isn't answered
+                self.reader.answer('$PSRFTXT,ACK', self.latency)
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+def replay(path, settings=None, refclock=None):
+    """Replays the control loop of one Crtc from a capture.
+
+    path: capture file.
+    settings: dict of config items to use instead of the captured ones.
+    refclock: Crtc to replay, default is the first captured.
+    returns: dict with the capture, the replayed decisions as (time, refclock, offset), the commands sent as
+             (time, refclock, text) and the simulated seconds replayed.
+    """
+    loaded = Capture(path)
+    items = dict(loaded.header['config'])
+    for item in ('temporary_storage', 'capture_file', 'program_path'):
+        items.pop(item, None)
+    config.update(items)
+    config.update({'temporary_storage': tempfile.mkdtemp(prefix='hipat_replay_'), 'metrics_format': 'none'})
+    config.update(settings or {})
+    virtual = clock.VirtualClock(loaded.times[0])
+    clock.install(virtual)
+
+    #The modules read the config when they are imported
+    import check_offset
+    import hipat_control
+    from state_store import get_store
+    store = get_store()
+    for key, value in loaded.header['state'].items():
+        store[key] = value
+    check_offset.peers.client = ReplayNtpd(loaded, virtual)
+    check_offset.peers.backend = 'control'
+    check_offset.peers.expires = 0
+
+    refclock = refclock or loaded.header['refclocks'][0]
+    reader = ReplayReader(loaded.lines[refclock], config['serial_ring_size'])
+    virtual.listeners.append(reader.deliver)
+    port = ReplayPort(reader)
+    device = hipat_control.Device(hipat_control.Crtc('replay', reader=reader, refclock=refclock, ser=port))
+    port.latency = device.crtc.round_trip or port.latency  # Answer as fast as the calibrated Crtc
+    reader.deliver(clock.time())    # The lines received before the capture started
+    recorder = capture.start(None, [refclock])   # The decisions and commands of the replay are kept in memory
+    try:
+        while True:
+            hipat_control.check_crtc(device, [device])
+            hipat_control.sample_offset(device.state, device.crtc)
+            hipat_control.adjust(device.crtc, device.state)
+    except ReplayFinished:
+        pass
+    except SystemExit:      # The Crtc could not be fixed, as in the capture the control loop ends
+        pass
+    finally:
+        capture.stop()
+    return {'capture': loaded,
+            'decisions': [(entry[0],) + tuple(entry[2]) for entry in recorder.records if entry[1] == 'decision'],
+            'commands': [(entry[0],) + tuple(entry[2]) for entry in recorder.records if entry[1] == 'command'],
+            'seconds': clock.time() - loaded.times[0]}
+
+def compare(captured, replayed):
+    """Compares the offsets acted upon in order.
+
+    returns: number of decisions that are identical.
+    """
+    identical = 0
+    for before, after in zip(captured, replayed):
+        if before[2] != after[2]:
+            break
+        identical += 1
+    return identical
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a capture of hipat_control offline.')
+    parser.add_argument('capture', help='capture file recorded with capture_file in config')
+    parser.add_argument('--set', action='append', default=[], metavar='ITEM=VALUE',
+                        help='config item used instead of the captured value, can be given several times')
+    parser.add_argument('--device', help='refclock of the Crtc to replay, default is the first')
+    args = parser.parse_args()
+    settings = dict(setting.split('=', 1) for setting in args.set)
+
+    start = time.time()
+    result = replay(args.capture, settings, args.device)
+    refclock = args.device or result['capture'].header['refclocks'][0]
+    captured = [decision for decision in result['capture'].decisions if decision[1] == refclock]
+    for decision_time, decision_refclock, offset in result['decisions']:
+        print '{0} {1} Offset: {2}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(decision_time)),
+                                          decision_refclock, offset)
+    print 'Replayed {0:.0f} s in {1:.1f} s, {2} decisions, {3} captured, the first {4} identical'.format(
+        result['seconds'], time.time() - start, len(result['decisions']), len(captured),
+        compare(captured, result['decisions']))
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
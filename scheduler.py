@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""scheduler.py runs the tasks of hipat_control independently of each other, each with its own interval.
+A task either gets its own thread, or is run by the thread calling Scheduler.run (the main thread).
+If a task calls sys.exit, every task is stopped and Scheduler.run exits the program.
+"""
+
+import threading
+import clock
+import logger
+
+#initialize the logger
+logfile = logger.init_logger('scheduler')
+
+class Task():
+    """Task is a function that is called every interval seconds."""
+
+    def __init__(self, name, function, interval):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.due = 0            # Time the task is to be run next
+        self.runs = 0           # Number of times the task has run
+        self.duration = 0.0     # Seconds the last run took
+
+    def run(self):
+        """Runs the function once. Exceptions are logged so one failing task doesn't stop the others.
+
+        returns: None
+        """
+        start = clock.time()
+        try:
+            self.function()
+        except Exception:
+            logfile.exception("Task {0} failed".format(self.name))
+        self.runs += 1
+        self.duration = clock.time() - start
+        self.due = clock.time() + self.interval
+        return
+
+class Scheduler():
+    """Scheduler holds the tasks and the threads running them."""
+
+    def __init__(self):
+        self.main_tasks = []    # Tasks run by Scheduler.run
+        self.threads = []
+        self.stopped = threading.Event()
+        self.exit = None        # SystemExit raised by a threaded task
+
+    def add(self, name, function, interval, thread=True):
+        """Adds a task.
+
+        name: name used when logging.
+        function: function called without arguments.
+        interval: seconds from a run has finished until the next is started.
+        thread: True to run the task in its own thread, False to run it from Scheduler.run.
+        returns: the Task.
+        """
+        task = Task(name, function, interval)
+        if thread:
+            worker = threading.Thread(target=self._loop, args=(task,), name=name)
+            worker.daemon = True
+            self.threads.append(worker)
+        else:
+            self.main_tasks.append(task)
+        return task
+
+    def _loop(self, task):
+        while not self.stopped.is_set():
+            try:
+                task.run()
+            except SystemExit as e:     # Only ends this thread, so the main thread is told to exit
+                self.exit = e
+                self.stop()
+                return
+            clock.wait(self.stopped, task.interval)
+
+    def run(self):
+        """Starts the threaded tasks and runs the main thread tasks until stop is called.
+
+        returns: None
+        """
+        for worker in self.threads:
+            worker.start()
+        while not self.stopped.is_set():
+            now = clock.time()
+            for task in self.main_tasks:
+                if task.due <= now:
+                    task.run()
+            if self.main_tasks:
+                clock.wait(self.stopped, max(min(task.due for task in self.main_tasks) - clock.time(), 0))
+            else:
+                clock.wait(self.stopped, 1)
+        if self.exit is not None:
+            raise self.exit
+        return
+
+    def stop(self):
+        self.stopped.set()
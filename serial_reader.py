@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""serial_reader.py keeps a serial port open and reads it from a background thread.
+Incoming bytes are split into lines which are kept in a bounded ring together with the time they arrived.
+Every line gets a sequence number, readers keep their own cursor and consume the lines after it.
+Listeners are called from the thread with every line as it arrives.
+"""
+
+import threading
+import collections
+import time
+import clock
+import logger
+from timeout import monotonic
+
+#initialize the logger
+logfile = logger.init_logger('serial_reader')
+
+class SerialReader(threading.Thread):
+    """SerialReader is the thread reading lines from an open serial port."""
+
+    def __init__(self, ser, size=256):
+        """ser: an open Serial object, the read timeout decides how quickly the thread reacts to stop().
+        size: maximum number of lines kept in the ring.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ser = ser
+        self.lines = collections.deque(maxlen=size)    # Entries of (sequence, timestamp, line)
+        self.condition = threading.Condition()
+        self.sequence = 0       # Sequence number of the last received line
+        self.listeners = []     # Functions called with (timestamp, line) for every received line
+        self.running = False
+        self.buffer = ''        # Bytes received after the last complete line
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                data = self.ser.read(self.ser.inWaiting() or 1)    # Blocks until a byte arrives or the port times out
+            except Exception as e:
+                if self.running:
+                    logfile.warn("Serial read failed: {0}".format(e))
+                    time.sleep(1)
+                continue
+            if not data:
+                continue
+            self.buffer += data
+            if '\n' not in self.buffer:
+                continue
+            now = clock.time()
+            lines = self.buffer.split('\n')
+            self.buffer = lines[-1]     # Keep the incomplete line
+            with self.condition:
+                for line in lines[:-1]:
+                    self.sequence += 1
+                    self.lines.append((self.sequence, now, line.rstrip('\r')))
+                self.condition.notify_all()
+            for listener in self.listeners:
+                for line in lines[:-1]:
+                    try:
+                        listener(now, line.rstrip('\r'))
+                    except Exception:   # A failing listener must not stop the lines from being read
+                        logfile.exception("Serial line listener failed")
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def get_line(self, cursor, timeout=0):
+        """Returns the first line after cursor. If lines have been pushed out of the ring the oldest kept line is returned.
+
+        cursor: sequence number of the last line the caller has consumed.
+        timeout: seconds to wait for a new line if none is available, 0 returns at once.
+        returns: (sequence, timestamp, line), None if no line arrived in time.
+        """
+        deadline = monotonic() + timeout
+        with self.condition:
+            while self.sequence <= cursor:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            oldest = self.lines[0][0]
+            return self.lines[max(cursor + 1 - oldest, 0)]
+
+    def latest(self):
+        """returns: the most recent (sequence, timestamp, line), None if nothing is received yet."""
+        with self.condition:
+            if self.lines:
+                return self.lines[-1]
+            return None
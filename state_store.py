@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""state_store.py keeps the persistent state of HiPAT (average, freq_adj history, serial calibration) in memory.
+The state is read once at startup. Changes are written behind: a burst of changes is collected for flush_delay
+seconds and written as one file. The file is written to a temporary name, synced and renamed over the old one,
+so after a power cut the file is either the old or the new state, never half written.
+"""
+
+import os
+import pickle
+import shelve
+import threading
+import atexit
+from config import config
+import logger
+
+#initialize the logger
+logfile = logger.init_logger('state_store')
+
+class StateStore():
+    """StateStore is a dictionary of state that is flushed to a file."""
+
+    def __init__(self, path, flush_delay=5.0, legacy_path=None):
+        """Loads the state from path.
+
+        path: file the state is stored in.
+        flush_delay: seconds changes are collected before they are written.
+        legacy_path: shelve file the state is copied from if path doesn't exist yet.
+        """
+        self.path = path
+        self.flush_delay = flush_delay
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()     # Only one flush writes the file at a time
+        self.timer = None       # Pending flush
+        self.dirty = False
+        self.state = self._load(legacy_path)
+        atexit.register(self.flush)
+
+    def _load(self, legacy_path):
+        """returns: the stored state, an empty dict if nothing could be read."""
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    return pickle.load(f)
+            except Exception as e:
+                logfile.warn("State file {0} unreadable, starting with an empty state: {1}".format(self.path, e))
+                return {}
+        if legacy_path and any(os.path.isfile(legacy_path + suffix) for suffix in ('', '.db', '.dat')):
+            try:
+                db = shelve.open(legacy_path, 'r')
+                state = dict(db)
+                db.close()
+                logfile.info("State copied from {0}".format(legacy_path))
+                return state
+            except Exception as e:
+                logfile.warn("Could not read {0}: {1}".format(legacy_path, e))
+        return {}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.state
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.state[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.state[key] = value
+            self._changed()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.state.get(key, default)
+
+    def setdefault(self, key, value):
+        """Sets key to value if it is not set.
+
+        returns: the value of key.
+        """
+        with self.lock:
+            if key not in self.state:
+                self.state[key] = value
+                self._changed()
+            return self.state[key]
+
+    def copy(self):
+        """returns: a deep copy of the state."""
+        with self.lock:
+            return pickle.loads(pickle.dumps(self.state, 2))
+
+    def _changed(self):
+        """Marks the state as changed and schedules a flush, if one isn't already scheduled."""
+        self.dirty = True
+        if self.timer is None:
+            self.timer = threading.Timer(self.flush_delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Writes the state if it has changed. The file is replaced with an atomic rename.
+
+        returns: None
+        """
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return
+                data = pickle.dumps(self.state, 2)
+                self.dirty = False
+            temporary = self.path + '.tmp'
+            try:
+                with open(temporary, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(temporary, self.path)
+            except (IOError, OSError) as e:
+                logfile.warn("Could not write state to {0}: {1}".format(self.path, e))
+                with self.lock:
+                    self.dirty = True
+        return
+
+store = None    # The state store of this process, created by get_store
+store_lock = threading.Lock()
+
+def get_store():
+    """Returns the state store of the process, it is loaded the first time it is used.
+
+    returns: StateStore
+    """
+    global store
+    with store_lock:
+        if store is None:
+            store = StateStore(os.path.join(config['temporary_storage'], 'state.pickle'),
+                               config['state_flush_delay'],
+                               os.path.join(config['temporary_storage'], 'shelvefile'))
+    return store
@@ -0,0 +1,15 @@
+"""The modules of HiPAT are imported from the directory above the tests. temporary_storage is pointed at a new
+temporary directory before any of them is imported, so the tests never write to /mnt/tmpfs.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config
+config.update({'temporary_storage': tempfile.mkdtemp(prefix='hipat_test_'), 'metrics_format': 'none'})
@@ -0,0 +1,100 @@
+"""Tests of combining several references and of their health scores in OffsetSampler."""
+
+import pytest
+import clock
+import check_offset
+import peer_table
+from check_offset import combine_references, weighted_median, OffsetSampler, HEALTH_WEIGHT
+
+START = 1792195200.0
+
+def readings(*peers):
+    """returns: readings of references named a, b, c... from (offset, delay) pairs."""
+    return dict((chr(ord('a') + index), {'offset': offset, 'delay': delay}) for index, (offset, delay) in enumerate(peers))
+
+class Client():
+    """Client stands in for the NTP control client, it answers with a peer record of every server in measured:
+    the time ntpd last received it and the offset measured.
+    """
+
+    def __init__(self, measured):
+        self.measured = measured
+
+    def peers(self):
+        return [{'ref_server': ref, 'refid': '.GPS.', 'st': '1', 't': 'u', 'when': str(int(clock.time() - received)),
+                 'poll': '16', 'reach': '377', 'delay': '1.000', 'offset': str(offset), 'jitter': '0.010'}
+                for ref, (received, offset) in self.measured.iteritems()]
+
+@pytest.fixture
+def virtual(monkeypatch):
+    virtual = clock.VirtualClock(START)
+    old_clock = clock.install(virtual)
+    monkeypatch.setattr(check_offset, 'reference_health', {})
+    yield virtual
+    clock.install(old_clock)
+
+def test_weighted_median():
+    assert weighted_median([(1.0, 1.0), (2.0, 1.0), (3.0, 1.0)]) == 2.0
+    assert weighted_median([(1.0, 1.0), (2.0, 1.0), (3.0, 5.0)]) == 3.0
+
+def test_no_readings():
+    assert combine_references({}) == (None, [])
+
+def test_outlier_is_dropped():
+    consensus, agreeing = combine_references(readings((0.1, 10.0), (0.2, 10.0), (-0.1, 10.0), (5.0, 10.0)), 1.0)
+    assert consensus == 0.1
+    assert sorted(agreeing) == ['a', 'b', 'c']
+
+def test_low_delay_outlier_does_not_win():
+    """The weight of a very short delay is capped at DELAY_RANGE times the median, so it can't outweigh the others."""
+    consensus, agreeing = combine_references(readings((5.0, 0.01), (0.1, 10.0), (0.2, 10.0)), 1.0)
+    assert consensus == 0.2
+    assert sorted(agreeing) == ['b', 'c']
+
+def test_two_references():
+    """With two references the one with the lower delay decides, the other is an outlier beyond the limit."""
+    consensus, agreeing = combine_references(readings((0.5, 20.0), (0.1, 10.0)), 1.0)
+    assert (consensus, sorted(agreeing)) == (0.1, ['a', 'b'])
+    consensus, agreeing = combine_references(readings((3.0, 20.0), (0.1, 10.0)), 1.0)
+    assert (consensus, agreeing) == (0.1, ['b'])
+
+def test_outlier_limit_grows_with_the_spread():
+    """A reference is only an outlier beyond three times the weighted median deviation."""
+    consensus, agreeing = combine_references(readings((0.0, 10.0), (2.0, 10.0), (-2.0, 10.0), (5.0, 10.0)), 1.0)
+    assert consensus == 0.0
+    assert sorted(agreeing) == ['a', 'b', 'c', 'd']
+
+def test_unhealthy_reference_weighs_less(monkeypatch):
+    monkeypatch.setattr(check_offset, 'reference_health', {'a': 0.1})
+    consensus, agreeing = combine_references(readings((3.0, 10.0), (0.1, 10.0)), 1.0)
+    assert (consensus, agreeing) == (0.1, ['b'])
+
+def test_health_is_updated_once_per_poll(virtual, monkeypatch):
+    """Passes reading the same measurement of an outlier don't lower its health score again."""
+    client = Client({'a': (START, 0.1), 'b': (START, 0.2), 'c': (START, 9.0)})
+    monkeypatch.setattr(check_offset, 'peers', peer_table.PeerTable('control', client, 0.0))
+    sampler = OffsetSampler(['a', 'b', 'c'], mode='event', keep=10)
+    health = 1.0
+    for poll in range(3):
+        for second in range(4):
+            virtual.advance(1)
+            sampler._read()
+        health += HEALTH_WEIGHT * (0 - health)
+        assert check_offset.reference_health['c'] == pytest.approx(health)
+        assert check_offset.reference_health['a'] == 1.0
+        client.measured = dict((ref, (clock.time(), offset)) for ref, (received, offset) in client.measured.iteritems())
+    assert sampler.rejected == 3
+
+def test_refclock_and_references_from_one_snapshot(virtual, monkeypatch):
+    """Every query of ntpd moves all offsets, the differential offsets only stay put when they come from one answer."""
+    class MovingClient(Client):
+        def peers(self):
+            for ref, (received, offset) in self.measured.items():
+                self.measured[ref] = (received, offset + 1.0)
+            return Client.peers(self)
+    client = MovingClient({'127.127.20.1': (START, 0.0), 'a': (START, 0.5), 'b': (START, 0.25)})
+    monkeypatch.setattr(check_offset, 'peers', peer_table.PeerTable('control', client, 0.0))
+    sampler = OffsetSampler(['a', 'b'], mode='event', keep=10, refclock='127.127.20.1')
+    virtual.advance(1)
+    readings = sampler._read()
+    assert (readings['a']['offset'], readings['b']['offset']) == (0.5, 0.25)
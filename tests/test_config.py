@@ -0,0 +1,83 @@
+"""Tests of the conversion of config items and of Config.reload."""
+
+import os
+import threading
+import pytest
+import config as config_module
+from config import Config, boolean, positive, not_negative, choice, address_list
+
+def write_config(path, text, mtime):
+    path.write(text)
+    os.utime(str(path), (mtime, mtime))
+
+@pytest.mark.parametrize('value, expected', [('True', True), ('false', False), ('yes', True), ('0', False),
+                                             (True, True)])
+def test_boolean(value, expected):
+    assert boolean(value) is expected
+
+@pytest.mark.parametrize('convert, value', [(boolean, 'maybe'), (positive(int), '0'), (positive(float), '-1.5'),
+                                            (not_negative(int), '-1'), (positive(int), 'ten'),
+                                            (choice('event', 'fixed'), 'random')])
+def test_invalid_values(convert, value):
+    with pytest.raises(ValueError):
+        convert(value)
+
+def test_address_list():
+    assert address_list(' 158.112.160.8, ,10.0.0.1 ') == ['158.112.160.8', '10.0.0.1']
+    assert address_list('') == []
+    assert address_list(('10.0.0.1',)) == ['10.0.0.1']
+
+def test_values_are_converted(tmpdir):
+    path = tmpdir.join('config.txt')
+    write_config(path, 'offset_window: 20\nfreq_adj: "False"\nhipat_references: 10.0.0.1,10.0.0.2\n', 1000)
+    config = Config(str(path))
+    assert (config['offset_window'], config['freq_adj']) == (20, False)
+    assert config['hipat_references'] == ['10.0.0.1', '10.0.0.2']
+    config['offset_window'] = '30'
+    assert config['offset_window'] == 30
+    with pytest.raises(ValueError):
+        config['offset_window'] = '-3'
+    with pytest.raises(ValueError):
+        config['no_such_item'] = '1'
+
+def test_invalid_value_uses_the_default(tmpdir):
+    path = tmpdir.join('config.txt')
+    write_config(path, 'offset_window: -5\nsample_mode: sometimes\n', 1000)
+    config = Config(str(path))
+    defaults = config_module.create_dictionary()
+    assert config['offset_window'] == int(defaults['offset_window'])
+    assert config['sample_mode'] == defaults['sample_mode']
+
+def test_missing_file_uses_the_defaults(tmpdir):
+    config = Config(str(tmpdir.join('missing.txt')))
+    assert config['offset_window'] == int(config_module.create_dictionary()['offset_window'])
+    assert config.reload() == ({}, [])
+
+def test_reload(tmpdir):
+    path = tmpdir.join('config.txt')
+    write_config(path, 'offset_window: 20\nntp_control_port: 123\n', 1000)
+    config = Config(str(path))
+    assert config.reload() == ({}, [])
+
+    #Live items are updated, the others only reported
+    write_config(path, 'offset_window: 40\nntp_control_port: 1123\n', 2000)
+    assert config.reload() == ({'offset_window': 40}, ['ntp_control_port'])
+    assert (config['offset_window'], config['ntp_control_port']) == (40, 123)
+
+    #An unchanged modification time isn't read again
+    write_config(path, 'offset_window: 50\n', 2000)
+    assert config.reload() == ({}, [])
+    assert config['offset_window'] == 40
+
+def test_concurrent_reloads_update_once(tmpdir):
+    path = tmpdir.join('config.txt')
+    write_config(path, 'offset_window: 20\n', 1000)
+    config = Config(str(path))
+    write_config(path, 'offset_window: 40\n', 2000)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(config.reload())) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [({}, [])] * 7 + [({'offset_window': 40}, [])]
@@ -0,0 +1,43 @@
+"""Tests of the control socket of hipat_control."""
+
+import os
+import stat
+import pytest
+import control_socket
+from control_socket import ControlServer, ControlError, query
+
+@pytest.fixture
+def server(tmpdir):
+    path = str(tmpdir.join('hipat_control.sock'))
+    server = ControlServer(path, {'status': lambda: {'offset': -0.25}, 'echo': lambda *words: list(words)})
+    server.start()
+    yield server
+    server.stop()
+
+def test_query(server):
+    assert query(server.path, 'status') == {'offset': -0.25}
+    assert query(server.path, 'echo a b') == ['a', 'b']
+    with pytest.raises(ControlError):
+        query(server.path, 'missing')
+
+def test_permissions_without_changing_the_umask(tmpdir):
+    umask = os.umask(0o022)
+    try:
+        server = ControlServer(str(tmpdir.join('hipat_control.sock')), {})
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o660
+    server.stop()
+    assert not os.path.exists(server.path)
+
+def test_socket_left_by_an_earlier_run_is_replaced(tmpdir):
+    path = str(tmpdir.join('hipat_control.sock'))
+    tmpdir.join('hipat_control.sock').write('')
+    server = ControlServer(path, {})
+    assert stat.S_ISSOCK(os.stat(path).st_mode)
+    server.stop()
+
+def test_socket_path(monkeypatch):
+    monkeypatch.setitem(control_socket.config, 'control_socket', '')
+    assert control_socket.socket_path() is None
@@ -0,0 +1,62 @@
+"""Tests of the Kalman estimate of the offset and drift."""
+
+import random
+import pytest
+from drift_estimator import DriftEstimator, MINIMUM_NOISE
+
+def test_first_measurement_sets_the_state():
+    estimator = DriftEstimator()
+    estimator.update(1000.0, 5.0, 0.5)
+    assert (estimator.time, estimator.offset, estimator.drift, estimator.samples) == (1000.0, 5.0, 0.0, 1)
+    assert estimator.estimate() == 5.0
+    assert estimator.interval() == pytest.approx(1.96 * 0.5)
+
+def test_noise():
+    estimator = DriftEstimator()
+    assert estimator.noise(0.0, None) == MINIMUM_NOISE
+    assert estimator.noise(0.3, 10.0) == pytest.approx(0.3)
+    #Half the delay in excess of the lowest delay is added to the jitter
+    assert estimator.noise(0.3, 10.8) == pytest.approx(0.5)
+    assert estimator.noise(0.3, 8.0) == pytest.approx(0.3)
+    assert estimator.min_delay == 8.0
+
+@pytest.mark.parametrize('drift', [0.0, 0.002, -0.005])
+def test_converges_to_the_offset_and_drift(drift):
+    """With measurements every 16 s the estimate follows a drifting offset and the interval covers it."""
+    generator = random.Random(7)
+    estimator = DriftEstimator()
+    for sample in range(200):
+        time = 1000.0 + 16 * sample
+        estimator.update(time, -3.0 + drift * (time - 1000.0) + generator.gauss(0.0, 0.1), 0.1, 12.0)
+    true_offset = -3.0 + drift * (estimator.time - 1000.0)
+    assert estimator.drift == pytest.approx(drift, abs=1e-3)
+    assert abs(estimator.estimate() - true_offset) <= estimator.interval()
+    assert estimator.interval() < 0.1
+
+def test_interval_narrows_and_widens_with_prediction():
+    estimator = DriftEstimator()
+    intervals = []
+    for sample in range(20):
+        estimator.update(1000.0 + 16 * sample, 1.0, 0.2)
+        intervals.append(estimator.interval())
+    assert intervals == sorted(intervals, reverse=True)
+    assert estimator.interval(estimator.time + 3600) > estimator.interval()
+    assert estimator.estimate(estimator.time + 3600) == pytest.approx(estimator.offset + estimator.drift * 3600)
+
+def test_delayed_measurement_has_less_weight():
+    """A measurement delayed by queueing moves the estimate less than one with the lowest delay."""
+    moves = []
+    for delay in (10.0, 40.0):
+        estimator = DriftEstimator()
+        for sample in range(10):
+            estimator.update(1000.0 + 16 * sample, 0.0, 0.1, 10.0)
+        estimator.update(1160.0, 5.0, 0.1, delay)
+        moves.append(estimator.offset)
+    assert moves[1] < moves[0]
+
+def test_out_of_order_measurement_keeps_the_latest_time():
+    estimator = DriftEstimator()
+    estimator.update(1000.0, 1.0, 0.1)
+    estimator.update(1032.0, 1.0, 0.1)
+    estimator.update(1016.0, 1.0, 0.1)
+    assert (estimator.time, estimator.samples) == (1032.0, 3)
@@ -0,0 +1,73 @@
+"""Tests of the frequency steps FrequencyController fits from the history of adjustments."""
+
+import pytest
+from freq_control import FrequencyController
+
+def drifting_history(drift, gain, steps_list, interval=3600.0, noise=None):
+    """returns: records of adjustments every interval, where steps_list are the steps in effect after each one
+    and the Crtc drifts by drift - gain * steps ms/s.
+    """
+    history = []
+    time = 1000.0
+    offset = 0.0
+    for index, steps in enumerate(steps_list):
+        history.append({'time': time, 'offset': offset, 'residual': 0.0, 'steps': steps})
+        time += interval
+        offset = (drift - gain * steps) * interval + (noise[index] if noise else 0.0)
+    return history
+
+def test_empty_history():
+    controller = FrequencyController()
+    assert controller.fit() is None
+    assert controller.steps_needed() == 0
+
+def test_rates():
+    controller = FrequencyController([{'time': 0.0, 'offset': 0.0, 'residual': 0.5, 'steps': 100},
+                                      {'time': 100.0, 'offset': 2.5, 'residual': 0.0, 'steps': 100},
+                                      {'time': 100.0, 'offset': 0.0, 'residual': 0.0, 'steps': 100}])
+    #The residual of the previous adjustment is not drift, and an interval of zero length is skipped
+    assert controller.rates() == [(0.02, 100, 10000.0)]
+
+def test_one_setting_uses_step_ppm():
+    """With a single steps setting the gain can't be fitted and step_ppm is used."""
+    controller = FrequencyController(drifting_history(0.01, 1e-6, [0, 0, 0]), step_ppm=0.001)
+    drift, gain, error = controller.fit()
+    assert (drift, gain) == (pytest.approx(0.01), 1e-6)
+    assert error == pytest.approx(0.0)
+    assert controller.steps_needed() == 10000
+
+def test_fits_the_gain():
+    """Two settings give the gain, whatever step_ppm says."""
+    controller = FrequencyController(drifting_history(0.01, 2e-6, [0, 1000, 2000, 2000]), step_ppm=0.001)
+    drift, gain, error = controller.fit()
+    assert drift == pytest.approx(0.01)
+    assert gain == pytest.approx(2e-6)
+    assert controller.steps_needed() == 3000
+
+def test_wrong_direction_keeps_step_ppm():
+    controller = FrequencyController(drifting_history(0.01, -2e-6, [0, 1000, 2000]), step_ppm=0.001)
+    assert controller.fit()[1] == 1e-6
+
+def test_noise_shrinks_the_step():
+    noise = [3.0, -3.0, 3.0, -3.0, 0.0, 0.0]     # No bias, only spread
+    exact = FrequencyController(drifting_history(0.001, 1e-6, [0] * 6)).steps_needed()
+    noisy = FrequencyController(drifting_history(0.001, 1e-6, [0] * 6, noise=noise)).steps_needed()
+    assert exact == 1000
+    assert 0 < noisy < exact
+
+def test_max_steps():
+    controller = FrequencyController(drifting_history(1.0, 1e-6, [0, 0]), max_steps=5000)
+    assert controller.steps_needed() == 5000
+    controller = FrequencyController(drifting_history(-1.0, 1e-6, [0, 0]), max_steps=5000)
+    assert controller.steps_needed() == -5000
+
+def test_add_and_set_steps():
+    controller = FrequencyController(size=3)
+    for index in range(5):
+        controller.add(1000.0 * index, 1.0, 0.0, 0)
+    controller.set_steps(40)
+    assert [record['time'] for record in controller.history] == [2000.0, 3000.0, 4000.0]
+    assert controller.history[-1]['steps'] == 40
+    #A date and time adjustment starts the history over
+    controller.add(5000.0, 3600000.0, 0.0, 40)
+    assert len(controller.history) == 1
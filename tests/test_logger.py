@@ -0,0 +1,85 @@
+"""Tests of the bounded log files."""
+
+import logging
+import os
+import logger
+from logger import BoundedFileHandler, trim_tail
+
+def write(path, text):
+    with open(path, 'wb') as f:
+        f.write(text)
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_trim_tail_keeps_the_last_lines(tmpdir):
+    path = str(tmpdir.join('running_output.txt'))
+    write(path, ''.join('line {0}\n'.format(number) for number in range(100)))
+    assert trim_tail(path, 3, 10000, block_size=16)
+    assert read(path) == 'line 97\nline 98\nline 99\n'
+
+def test_trim_tail_keeps_whole_lines_within_max_bytes(tmpdir):
+    path = str(tmpdir.join('running_output.txt'))
+    write(path, 'a' * 20 + '\n' + 'b' * 5 + '\n' + 'c' * 5 + '\n')
+    assert trim_tail(path, 10, 14)
+    assert read(path) == 'b' * 5 + '\n' + 'c' * 5 + '\n'
+
+def test_trim_tail_last_line_without_line_break(tmpdir):
+    path = str(tmpdir.join('running_output.txt'))
+    write(path, 'one\ntwo\nthree')
+    assert trim_tail(path, 2, 10000)
+    assert read(path) == 'two\nthree'
+
+def test_trim_tail_file_within_limits(tmpdir):
+    path = str(tmpdir.join('running_output.txt'))
+    write(path, 'one\ntwo\n')
+    assert not trim_tail(path, 2, 10000)
+    assert logger.trimmed_sizes[path] == 8
+    assert read(path) == 'one\ntwo\n'
+
+def test_trim_tail_skips_an_unchanged_file(tmpdir, monkeypatch):
+    path = str(tmpdir.join('running_output.txt'))
+    write(path, 'one\ntwo\n')
+    trim_tail(path, 2, 10000)
+    monkeypatch.setattr(logger, 'open', lambda *args: 1 / 0, raising=False)     # The file must not be opened
+    assert not trim_tail(path, 2, 10000)
+
+def test_trim_tail_missing_file(tmpdir):
+    assert not trim_tail(str(tmpdir.join('missing.txt')), 2, 10000)
+
+def make_handler(path, max_lines):
+    handler = BoundedFileHandler(path, 100000, max_lines, backup_count=1)
+    handler.setFormatter(logging.Formatter('%(levelname)s-%(message)s'))
+    return handler
+
+def record(message, exc_text=None):
+    entry = logging.LogRecord('test', logging.WARNING, __file__, 1, message, None, None)
+    entry.exc_text = exc_text
+    return entry
+
+def test_handler_counts_the_lines_of_a_traceback(tmpdir):
+    path = str(tmpdir.join('errors.log'))
+    handler = make_handler(path, 100)
+    handler.handle(record('first'))
+    handler.handle(record('failed', 'Traceback (most recent call last):\n  File "x", line 1\nValueError'))
+    handler.close()
+    assert handler.lines == read(path).count('\n') == 5
+
+def test_handler_rotates_at_max_lines(tmpdir):
+    path = str(tmpdir.join('errors.log'))
+    handler = make_handler(path, 4)
+    handler.handle(record('one\ntwo\nthree'))
+    handler.handle(record('four'))
+    handler.handle(record('five'))
+    handler.close()
+    assert read(path) == 'WARNING-five\n'
+    assert read(path + '.1') == 'WARNING-one\ntwo\nthree\nWARNING-four\n'
+
+def test_handler_counts_an_existing_file(tmpdir):
+    path = str(tmpdir.join('errors.log'))
+    write(path, 'one\ntwo\n')
+    handler = make_handler(path, 100)
+    handler.close()
+    assert handler.lines == 2
+    assert os.path.exists(path)
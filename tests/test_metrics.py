@@ -0,0 +1,36 @@
+"""Tests of recording and exporting metrics."""
+
+import json
+import threading
+from metrics import Metrics
+
+def test_prometheus_and_json(tmpdir):
+    metrics = Metrics()
+    metrics.count('serial_commands_total')
+    metrics.count('serial_commands_total', 2)
+    metrics.gauge('crtc_offset_ms', -0.25)
+    path = metrics.export(str(tmpdir), 'json')
+    snapshot = json.load(open(path))
+    assert snapshot['counters'] == {'serial_commands_total': 3}
+    assert snapshot['gauges'] == {'crtc_offset_ms': -0.25}
+    text = open(metrics.export(str(tmpdir))).read()
+    assert 'hipat_serial_commands_total 3' in text
+    assert not tmpdir.join('hipat_metrics.prom.tmp').exists()
+
+def test_concurrent_exports(tmpdir):
+    """Device threads export at the same time, every export replaces the file whole."""
+    metrics = Metrics()
+    errors = []
+    def export():
+        try:
+            for index in range(10):
+                metrics.count('exports_total')
+                json.load(open(metrics.export(str(tmpdir), 'json')))
+        except (IOError, OSError, ValueError) as e:
+            errors.append(e)
+    threads = [threading.Thread(target=export) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
@@ -0,0 +1,88 @@
+"""Tests of the NTP control client against FakeNtpd."""
+
+import pytest
+import ntp_control
+from ntp_control import NtpControl, NtpControlError, parse_variables, peer_record
+from fake_ntpd import FakeNtpd, ntp_timestamp
+
+@pytest.fixture
+def ntpd():
+    server = FakeNtpd({'127.127.20.0': {'offset': '0.004', 'when': 3},
+                       '158.112.160.8': {'offset': '-24.975', 'delay': '1.232', 'jitter': '0.042', 'when': 5}})
+    server.start()
+    yield server
+    server.stop()
+
+def test_parse_variables():
+    data = 'srcadr=158.112.160.8, refid="192.168.1.1",\r\nreach=0xff, offset=-0.250\r\n'
+    assert parse_variables(data) == {'srcadr': '158.112.160.8', 'refid': '192.168.1.1', 'reach': '0xff',
+                                     'offset': '-0.250'}
+
+def test_peer_record_formats_like_ntpq():
+    now = 1792195203.0
+    record = peer_record({'srcadr': '158.112.160.8', 'refid': '192.168.1.1', 'stratum': '1', 'hpoll': '6',
+                          'ppoll': '4', 'reach': '0xff', 'delay': '1.232', 'offset': '-24.975', 'jitter': '0.042',
+                          'rec': ntp_timestamp(now - 5.5)}, now)
+    assert record == {'ref_server': '158.112.160.8', 'refid': '192.168.1.1', 'st': '1', 't': 'u', 'when': '5',
+                      'poll': '16', 'reach': '377', 'delay': '1.232', 'offset': '-24.975', 'jitter': '0.042'}
+
+@pytest.mark.parametrize('reach, octal', [('0xff', '377'), ('0x1', '1'), ('0x0', '0'), ('0xfe', '376'), ('7', '7')])
+def test_peer_record_shows_reach_in_octal(reach, octal):
+    assert peer_record({'reach': reach})['reach'] == octal
+
+def test_peer_record_without_measurement():
+    record = peer_record({'srcadr': '127.127.20.0', 'rec': '0x00000000.00000000', 'dispersion': '0.5'}, 0)
+    assert record['when'] == '-'
+    assert record['poll'] == '-'
+    assert record['t'] == 'l'
+    assert record['jitter'] == '0.5'
+
+def test_ntp_timestamp_round_trip():
+    assert abs(ntp_control._ntp_timestamp(ntp_timestamp(1792195203.25)) - 1792195203.25) < 1e-6
+    assert ntp_control._ntp_timestamp('0x00000000.00000000') is None
+
+def test_associations(ntpd):
+    client = NtpControl(port=ntpd.port)
+    assert sorted(client.associations()) == [1, 2]
+    client.close()
+
+def test_peers(ntpd):
+    client = NtpControl(port=ntpd.port)
+    peers = dict((peer['ref_server'], peer) for peer in client.peers())
+    client.close()
+    assert sorted(peers) == ['127.127.20.0', '158.112.160.8']
+    reference = peers['158.112.160.8']
+    assert (reference['offset'], reference['delay'], reference['jitter']) == ('-24.975', '1.232', '0.042')
+    assert reference['reach'] == '377'
+    assert reference['poll'] == '16'
+    assert 5 <= int(reference['when']) <= 6
+    assert peers['127.127.20.0']['t'] == 'l'
+
+def test_peer(ntpd):
+    client = NtpControl(port=ntpd.port)
+    ntpd.set_peer('158.112.160.8', offset='0.250', when=0)
+    assert client.peer('158.112.160.8')['offset'] == '0.250'
+    assert client.peer('10.0.0.1') is None
+    client.close()
+
+def test_fragmented_response(ntpd):
+    """A response longer than one packet is reassembled from its fragments."""
+    ntpd.set_peer('158.112.160.8', refid='x' * 1000)
+    client = NtpControl(port=ntpd.port)
+    assert client.peer('158.112.160.8')['refid'] == 'x' * 1000
+    client.close()
+
+def test_unknown_association(ntpd):
+    client = NtpControl(port=ntpd.port)
+    with pytest.raises(NtpControlError):
+        client.read_variables(99)
+    client.close()
+
+def test_ntpd_not_running():
+    server = FakeNtpd()
+    port = server.port
+    server.sock.close()
+    client = NtpControl(port=port, timeout=0.2, retries=1)
+    with pytest.raises(NtpControlError):
+        client.peers()
+    client.close()
@@ -0,0 +1,49 @@
+"""Tests of OffsetWindow against the statistics check_offset calculates from the whole list."""
+
+import random
+import pytest
+from offset_window import OffsetWindow
+from check_offset import calculate_average_std
+
+def test_empty_window():
+    window = OffsetWindow(3)
+    assert len(window) == 0
+    assert (window.average(), window.std()) == (0.0, 0.0)
+    assert (window.min(), window.max(), window.median()) == (None, None, None)
+
+def test_push_returns_the_removed_offset():
+    window = OffsetWindow(3)
+    assert [window.push(offset) for offset in (1.0, 2.0, 3.0, 4.0, 5.0)] == [None, None, None, 1.0, 2.0]
+    assert window.full()
+    assert window.values() == [3.0, 4.0, 5.0]
+
+@pytest.mark.parametrize('capacity', [1, 2, 10])
+def test_statistics_match_the_whole_list(capacity):
+    """After every push the window has the statistics of the last capacity offsets."""
+    generator = random.Random(capacity)
+    window = OffsetWindow(capacity)
+    offsets = []
+    for sample in range(200):
+        offset = generator.gauss(-25.0, 0.1) if sample < 100 else generator.gauss(0.2, 2.0)
+        window.push(offset)
+        offsets.append(offset)
+        expected = offsets[-capacity:]
+        average, std = calculate_average_std(expected)
+        assert window.values() == expected
+        assert window.average() == pytest.approx(average, abs=1e-9)
+        assert window.std() == pytest.approx(std, abs=1e-6)
+        assert window.min() == min(expected)
+        assert window.max() == max(expected)
+        ordered = sorted(expected)
+        middle = len(ordered) // 2
+        median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2.0
+        assert window.median() == median
+
+def test_repeated_offsets():
+    """Equal offsets are removed one at a time from the median and the min/max queues."""
+    window = OffsetWindow(4)
+    for offset in (1.0, 1.0, 1.0, 2.0, 1.0, 0.0):
+        window.push(offset)
+    assert window.values() == [1.0, 2.0, 1.0, 0.0]
+    assert (window.min(), window.max(), window.median()) == (0.0, 2.0, 1.0)
+    assert window.std() == pytest.approx(calculate_average_std(window.values())[1])
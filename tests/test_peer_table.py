@@ -0,0 +1,29 @@
+"""Tests of parsing the ntpq -pn table."""
+
+import pytest
+from peer_table import Peer, parse_ntpq, seconds
+
+NTPQ_OUTPUT = """     remote           refid      st t when poll reach   delay   offset  jitter
+==============================================================================
+*127.127.20.0    .GPS.            0 l    3   16   377    0.000    0.004   0.002
++158.112.160.8   192.168.1.1      1 u   12   64   377    1.232  -24.975   0.042
+ 10.0.0.1        .INIT.          16 u    -   64     0    0.000    0.000   0.000
+x192.168.2.1     192.168.1.1      2 u  1.5m 1024  376    2.500  100.250  12.500
+"""
+
+def test_parse_ntpq():
+    peers = parse_ntpq(NTPQ_OUTPUT)
+    assert [peer.ref_server for peer in peers] == ['127.127.20.0', '158.112.160.8', '10.0.0.1', '192.168.2.1']
+    assert peers[1] == Peer('158.112.160.8', '192.168.1.1', '1', 'u', '12', '64', '377', '1.232', '-24.975', '0.042')
+    assert peers[0].t == 'l'
+    assert peers[2].when == '-'
+    assert peers[3].when == '1.5m'
+
+def test_parse_ntpq_without_peers():
+    assert parse_ntpq('') == []
+    assert parse_ntpq(NTPQ_OUTPUT.split('\n', 2)[0] + '\n' + '=' * 78 + '\n') == []
+
+@pytest.mark.parametrize('value, expected', [('12', 12.0), ('-', 0.0), ('2m', 120.0), ('1.5h', 5400.0),
+                                             ('3d', 259200.0)])
+def test_seconds(value, expected):
+    assert seconds(value) == expected
@@ -0,0 +1,94 @@
+"""Tests of Crtc.send_many on a virtual clock. The Crtc is simulated by a port answering the commands written to it
+and a ReplayReader delivering the answers and the status lines sent every second.
+"""
+
+import pytest
+import clock
+from crtc import Crtc
+from replay import ReplayReader
+
+START = 1792195200.0
+STATUS = '$PSRFTXT,054,A,0000'
+
+class Port():
+    """Port stands in for the serial port of the Crtc. Every command is answered after latency seconds, except the
+    commands with an index in drop and every command after silent_after commands.
+    """
+
+    def __init__(self, reader, latency=0.1, drop=(), silent_after=None):
+        self.reader = reader
+        self.latency = latency
+        self.drop = set(drop)
+        self.silent_after = silent_after
+        self.timeout = 3
+        self.written = ''
+        self.commands = 0       # Number of commands written, the unblocking 1s are not commands
+
+    def write(self, text):
+        self.written += text
+        for character in text:
+            if character == '1':
+                continue
+            index, self.commands = self.commands, self.commands + 1
+            if index in self.drop or (self.silent_after is not None and index >= self.silent_after):
+                continue
+            self.reader.answer('$PSRFTXT,ACK', self.latency)
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def virtual():
+    virtual = clock.VirtualClock(START)
+    old_clock = clock.install(virtual)
+    yield virtual
+    clock.install(old_clock)
+
+def make_crtc(virtual, status=True, **port_options):
+    """status: True if the Crtc sends a status line every second.
+    returns: (Crtc, Port)
+    """
+    lines = [(START + second, STATUS) for second in range(1, 600)] if status else []
+    reader = ReplayReader(lines)
+    virtual.listeners.append(reader.deliver)
+    port = Port(reader, **port_options)
+    return Crtc('test', reader=reader, ser=port), port
+
+def test_every_command_answered(virtual):
+    crtc, port = make_crtc(virtual)
+    assert crtc.send_many('oooxx') == {'o': 3, 'x': 2}
+    assert port.written == 'oooxx'
+
+def test_lost_answer_is_resent(virtual):
+    crtc, port = make_crtc(virtual, drop=[1])
+    assert crtc.send_many('ooo') == {'o': 3}
+    assert port.written == 'oooo'
+
+def test_late_answer_is_counted_not_resent(virtual):
+    """Without status lines after the deadline the late answer may still come, the command isn't sent twice."""
+    crtc, port = make_crtc(virtual, status=False, latency=4.0)
+    assert crtc.send_many('oo') == {'o': 2}
+    assert port.written == 'oo'
+
+def test_batch_dropped_after_lost_answers(virtual):
+    """After more than retries answers in a row are lost, nothing more of the batch is sent."""
+    crtc, port = make_crtc(virtual, drop=range(2, 100))
+    assert crtc.send_many('ooxxxzz', retries=3) == {'o': 2, 'x': 0, 'z': 0}
+    assert 'z' not in port.written
+    assert port.written.endswith('1111111111')
+
+def test_batch_dropped_when_crtc_hangs(virtual):
+    """A Crtc that neither answers nor sends status lines is assumed to hang."""
+    crtc, port = make_crtc(virtual, status=False, silent_after=2)
+    assert crtc.send_many('oooozz') == {'o': 2, 'z': 0}
+    assert 'z' not in port.written
+    assert port.written.endswith('1111111111')
+    assert clock.time() - START < 30
+
+def test_commands_without_answer(virtual):
+    crtc, port = make_crtc(virtual, silent_after=0)
+    assert crtc.send_many('+++', None) == {'+': 3}
+    assert port.written == '+++'
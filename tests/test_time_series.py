@@ -0,0 +1,92 @@
+"""Tests of the ring file of TimeSeries: wraparound, records out of time order and reopening the file."""
+
+import struct
+import pytest
+import time_series
+from time_series import TimeSeries, RECORD
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('history.ring'))
+
+def times(records):
+    return [record.time for record in records]
+
+def test_append_and_read(path):
+    series = TimeSeries(path, 4)
+    series.append(100.0, 1.5, 0.2, 10.0, '158.112.160.8')
+    series.append(101.0, -0.5, adjustment=2.0)
+    assert len(series) == 2
+    assert series.record(0) == time_series.Record(100.0, 1.5, 0.2, 10.0, 0.0, '158.112.160.8')
+    assert series.record(-1) == time_series.Record(101.0, -0.5, 0.0, 0.0, 2.0, '0.0.0.0')
+    with pytest.raises(IndexError):
+        series.record(2)
+
+def test_wraparound(path):
+    series = TimeSeries(path, 4)
+    for second in range(10):
+        series.append(100.0 + second, float(second))
+    assert (len(series), series.count) == (4, 10)
+    assert times(series.records()) == [106.0, 107.0, 108.0, 109.0]
+    assert times(series.records(107.0, 109.0)) == [107.0, 108.0]
+    assert (series.find(105.0), series.find(107.5), series.find(200.0)) == (0, 2, 4)
+
+def test_views_wrap_around(path):
+    series = TimeSeries(path, 4)
+    for second in range(6):
+        series.append(100.0 + second, float(second))
+    parts = series.views()
+    #The oldest two records are at the end of the file, the newest two at its start
+    if time_series.numpy is None:
+        assert [len(part) for part in parts] == [2 * RECORD.size, 2 * RECORD.size]
+        values = [RECORD.unpack_from(part, position)[0]
+                  for part in parts for position in range(0, len(part), RECORD.size)]
+    else:
+        assert [len(part) for part in parts] == [2, 2]
+        values = [value for part in parts for value in part['time']]
+    assert values == [102.0, 103.0, 104.0, 105.0]
+    assert series.views(110.0) == []
+
+def test_out_of_order(path):
+    series = TimeSeries(path, 8)
+    for time in (100.0, 102.0, 101.0, 104.0, 103.0):
+        series.append(time, 0.0)
+    assert not series.ordered()
+    #find searches one by one and records filters every record against the range
+    assert series.find(102.5) == 3
+    assert times(series.records(101.0, 104.0)) == [102.0, 101.0, 103.0]
+    assert times(series.records(103.0)) == [104.0, 103.0]
+
+def test_order_comes_back_when_the_record_is_overwritten(path):
+    series = TimeSeries(path, 3)
+    for time in (100.0, 101.0, 99.0, 102.0):
+        series.append(time, 0.0)
+    assert not series.ordered()
+    series.append(103.0, 0.0)
+    assert series.ordered()
+    assert times(series.records(101.5)) == [102.0, 103.0]
+
+def test_reopen_keeps_the_records(path):
+    series = TimeSeries(path, 4)
+    for time in (100.0, 102.0, 101.0, 103.0, 104.0):
+        series.append(time, 0.0)
+    series.close()
+    series = TimeSeries(path, 4)
+    assert series.count == 5
+    assert times(series.records()) == [102.0, 101.0, 103.0, 104.0]
+    assert not series.ordered()
+
+def test_reopen_with_another_capacity_starts_over(path):
+    series = TimeSeries(path, 4)
+    series.append(100.0, 0.0)
+    series.close()
+    series = TimeSeries(path, 8)
+    assert (len(series), series.count) == (0, 0)
+
+def test_invalid_header_starts_over(path):
+    series = TimeSeries(path, 4)
+    series.append(100.0, 0.0)
+    series.close()
+    with open(path, 'r+b') as ring:
+        ring.write(struct.pack('<4s', 'XXXX'))
+    assert len(TimeSeries(path, 4)) == 0
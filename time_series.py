@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""time_series.py keeps the history of samples and adjustments in a fixed size binary ring file on temporary storage.
+The file is memory mapped, so appending a record is a copy of 48 bytes into the map, and it is kept across restarts
+of the daemon. Other processes can map the same file to read the history.
+
+Every record holds time, offset, jitter, delay and adjustment as doubles (ms, time in seconds since the epoch) and
+the source as a packed IPv4 address. If numpy is installed views returns numpy arrays of the records that share
+memory with the file, otherwise read only buffers of the raw records.
+
+Usage:
+    series = get_series()
+    series.append(clock.time(), offset, jitter, delay, '158.112.160.8')
+    for record in series.records(clock.time() - 3600):
+        print record.offset
+"""
+
+import collections
+import mmap
+import os
+import socket
+import struct
+import threading
+from config import config
+
+try:
+    import numpy
+except ImportError:     # The history can be read record by record without numpy
+    numpy = None
+
+MAGIC = 'HPTS'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQ')       # magic, version, record size, capacity, number of records ever appended
+HEADER_SIZE = 64
+RECORD = struct.Struct('<dddddI4x')     # time, offset, jitter, delay, adjustment, source
+if numpy is not None:
+    DTYPE = numpy.dtype([('time', '<f8'), ('offset', '<f8'), ('jitter', '<f8'), ('delay', '<f8'),
+                         ('adjustment', '<f8'), ('source', '<u4'), ('padding', 'V4')])
+
+Record = collections.namedtuple('Record', 'time offset jitter delay adjustment source')
+
+def pack_source(address):
+    """returns: IPv4 address as an int, 0 if it isn't one."""
+    try:
+        return struct.unpack('!I', socket.inet_aton(address))[0]
+    except (socket.error, TypeError):
+        return 0
+
+def unpack_source(value):
+    """returns: IPv4 address from an int."""
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+class TimeSeries():
+    """TimeSeries is the ring of records in one file. Only one process is to append to a file."""
+
+    def __init__(self, path, capacity):
+        """Maps the file, it is created if it doesn't exist or was made for another capacity or record layout.
+
+        path: file of the ring.
+        capacity: number of records kept, the oldest is overwritten when it is full.
+        """
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        size = HEADER_SIZE + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size or not self._valid(fd):
+                os.ftruncate(fd, 0)     # Start over, the old records can't be read with this layout
+                os.ftruncate(fd, size)
+                os.write(fd, HEADER.pack(MAGIC, VERSION, RECORD.size, capacity, 0))
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.count = HEADER.unpack_from(self.map, 0)[4]
+        #Samples are appended with the time ntpd measured them, so a record can be older than the one before it.
+        #disorder is the number of the newest such record ever appended, -1 if there is none.
+        self.disorder = -1
+        for index in xrange(1, len(self)):
+            if self._time(index) < self._time(index - 1):
+                self.disorder = self.count - len(self) + index
+
+    def _valid(self, fd):
+        """returns: True if the file has a header matching this layout."""
+        header = os.read(fd, HEADER.size)
+        os.lseek(fd, 0, os.SEEK_SET)
+        if len(header) < HEADER.size:
+            return False
+        magic, version, record_size, capacity, count = HEADER.unpack(header)
+        return magic == MAGIC and version == VERSION and record_size == RECORD.size and capacity == self.capacity
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, time, offset, jitter=0.0, delay=0.0, source='', adjustment=0.0):
+        """Appends a record, overwriting the oldest when the ring is full.
+
+        time: seconds since the epoch.
+        offset, jitter, delay: ms as reported by ntpd.
+        source: address of the server measured.
+        adjustment: ms the Crtc was adjusted, 0 for a sample.
+        returns: None
+        """
+        with self.lock:
+            if self.count and time < self._time(len(self) - 1):
+                self.disorder = self.count
+            RECORD.pack_into(self.map, HEADER_SIZE + (self.count % self.capacity) * RECORD.size,
+                             time, offset, jitter or 0.0, delay or 0.0, adjustment, pack_source(source))
+            self.count += 1
+            HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.capacity, self.count)  # After the record
+        return
+
+    def _slot(self, index):
+        """returns: position in the file of the index'th oldest record kept."""
+        return HEADER_SIZE + ((max(self.count - self.capacity, 0) + index) % self.capacity) * RECORD.size
+
+    def _time(self, index):
+        """returns: time of the index'th oldest record kept."""
+        return struct.unpack_from('<d', self.map, self._slot(index))[0]
+
+    def ordered(self):
+        """returns: True if the records kept are in time order."""
+        return self.disorder <= self.count - len(self)
+
+    def record(self, index):
+        """returns: the index'th oldest record kept as a Record, negative indexes count from the newest."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('record index out of range')
+        values = RECORD.unpack_from(self.map, self._slot(index))
+        return Record(*(values[:5] + (unpack_source(values[5]),)))
+
+    def find(self, time):
+        """Finds the first record at or after time. The records are searched with bisection when they are in time
+        order, otherwise one by one.
+
+        returns: index of the record, the number of records if there is none.
+        """
+        if not self.ordered():
+            for index in xrange(len(self)):
+                if self._time(index) >= time:
+                    return index
+            return len(self)
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._time(middle) < time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def records(self, start=None, end=None):
+        """returns: iterator of the Records from time start until time end."""
+        first = 0 if start is None else self.find(start)
+        last = len(self) if end is None else self.find(end)
+        if self.ordered():
+            return (self.record(index) for index in xrange(first, last))
+        #A record out of order can be older than start, or come after the first record at or after end
+        records = (self.record(index) for index in xrange(first, len(self)))
+        return (record for record in records
+                if (start is None or record.time >= start) and (end is None or record.time < end))
+
+    def views(self, start=None, end=None):
+        """Returns the records from time start until time end without copying them. The records are in one or two
+        parts, depending on whether they wrap around the end of the ring. When the records are out of order the
+        parts run from the first record at or after start to the first at or after end, records outside the range
+        can be among them.
+
+        returns: list of numpy arrays with the fields of Record, or of buffers of packed records without numpy.
+        """
+        first = 0 if start is None else self.find(start)
+        last = len(self) if end is None else self.find(end)
+        parts = []
+        while first < last:
+            position = self._slot(first)
+            number = min(last - first, (HEADER_SIZE + self.capacity * RECORD.size - position) // RECORD.size)
+            if numpy is not None:
+                parts.append(numpy.frombuffer(self.map, DTYPE, number, position))
+            else:
+                parts.append(buffer(self.map, position, number * RECORD.size))
+            first += number
+        return parts
+
+    def close(self):
+        self.map.close()
+
+series = None   # The time series of this process, created by get_series
+series_lock = threading.Lock()
+
+def get_series():
+    """Returns the time series of the process, the file is mapped the first time it is used.
+
+    returns: TimeSeries
+    """
+    global series
+    with series_lock:
+        if series is None:
+            series = TimeSeries(os.path.join(config['temporary_storage'], 'history.ring'), config['history_size'])
+    return series
@@ -4,10 +4,19 @@ from functools import wraps
 import errno
 import os
 import signal
+import time
 
 class TimeoutError(Exception):
     pass
 
+def monotonic():
+    """Returns seconds from an arbitrary point that never jumps when the system clock is set. 
+    Used for deadlines, since HiPAT steps the system clock.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic()
+    return os.times()[4]    # Elapsed real time, counted in clock ticks since boot
+
 def timeout(seconds=10, error_message=os.strerror(errno.ETIMEDOUT)):
     def decorator(func):
         def _handle_timeout(signum, frame):